@@ -1,6 +1,15 @@
 from django.contrib import admin
 from chat.models import PrivateMessage, UserStatus
 
-admin.site.register(PrivateMessage)
+
+@admin.register(PrivateMessage)
+class PrivateMessageAdmin(admin.ModelAdmin):
+    # Bulk reads go through manage.py export_messages or /export/; the change list stays cheap on big tables.
+    list_display = ('id', 'sender', 'recipient', 'timestamp', 'is_read')
+    list_select_related = ('sender', 'recipient')
+    raw_id_fields = ('sender', 'recipient')
+    show_full_result_count = False
+
+
 admin.site.register(UserStatus)
 # Register your models here.
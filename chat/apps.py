@@ -3,4 +3,12 @@ from django.apps import AppConfig
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'chat'
\ No newline at end of file
+    name = 'chat'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+
+        from . import fragments, user_cache  # noqa: F401  (connect the User and UserStatus invalidation signals)
+        from .search import repair_fts_triggers
+
+        post_migrate.connect(repair_fts_triggers, sender=self)
@@ -0,0 +1,152 @@
+"""Cold storage for old messages: gzip-compressed, per-dialog segments in ArchivedSegment.
+
+`manage.py apply_retention` moves messages older than CHAT_RETENTION_DAYS out
+of PrivateMessage, so the hot table and its indexes only hold recent
+history. Each dialog's archive is the start of its history without gaps: a
+run takes messages oldest first and stops at the first one that has to stay
+(unread, or the dialog's last message, which its Conversation points at).
+New messages fill up the dialog's newest segment before another is started,
+CHAT_ARCHIVE_SEGMENT_MESSAGES to a segment.
+
+Archived messages read back as unsaved PrivateMessage instances with their
+original id, seq and timestamp: get_history_page continues into the archive
+once PrivateMessage runs out, and attachment_view finds them by id. Search,
+delta sync and resume only cover PrivateMessage.
+"""
+import gzip
+import json
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .models import ArchivedSegment, PrivateMessage
+from .persistence import message_record
+
+ARCHIVE_SEGMENT_MESSAGES = getattr(settings, 'CHAT_ARCHIVE_SEGMENT_MESSAGES', 1000)
+
+
+def encode_segment(records):
+    data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records).encode()
+    # mtime=0 so the same messages always compress to the same bytes.
+    return gzip.compress(data, mtime=0)
+
+
+def decode_segment(segment):
+    return [json.loads(line) for line in gzip.decompress(bytes(segment.data)).splitlines()]
+
+
+def record_position(record):
+    return parse_datetime(record['timestamp']), record['id']
+
+
+def message_from_record(record, users=None):
+    message = PrivateMessage(
+        id=record['id'],
+        sender_id=record['sender_id'],
+        recipient_id=record['recipient_id'],
+        dialog_key=record['dialog_key'],
+        seq=record['seq'],
+        content=record['content'],
+        file=record['file'] or '',
+        is_read=True,
+        timestamp=parse_datetime(record['timestamp']),
+    )
+    if users is not None and record['sender_id'] in users:
+        message.sender = users[record['sender_id']]
+    return message
+
+
+def fill_segment(segment, records):
+    # Normally already in order; messages imported later with old timestamps may not be.
+    records = sorted(records, key=record_position)
+    first, last = records[0], records[-1]
+    segment.first_timestamp, segment.first_id = record_position(first)
+    segment.last_timestamp, segment.last_id = record_position(last)
+    segment.min_id = min(record['id'] for record in records)
+    segment.max_id = max(record['id'] for record in records)
+    segment.message_count = len(records)
+    segment.files = sorted({record['file'] for record in records if record['file']})
+    segment.data = encode_segment(records)
+    return segment
+
+
+def archive_dialog(conversation, cutoff, segment_size=ARCHIVE_SEGMENT_MESSAGES):
+    """Move the dialog's messages from before `cutoff` into its segments; returns how many moved."""
+    moved = 0
+    while True:
+        with transaction.atomic():
+            candidates = list(
+                PrivateMessage.objects.filter(dialog_key=conversation.dialog_key, timestamp__lt=cutoff)
+                .order_by('timestamp', 'id')[:segment_size]
+            )
+            messages = []
+            for message in candidates:
+                if not message.is_read or message.pk == conversation.last_message_id:
+                    break
+                messages.append(message)
+            if not messages:
+                return moved
+
+            records = [message_record(message) for message in messages]
+            tail = ArchivedSegment.objects.filter(dialog_key=conversation.dialog_key) \
+                .order_by('-last_timestamp', '-last_id').first()
+            if tail is not None and tail.message_count < segment_size:
+                room = segment_size - tail.message_count
+                fill_segment(tail, decode_segment(tail) + records[:room]).save()
+                records = records[room:]
+            for start in range(0, len(records), segment_size):
+                fill_segment(ArchivedSegment(
+                    dialog_key=conversation.dialog_key,
+                    user_low_id=conversation.user_low_id,
+                    user_high_id=conversation.user_high_id,
+                ), records[start:start + segment_size]).save()
+            # Not .delete(): the collector would load every row and send post_delete, which
+            # releases attachment references the archive still holds.
+            PrivateMessage.objects.filter(pk__in=[message.pk for message in messages])._raw_delete(
+                PrivateMessage.objects.db
+            )
+        moved += len(messages)
+        if len(messages) < len(candidates) or len(candidates) < segment_size:
+            return moved
+
+
+def archived_messages(dialog_key, before=None, limit=50):
+    """Up to `limit` archived messages of the dialog before the (timestamp, id) `before`, newest first."""
+    segments = ArchivedSegment.objects.filter(dialog_key=dialog_key)
+    if before is not None:
+        timestamp, pk = before
+        segments = segments.filter(Q(first_timestamp__lt=timestamp) | Q(first_timestamp=timestamp, first_id__lt=pk))
+    records = []
+    # Most pages need one segment, so they are loaded one at a time.
+    for segment in segments.order_by('-last_timestamp', '-last_id').iterator(chunk_size=1):
+        for record in reversed(decode_segment(segment)):
+            if before is None or record_position(record) < before:
+                records.append(record)
+                if len(records) == limit:
+                    break
+        if len(records) == limit:
+            break
+    users = User.objects.in_bulk({record['sender_id'] for record in records})
+    return [message_from_record(record, users) for record in records]
+
+
+def find_archived_message(user, message_id):
+    """The archived message with this id from one of `user`'s dialogs, or None."""
+    segments = ArchivedSegment.objects.filter(
+        Q(user_low=user) | Q(user_high=user), min_id__lte=message_id, max_id__gte=message_id,
+    )
+    for segment in segments.iterator(chunk_size=1):
+        for record in decode_segment(segment):
+            if record['id'] == message_id:
+                return message_from_record(record)
+    return None
+
+
+def archived_file_names():
+    names = set()
+    for files in ArchivedSegment.objects.values_list('files', flat=True).iterator():
+        names.update(files)
+    return names
@@ -0,0 +1,237 @@
+import hashlib
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .models import Blob
+from .uploads import BLOB_DIR
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are optional, originals are served instead
+    Image = None
+
+# Set to 'X-Accel-Redirect' (nginx) or 'X-Sendfile' (Apache, lighttpd) to let
+# the web server send the bytes; the prefix is the internal location that maps
+# onto MEDIA_ROOT.
+ATTACHMENT_SENDFILE_HEADER = getattr(settings, 'CHAT_ATTACHMENT_SENDFILE_HEADER', None)
+ATTACHMENT_SENDFILE_PREFIX = getattr(settings, 'CHAT_ATTACHMENT_SENDFILE_PREFIX', '/protected-media/')
+THUMBNAIL_SIZES = getattr(settings, 'CHAT_THUMBNAIL_SIZES', (200, 400))
+THUMBNAIL_DIR = 'chat_files/thumbnails'
+LEGACY_UPLOAD_DIR = 'chat_files'
+INLINE_TYPES = ('image/', 'video/', 'audio/')
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class Attachment:
+    """A file on disk behind a PrivateMessage, with the validators used for caching."""
+
+    def __init__(self, name, path, content_type, etag, stat):
+        self.name = name
+        self.path = path
+        self.content_type = content_type
+        self.etag = etag
+        self.size = stat.st_size
+        self.last_modified = int(stat.st_mtime)
+
+    @classmethod
+    def for_message(cls, message):
+        """The message's file, if it is one its sender may attach; `message` needs `file` and `sender_id`."""
+        name = Blob.name_from_file_value(message.file.name)
+        if not name:
+            return None
+        blob = None
+        # The file field is free text sent by clients: only a blob the sender uploaded, or a file
+        # from the old upload_to='chat_files/' field, never anything else under MEDIA_ROOT.
+        if name.startswith(BLOB_DIR + '/'):
+            blob = Blob.objects.filter(
+                name=name, uploads__user_id=message.sender_id, uploads__completed_at__isnull=False,
+            ).only('sha256', 'content_type').first()
+            if blob is None:
+                return None
+        elif not is_legacy_upload(name):
+            return None
+        root = os.path.realpath(settings.MEDIA_ROOT)
+        path = os.path.realpath(os.path.join(root, name))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        if blob is not None:
+            # Blobs are content-addressed, so the digest is a strong validator for free.
+            return cls(name, path, blob.content_type, blob_etag(blob), stat)
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        return cls(name, path, content_type, stat_etag(stat), stat)
+
+    @property
+    def immutable(self):
+        return self.name.startswith(BLOB_DIR + '/')
+
+    @property
+    def is_image(self):
+        return is_image_type(self.content_type)
+
+
+def is_image_type(content_type):
+    # SVG can carry scripts and is not something Pillow reads anyway.
+    return content_type.startswith('image/') and content_type != 'image/svg+xml'
+
+
+def annotate_images(messages):
+    """Set `is_image` on each message, whether its file gets a thumbnail; one query for the blobs."""
+    names = {message.pk: Blob.name_from_file_value(message.file.name) for message in messages}
+    blob_types = dict(Blob.objects.filter(name__in=[name for name in names.values() if name])
+                      .values_list('name', 'content_type'))
+    for message in messages:
+        name = names[message.pk]
+        content_type = blob_types.get(name) or (mimetypes.guess_type(name)[0] if name else None)
+        message.is_image = bool(content_type) and is_image_type(content_type)
+    return messages
+
+
+def is_legacy_upload(name):
+    # Files saved straight into chat_files/ before uploads were deduplicated into blobs.
+    directory, _, filename = name.rpartition('/')
+    return directory == LEGACY_UPLOAD_DIR and filename not in ('', '.', '..')
+
+
+def blob_etag(blob):
+    return f'"{blob.sha256}"'
+
+
+def stat_etag(stat):
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """Return (start, end) inclusive for a single byte range, or None to send the whole file.
+
+    Multi-range requests are answered with the whole file, which RFC 9110 allows.
+    """
+    match = RANGE_PATTERN.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if not length:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+class RangeFile:
+    """Read-only view of `length` bytes of a file starting at `start`."""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def thumbnail_key(name, etag):
+    # Changes with the file's content, so a replaced file never gets a stale thumbnail.
+    return hashlib.sha256(f"{name}|{etag}".encode()).hexdigest()
+
+
+def thumbnail_for(attachment, size):
+    """Path of a cached JPEG thumbnail, generated on first use; None if it cannot be made."""
+    if Image is None or not attachment.is_image:
+        return None
+    key = thumbnail_key(attachment.name, attachment.etag)
+    path = os.path.join(settings.MEDIA_ROOT, THUMBNAIL_DIR, key[:2], f"{key}-{size}.jpg")
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with Image.open(attachment.path) as image:
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            temporary = f"{path}.{os.getpid()}.tmp"
+            image.save(temporary, 'JPEG', quality=80, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    # Concurrent requests may render the same thumbnail, the last rename wins.
+    os.replace(temporary, path)
+    return path
+
+
+def cache_headers(response, attachment, etag):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(attachment.last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    if attachment.immutable:
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def serve_attachment(request, attachment, thumbnail_size=None):
+    path, content_type, etag, size = attachment.path, attachment.content_type, attachment.etag, attachment.size
+    if thumbnail_size:
+        thumbnail = thumbnail_for(attachment, thumbnail_size)
+        if thumbnail is not None:
+            path, content_type, size = thumbnail, 'image/jpeg', os.path.getsize(thumbnail)
+            etag = f'{etag[:-1]}-t{thumbnail_size}"'
+
+    response = get_conditional_response(request, etag=etag, last_modified=attachment.last_modified)
+    if response is not None:
+        return cache_headers(response, attachment, etag)
+
+    if ATTACHMENT_SENDFILE_HEADER and path == attachment.path:
+        # The web server handles ranges and conditionals itself from here.
+        response = HttpResponse(content_type=content_type)
+        response[ATTACHMENT_SENDFILE_HEADER] = ATTACHMENT_SENDFILE_PREFIX + attachment.name
+        return cache_headers(response, attachment, etag)
+
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return cache_headers(response, attachment, etag)
+
+    file = open(path, 'rb')
+    if byte_range is None:
+        # A plain file object lets the server use wsgi.file_wrapper / sendfile().
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = FileResponse(RangeFile(file, start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    disposition = 'inline' if content_type.startswith(INLINE_TYPES) else 'attachment'
+    response['Content-Disposition'] = disposition
+    response['X-Content-Type-Options'] = 'nosniff'
+    return cache_headers(response, attachment, etag)
@@ -0,0 +1,402 @@
+"""Load and latency benchmarks for the WebSocket consumers.
+
+Every scenario drives the real consumers through Channels'
+WebsocketCommunicator on an in-memory channel layer and cache, so nothing here needs
+Redis or a network. Run them with ``manage.py benchmark_consumers``.
+"""
+import asyncio
+import json
+import resource
+import statistics
+import time
+import tracemalloc
+import weakref
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .consumers import NotificationConsumer, OnlineStatusConsumer
+from .notifications import notification_event, notification_group_name
+from .persistence import get_message_writer
+from .presence import SUPERUSER_WATCHERS_GROUP, status_batch_payload
+from .routing import websocket_urlpatterns
+from .wire import CODECS, fanout as preencode
+
+# Selected with --layer; neither needs Redis.
+BENCHMARK_CHANNEL_LAYERS = {
+    'inmemory': {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'capacity': 100000, 'expiry': 600},
+        },
+    },
+    'local': {
+        'default': {
+            'BACKEND': 'chat.layers.LocalFirstChannelLayer',
+            'CONFIG': {'capacity': 100000, 'expiry': 600},
+        },
+    },
+}
+
+# Fragments and unread counters (chat.fragments, chat.notifications) live in the cache.
+BENCHMARK_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}
+
+RECEIVE_TIMEOUT = 30
+
+# Every connection opened in this process, whichever thread it belongs to: the
+# database writer and reader threads (chat.database) keep theirs open.
+opened_connections = weakref.WeakSet()
+connection_created.connect(lambda connection, **kwargs: opened_connections.add(connection), weak=False)
+
+
+class QueryCounter:
+    """Counts SQL statements on every connection, including the ones
+    held or opened later by the database worker threads."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def _install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def _install_all(self):
+        for connection in {*connections.all(initialized_only=True), *opened_connections}:
+            self._install(connection)
+
+    def _uninstall_all(self):
+        for connection in {*connections.all(initialized_only=True), *opened_connections}:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+    async def __aenter__(self):
+        connection_created.connect(self._install)
+        self._install_all()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        connection_created.disconnect(self._install)
+        self._uninstall_all()
+
+
+class EncodeCounter:
+    """Counts and times every frame encode by the wire codecs while active."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def _wrap(self, encode):
+        def counted(event):
+            start = time.perf_counter()
+            try:
+                return encode(event)
+            finally:
+                self.seconds += time.perf_counter() - start
+                self.count += 1
+        return counted
+
+    def __enter__(self):
+        for codec in CODECS.values():
+            codec.encode = self._wrap(codec.encode)
+        return self
+
+    def __exit__(self, *exc_info):
+        for codec in CODECS.values():
+            del codec.encode
+
+
+class Recorder:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.sent = 0
+        self.delivered = 0
+        self.queries = 0
+        self.started = None
+        self.elapsed = None
+        self.extra = {}
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def delivered_after(self, sent_at):
+        self.delivered += 1
+        self.latencies.append(time.perf_counter() - sent_at)
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        result = {
+            'scenario': self.name,
+            'sent': self.sent,
+            'delivered': self.delivered,
+            'elapsed_s': round(self.elapsed, 4),
+            'messages_per_s': round(self.delivered / self.elapsed, 1) if self.elapsed else None,
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'mean': round(statistics.fmean(latencies) * 1000, 3) if latencies else None,
+            },
+            'db_queries_per_message': round(self.queries / self.sent, 3) if self.sent else None,
+        }
+        result.update(self.extra)
+        return result
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, round(pct / 100 * (len(sorted_values) - 1)))
+    return round(sorted_values[index] * 1000, 3)
+
+
+async def connect(application, path, user=None):
+    communicator = WebsocketCommunicator(application, path)
+    if user is not None:
+        communicator.scope['user'] = user
+    connected, _ = await communicator.connect(timeout=RECEIVE_TIMEOUT)
+    if not connected:
+        raise RuntimeError(f"Could not connect to {path}")
+    return communicator
+
+
+async def disconnect_all(communicators):
+    await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+
+
+@sync_to_async
+def create_users(prefix, count, is_superuser=False):
+    User.objects.bulk_create([
+        User(username=f"{prefix}{i}", is_superuser=is_superuser) for i in range(count)
+    ], ignore_conflicts=True)
+    return list(User.objects.filter(username__startswith=prefix).order_by('id')[:count])
+
+
+async def private_chat(pairs=500, messages=10):
+    """Each pair has one sender and one receiver socket in its own room."""
+    recorder = Recorder('private_chat')
+    application = URLRouter(websocket_urlpatterns)
+    users = await create_users('bench_chat_', pairs * 2)
+    senders, receivers = [], []
+    for i in range(pairs):
+        a, b = users[2 * i].username, users[2 * i + 1].username
+        senders.append(await connect(application, f"/ws/chat/{a}/{b}/", users[2 * i]))
+        receivers.append(await connect(application, f"/ws/chat/{b}/{a}/", users[2 * i + 1]))
+
+    sent_at = {}
+
+    async def send(communicator, pair):
+        for n in range(messages):
+            key = f"{pair}:{n}"
+            sent_at[key] = time.perf_counter()
+            await communicator.send_to(text_data=json.dumps({'message': key}))
+            recorder.sent += 1
+
+    async def receive(communicator):
+        received = 0
+        while received < messages:
+            event = json.loads(await communicator.receive_from(timeout=RECEIVE_TIMEOUT))
+            if event.get('type') == 'chat_message':
+                recorder.delivered_after(sent_at[event['message']])
+                received += 1
+
+    async with QueryCounter() as queries:
+        recorder.start()
+        await asyncio.gather(
+            *(send(communicator, pair) for pair, communicator in enumerate(senders)),
+            *(receive(communicator) for communicator in receivers),
+        )
+        await get_message_writer().aclose()
+        recorder.stop()
+    recorder.queries = queries.count
+    await disconnect_all(senders + receivers)
+    return recorder
+
+
+async def notifications(clients=1000, messages=5):
+    recorder = Recorder('notifications')
+    users = await create_users('bench_notify_', clients)
+    application = NotificationConsumer.as_asgi()
+    communicators = [await connect(application, '/ws/notifications/', user) for user in users]
+    channel_layer = get_channel_layer()
+    sent_at = {}
+
+    async def send(user):
+        for n in range(messages):
+            key = f"{user.username}:{n}"
+            sent_at[key] = time.perf_counter()
+            await channel_layer.group_send(notification_group_name(user.username), notification_event([
+                {'sender': 'benchmark', 'unread': n + 1, 'message': key},
+            ]))
+            recorder.sent += 1
+
+    async def receive(communicator):
+        for _ in range(messages):
+            event = json.loads(await communicator.receive_from(timeout=RECEIVE_TIMEOUT))
+            recorder.delivered_after(sent_at[event['dialogs'][0]['message']])
+
+    async with QueryCounter() as queries:
+        recorder.start()
+        await asyncio.gather(*(send(user) for user in users), *(receive(c) for c in communicators))
+        recorder.stop()
+    recorder.queries = queries.count
+    await disconnect_all(communicators)
+    return recorder
+
+
+async def online_status(watchers=50, clients=1000):
+    """Superuser watchers observe regular users coming online."""
+    recorder = Recorder('online_status')
+    admins = await create_users('bench_admin_', watchers, is_superuser=True)
+    users = await create_users('bench_status_', clients)
+    application = OnlineStatusConsumer.as_asgi()
+    watching = [await connect(application, '/ws/online_status/', admin) for admin in admins]
+    connected_at = {}
+
+    async def receive(communicator):
+        seen = 0
+        while seen < clients:
+            event = json.loads(await communicator.receive_from(timeout=RECEIVE_TIMEOUT))
+            for change in event.get('changes', []):
+                if change['username'] in connected_at and change['is_online']:
+                    recorder.delivered_after(connected_at[change['username']])
+                    seen += 1
+
+    async def go_online(user):
+        connected_at[user.username] = time.perf_counter()
+        recorder.sent += 1
+        return await connect(application, '/ws/online_status/', user)
+
+    async with QueryCounter() as queries:
+        recorder.start()
+        receivers = asyncio.gather(*(receive(c) for c in watching))
+        online = await asyncio.gather(*(go_online(user) for user in users))
+        await receivers
+        recorder.stop()
+    recorder.queries = queries.count
+    await disconnect_all(online + watching)
+    return recorder
+
+
+async def screenshare(rooms=10, peers=2, signals=5):
+    """Peers signal inside their own room; fan-out per signal should not depend on `rooms`."""
+    recorder = Recorder(f'screenshare[rooms={rooms}]')
+    application = URLRouter(websocket_urlpatterns)
+    communicators = []
+    for room in range(rooms):
+        for _ in range(peers):
+            communicator = await connect(application, f"/ws/screenshare/bench{room}/")
+            await communicator.receive_from(timeout=RECEIVE_TIMEOUT)  # welcome
+            communicators.append(communicator)
+    sent_at = {}
+    expected = signals * (peers - 1)
+
+    async def send(index, communicator):
+        for n in range(signals):
+            key = f"{index}:{n}"
+            sent_at[key] = time.perf_counter()
+            await communicator.send_to(text_data=json.dumps({'offer': key}))
+            recorder.sent += 1
+
+    async def receive(communicator):
+        received = 0
+        while received < expected:
+            event = json.loads(await communicator.receive_from(timeout=RECEIVE_TIMEOUT))
+            if 'offer' in event:
+                recorder.delivered_after(sent_at[event['offer']])
+                received += 1
+
+    async with QueryCounter() as queries:
+        recorder.start()
+        await asyncio.gather(
+            *(send(i, c) for i, c in enumerate(communicators)),
+            *(receive(c) for c in communicators),
+        )
+        recorder.stop()
+    recorder.queries = queries.count
+    recorder.extra['fanout_per_signal'] = round(recorder.delivered / recorder.sent, 3)
+    await disconnect_all(communicators)
+    return recorder
+
+
+async def fanout(watchers=100, broadcasts=20, changes=20):
+    """CPU per status broadcast to a group of `watchers`, encoded per socket vs once at group_send."""
+    recorder = Recorder(f'fanout[watchers={watchers}]')
+    admins = await create_users('bench_fanout_', watchers, is_superuser=True)
+    application = OnlineStatusConsumer.as_asgi()
+    watching = [await connect(application, '/ws/online_status/', admin) for admin in admins]
+    channel_layer = get_channel_layer()
+    changed = [{'user_id': n, 'username': f"bench_status_{n}", 'is_online': n % 2 == 0} for n in range(changes)]
+    await asyncio.sleep(0.1)
+    # The watchers' own presence changes go to the other group; drain anything else.
+    for communicator in watching:
+        while not await communicator.receive_nothing(timeout=0.01):
+            await communicator.receive_output()
+
+    async def receive(communicator):
+        for _ in range(broadcasts):
+            await communicator.receive_from(timeout=RECEIVE_TIMEOUT)
+
+    async def run(encode_once):
+        receivers = asyncio.gather(*(receive(c) for c in watching))
+        with EncodeCounter() as encodes:
+            cpu = time.process_time()
+            for _ in range(broadcasts):
+                event = {'type': 'presence_batch', 'changes': changed}
+                if encode_once:
+                    event = preencode(event, status_batch_payload(event))
+                await channel_layer.group_send(SUPERUSER_WATCHERS_GROUP, event)
+            await receivers
+            cpu = time.process_time() - cpu
+        return {
+            'cpu_us_per_broadcast': round(cpu / broadcasts * 1e6, 1),
+            'encodes_per_broadcast': round(encodes.count / broadcasts, 2),
+            'encode_us_per_broadcast': round(encodes.seconds / broadcasts * 1e6, 1),
+        }
+
+    recorder.extra['per_socket'] = await run(encode_once=False)
+    recorder.sent = broadcasts
+    recorder.start()
+    recorder.extra['encode_once'] = await run(encode_once=True)
+    recorder.stop()
+    recorder.delivered = broadcasts * watchers
+    await disconnect_all(watching)
+    return recorder
+
+
+SCENARIOS = {
+    'private_chat': private_chat,
+    'notifications': notifications,
+    'online_status': online_status,
+    'screenshare': screenshare,
+    'fanout': fanout,
+}
+
+
+def run_scenario(name, trace_memory=False, **options):
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        recorder = asyncio.run(SCENARIOS[name](**options))
+        if trace_memory:
+            recorder.extra['peak_traced_memory_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    recorder.extra['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return recorder.result()
@@ -1,198 +1,437 @@
-import json
-from channels.db import database_sync_to_async
+import asyncio
+import time
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-from django.contrib.auth.models import User
+from urllib.parse import parse_qs
 import logging
-from .models import PrivateMessage, UserStatus
+from django.conf import settings
+from .attachments import annotate_images
+from .database import db_read, db_write
+from .metrics import GROUP_SEND_SECONDS
+from .models import PrivateMessage
+from .notifications import get_unread_notifier, notification_group_name, notification_payload
+from .persistence import WriteQueueFull, get_message_writer
+from .presence import get_presence_tracker, status_batch_payload, watcher_group_for
+from .replay import REPLAY_DB_CHUNK, REPLAY_MAX_MESSAGES, latest_seq, message_event, missed_messages, replay_buffers
+from .signaling import (
+    DEFAULT_ROOM, SCREENSHARE_CANDIDATE_BATCH, SCREENSHARE_CANDIDATE_WINDOW, SEAT_TOUCH_INTERVAL, RoomFull,
+    room_group_name, signaling_rooms,
+)
+from .sync import chat_group_name
+from .throttling import ThrottleMixin, throttle_counters
+from .uploads import owned_blob_name
+from .user_cache import aget_user
+from .wire import WireProtocolMixin, fanout
 
 logger = logging.getLogger(__name__)
 
-class PrivateChatConsumer(AsyncWebsocketConsumer):
+# Read watermarks from one connection are coalesced into one UPDATE per interval.
+READ_RECEIPT_INTERVAL = getattr(settings, 'CHAT_READ_RECEIPT_INTERVAL', 0.25)
+# How long a closing connection keeps broadcasting messages it already accepted.
+BROADCAST_DRAIN_TIMEOUT = getattr(settings, 'CHAT_BROADCAST_DRAIN_TIMEOUT', 5.0)
+# Messages from one connection that may wait to be saved and broadcast.
+OUTBOX_LIMIT = getattr(settings, 'CHAT_OUTBOX_LIMIT', 50)
+
+
+# What clients receive for the group events whose handlers reshape them.
+def signal_payload(event):
+    return dict(event['message'], **{'from': event['from']})
+
+
+class PrivateChatConsumer(ThrottleMixin, WireProtocolMixin, AsyncWebsocketConsumer):
+    throttle_scope = 'chat'
+    room_group_name = None
 
     async def connect(self):
-        logger.info(f"Attempting WebSocket connection: {self.channel_name}")
+        logger.info("Attempting WebSocket connection: %s", self.channel_name)
+        self.sender_username = self.scope['url_route']['kwargs']['sender_username']
+        # The URL names the sender; only that user may send, replay history or mark it read.
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated or user.username != self.sender_username:
+            await self.close()
+            return
         try:
-            self.sender_username = self.scope['url_route']['kwargs']['sender_username']
             self.recipient_username = self.scope['url_route']['kwargs']['recipient_username']
-            self.room_name = f"chat_{min(self.sender_username, self.recipient_username)}_{max(self.sender_username, self.recipient_username)}"
-            self.room_group_name = f"chat_{self.room_name}"
+            self.room_group_name = chat_group_name(self.sender_username, self.recipient_username)
+            self.read_watermark = None
+            self.read_flush = None
+            # Highest seq sent to this client; live events at or below it were already replayed.
+            self.delivered_seq = None
+            # Saved messages are broadcast in the order they were received, by one task.
+            self.outbox = asyncio.Queue()
+            self.broadcaster = None
+            self.closing = False
+            # Both participants are fixed for the connection, resolve them once.
+            self.sender_user = await aget_user(self.sender_username)
+            self.recipient_user = await aget_user(self.recipient_username)
+            self.dialog_key = PrivateMessage.make_dialog_key(self.sender_user.pk, self.recipient_user.pk)
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
             await self.accept()
-            logger.info(f"WebSocket connected to room: {self.room_group_name}")
-            logger.info(f"Connected to channel : {self.channel_name}")
+            self.broadcaster = asyncio.ensure_future(self.broadcast_saved())
+            resume_from = parse_qs(self.scope.get('query_string', b'').decode()).get('resume_from')
+            if resume_from:
+                await self.replay(int(resume_from[0]))
+            logger.info("WebSocket connected to room %s on channel %s", self.room_group_name, self.channel_name)
         except Exception as e:
-            logger.error(f"WebSocket connection error: {str(e)}")
+            logger.error("WebSocket connection error: %s", e)
             await self.close()
 
     async def disconnect(self, close_code):
-        logger.info(f"WebSocket disconnected: {self.channel_name}")
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-
-    async def receive(self, text_data):
+        logger.info("WebSocket disconnected: %s", self.channel_name)
+        self.closing = True
+        if getattr(self, 'broadcaster', None) is not None:
+            # Messages already accepted from this client are still broadcast to the room.
+            self.outbox.put_nowait(None)
+            try:
+                await asyncio.wait_for(self.broadcaster, BROADCAST_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Gave up broadcasting %s message(s) from %s", self.outbox.qsize(), self.channel_name)
+        if getattr(self, 'read_flush', None) is not None:
+            self.read_flush.cancel()
+            await self.flush_read_receipt()
+        if self.room_group_name is not None:
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = self.decode_frame(text_data, bytes_data)
+            if text_data_json.get('type') == 'read':
+                await self.queue_read_receipt(text_data_json.get('up_to'))
+                return
+
             message = text_data_json.get('message', None)
             file_url = text_data_json.get('file_url')
 
             if not message and not file_url:
-                await self.send(text_data=json.dumps({'error': 'No message provided'}))
+                await self.send_event({'error': 'No message provided'})
                 return
 
             if message is None:
-                await self.send(text_data=json.dumps({'error': 'No message provided'}))
+                await self.send_event({'error': 'No message provided'})
                 return
 
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'file_url': file_url,
-                    'sender': self.sender_username,
-                    'recipient': self.recipient_username,
-                }
-            )
+            if file_url and await db_read(owned_blob_name)(self.sender_user.pk, file_url) is None:
+                await self.send_event({
+                    'error': 'File not found',
+                    'client_id': text_data_json.get('client_id'),
+                })
+                return
+
+            if self.outbox.qsize() >= OUTBOX_LIMIT:
+                throttle_counters['outbox_full'] += 1
+                await self.send_event({
+                    'error': 'Too many messages in flight',
+                    'client_id': text_data_json.get('client_id'),
+                })
+                return
+
+            try:
+                saved = await self.save_message(self.sender_user.pk, self.recipient_user.pk, message, file_url)
+            except WriteQueueFull:
+                logger.warning("Message writer is full, rejecting message on %s", self.channel_name)
+                await self.send_event({'error': 'Server busy, message not sent'})
+                return
 
-            await self.save_message(self.sender_username, self.recipient_username, message, file_url)
-            logger.info(f"Message received: {message}")
-        except json.JSONDecodeError:
-            logger.error("Invalid JSON received")
-            await self.send(text_data=json.dumps({'error': 'Invalid JSON'}))
+            # Broadcast once persisted, so every event carries the seq it was stored with.
+            self.outbox.put_nowait((saved, text_data_json.get('client_id')))
+            # Never the content: this runs for every message.
+            logger.debug("Message received on %s", self.channel_name)
+        except ValueError:
+            logger.error("Invalid frame received")
+            await self.send_event({'error': 'Invalid JSON'})
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
-
-    @sync_to_async
-    def save_message(self, sender_username, recipient_username, content, file_url):
-        sender_user = User.objects.get(username=sender_username)
-        recipient_user = User.objects.get(username=recipient_username)
-        message = PrivateMessage.objects.create(
-            sender=sender_user,
-            recipient=recipient_user,
-            content=content,
-            file=file_url
+        replay_buffers.record(self.room_group_name, event)
+        seq = event.get('seq')
+        if seq is not None and self.delivered_seq is not None:
+            if seq <= self.delivered_seq:
+                return
+            self.delivered_seq = seq
+        await self.send_event(event)
+
+    async def replay(self, resume_from):
+        """Send what the client missed after `resume_from`, from memory when the buffer covers the gap."""
+        latest = await db_read(latest_seq)(self.dialog_key)
+        # Client input: a seq past the newest message would make chat_message drop the next live ones.
+        resume_from = min(max(resume_from, 0), latest)
+        self.delivered_seq = resume_from
+        if latest == resume_from:
+            return
+        if latest - resume_from > REPLAY_MAX_MESSAGES:
+            await self.send_event({'type': 'resync', 'seq': latest})
+            self.delivered_seq = latest
+            return
+        events = replay_buffers.events_after(self.room_group_name, resume_from, latest)
+        if events is None:
+            # The gap is older than this process's buffer, stream it from the (dialog_key, seq) index.
+            while self.delivered_seq < latest:
+                chunk = await db_read(missed_messages)(
+                    self.dialog_key, self.delivered_seq, latest, REPLAY_DB_CHUNK
+                )
+                if not chunk:
+                    break
+                await self.send_replayed(chunk)
+        else:
+            await self.send_replayed(events)
+
+    async def send_replayed(self, events):
+        for event in events:
+            await self.send_event(event)
+        if events:
+            self.delivered_seq = max(self.delivered_seq, events[-1]['seq'])
+
+    async def save_message(self, sender_id, recipient_id, content, file_url):
+        # Queued for the next batched write; the returned future resolves to the saved message.
+        writer = get_message_writer()
+        return await writer.submit(sender_id, recipient_id, content, file_url)
+
+    async def broadcast_saved(self):
+        while True:
+            item = await self.outbox.get()
+            if item is None:
+                return
+            saved, client_id = item
+            try:
+                message = await saved
+            except Exception as e:
+                logger.error("Message could not be saved: %s", e)
+                if not self.closing:
+                    await self.send_event({'error': 'Message could not be saved', 'client_id': client_id})
+                continue
+            if message.file.name:
+                await db_read(annotate_images)([message])
+            event = fanout(message_event(
+                message, self.sender_username, self.recipient_username, getattr(message, 'is_image', False),
+            ))
+            replay_buffers.record(self.room_group_name, event)
+            with GROUP_SEND_SECONDS.time('chat_message'):
+                await self.channel_layer.group_send(self.room_group_name, event)
+            get_unread_notifier().message_saved(message, self.sender_username, self.recipient_username)
+            if self.closing:
+                continue
+            await self.send_event({
+                'type': 'message_ack',
+                'id': message.pk,
+                'seq': message.seq,
+                'client_id': client_id,
+            })
+
+    async def queue_read_receipt(self, up_to):
+        # up_to is the newest message id the client has displayed; None means everything.
+        if self.scope['user'].pk != self.sender_user.pk:
+            # connect() already refuses anyone else; receipts change the sender's unread counts.
+            await self.send_event({'error': 'Not allowed'})
+            return
+        if up_to is not None and not isinstance(up_to, int):
+            await self.send_event({'error': 'Invalid read watermark'})
+            return
+        if self.read_flush is None:
+            self.read_watermark = up_to
+            self.read_flush = asyncio.ensure_future(self.flush_read_receipt_later())
+        elif self.read_watermark is not None:
+            self.read_watermark = None if up_to is None else max(self.read_watermark, up_to)
+
+    async def flush_read_receipt_later(self):
+        await asyncio.sleep(READ_RECEIPT_INTERVAL)
+        await self.flush_read_receipt()
+
+    async def flush_read_receipt(self):
+        self.read_flush = None
+        up_to, self.read_watermark = self.read_watermark, None
+        updated = await db_write(PrivateMessage.mark_read_up_to)(
+            self.sender_user.pk, self.recipient_user.pk, up_to
         )
-        return message
+        if updated:
+            get_unread_notifier().dialog_read(self.sender_user, self.recipient_user, everything=up_to is None)
+            with GROUP_SEND_SECONDS.time('read_receipt'):
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    fanout({
+                        'type': 'read_receipt',
+                        'reader': self.sender_username,
+                        'up_to': up_to,
+                    })
+                )
+
+    async def read_receipt(self, event):
+        await self.send_event(event)
 
     async def user_online(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'type': 'user_status',
             'username': event['username'],
             'status': 'online',
-        }))
+        })
 
     async def user_offline(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'type': 'user_status',
             'username': event['username'],
             'status': 'offline',
-        }))
+        })
 
+class NotificationConsumer(ThrottleMixin, WireProtocolMixin, AsyncWebsocketConsumer):
+    """Unread counter updates for the connected user, see chat.notifications."""
+    throttle_scope = 'notifications'
+    group_name = None
 
-    async def send_notification(self, recipient_username, message):
-        recipient = await sync_to_async(User.objects.get)(username=recipient_username)
-        if recipient.is_authenticated:
-            await self.channel_layer.group_send(
-                f"notifications_{recipient_username}",
-                {
-                    'type': 'notification_message',
-                    'message': message,
-                    'sender': self.sender_username
-                }
-            )
-
-class NotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
+        if not self.scope['user'].is_authenticated:
+            await self.close()
+            return
         self.username = self.scope['user'].username
-        self.group_name = f"notifications_{self.username}"
+        self.group_name = notification_group_name(self.username)
 
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if self.group_name is not None:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def notification_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'notification',
-            'sender': event['sender'],
-            'message': event['message']
-        }))
+        await self.send_event(dict(notification_payload(event), _eid=event.get('_eid')),
+                              frames=event.get('_frames'))
+
+class ScreenShareConsumer(ThrottleMixin, WireProtocolMixin, AsyncWebsocketConsumer):
+    throttle_scope = 'screenshare'
+    joined = False
 
-class ScreenShareConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.room_group_name = 'screenshare'
+        self.room_name = self.scope['url_route']['kwargs'].get('room_name', DEFAULT_ROOM)
+        self.room_group_name = room_group_name(self.room_name)
+        self.peer_id = uuid.uuid4().hex[:12]
+        self.pending_candidates = {}
+        self.candidate_flush = None
         logger.info("Attempting WebSocket connection")
 
+        await self.accept()
+        try:
+            await signaling_rooms.join(self.room_name, self.peer_id, self.channel_name)
+        except RoomFull as e:
+            logger.warning(str(e))
+            await self.send_event({'error': 'Room is full'})
+            await self.close(code=4003)
+            return
+        self.joined = True
+        self.seat_touched = time.monotonic()
+
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name,
         )
-        await self.accept()
+        await self.send_event({
+            'type': 'welcome',
+            'peer_id': self.peer_id,
+            'peers': await signaling_rooms.peers(self.room_name, exclude=self.peer_id),
+        })
+        with GROUP_SEND_SECONDS.time('peer_joined'):
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                fanout({'type': 'peer_joined', 'peer_id': self.peer_id})
+            )
         logger.info("Websocket connected")
 
     async def disconnect(self, close_code):
+        if not self.joined:
+            return
+        if self.candidate_flush is not None:
+            self.candidate_flush.cancel()
+        await signaling_rooms.leave(self.room_name, self.peer_id)
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        with GROUP_SEND_SECONDS.time('peer_left'):
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                fanout({'type': 'peer_left', 'peer_id': self.peer_id})
+            )
         logger.info("Websocket disconnected for Screen Shareing")
 
-    async def receive(self, text_data):
-        message = json.loads(text_data)
-        logger.info("Reciving signal..")
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'signal_message',
-                'message': message
-            }
-        )
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            message = self.decode_frame(text_data, bytes_data)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            await self.send_event({'error': 'Invalid signal'})
+            return
+        logger.debug("Reciving signal..")
+        if time.monotonic() - self.seat_touched > SEAT_TOUCH_INTERVAL:
+            self.seat_touched = time.monotonic()
+            await signaling_rooms.touch(self.room_name, self.peer_id)
+        target = message.pop('to', None)
+        if set(message) == {'candidate'}:
+            await self.queue_candidate(target, message['candidate'])
+        else:
+            await self.deliver(target, message)
+
+    async def deliver(self, target, message):
+        # Signals addressed to a peer go to its channel, anything else to the room.
+        event = {'type': 'signal_message', 'message': message, 'from': self.peer_id}
+        if target is None:
+            with GROUP_SEND_SECONDS.time('signal_message'):
+                await self.channel_layer.group_send(self.room_group_name, fanout(event, signal_payload(event)))
+            return
+        channel_name = await signaling_rooms.channel_for(self.room_name, target)
+        if channel_name is None:
+            await self.send_event({'error': 'Unknown peer', 'peer_id': target})
+            return
+        await self.channel_layer.send(channel_name, event)
+
+    async def queue_candidate(self, target, candidate):
+        # Trickled ICE candidates arrive in bursts, forward them as one frame per window.
+        candidates = self.pending_candidates.setdefault(target, [])
+        candidates.append(candidate)
+        if len(candidates) >= SCREENSHARE_CANDIDATE_BATCH:
+            await self.deliver(target, {'candidates': self.pending_candidates.pop(target)})
+        elif self.candidate_flush is None:
+            self.candidate_flush = asyncio.ensure_future(self.flush_candidates_later())
+
+    async def flush_candidates_later(self):
+        await asyncio.sleep(SCREENSHARE_CANDIDATE_WINDOW)
+        self.candidate_flush = None
+        pending, self.pending_candidates = self.pending_candidates, {}
+        for target, candidates in pending.items():
+            await self.deliver(target, {'candidates': candidates})
 
     async def signal_message(self, event):
-        message = event['message']
-        await self.send(text_data=json.dumps(message))
+        if event['from'] == self.peer_id:
+            return
+        await self.send_event(dict(signal_payload(event), _eid=event.get('_eid')), frames=event.get('_frames'))
+
+    async def peer_joined(self, event):
+        if event['peer_id'] != self.peer_id:
+            await self.send_event(event)
+
+    async def peer_left(self, event):
+        if event['peer_id'] != self.peer_id:
+            await self.send_event(event)
 
 
-class OnlineStatusConsumer(AsyncWebsocketConsumer):
+class OnlineStatusConsumer(ThrottleMixin, WireProtocolMixin, AsyncWebsocketConsumer):
+    throttle_scope = 'status'
 
     async def connect(self):
 
         self.user = self.scope["user"]
         if self.user.is_authenticated:
-            await self.set_online_status(self.user, True)
-            await self.channel_layer.group_add("online_users", self.channel_name)
+            self.group_name = watcher_group_for(self.user)
+            await self.channel_layer.group_add(self.group_name, self.channel_name)
             await self.accept()
-            await self.broadcast_user_status(self.user, True)
+            await get_presence_tracker().connect(self.user)
 
     async def disconnect(self, close_code):
         if self.user.is_authenticated:
-            await self.set_online_status(self.user, False)
-            await self.channel_layer.group_discard("online_users", self.channel_name)
-            await self.broadcast_user_status(self.user, False)
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await get_presence_tracker().disconnect(self.user)
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode_frame(text_data, bytes_data)
         message = data.get("message", "")
-        await self.send(text_data=json.dumps({"message": message}))
-
-    async def broadcast_user_status(self, user, is_online):
-        await self.channel_layer.group_send(
-            "online_users",
-            {
-                "type": "user_status",
-                "user_id": user.id,
-                "username": user.username,
-                "is_online": is_online,
-            }
-        )
-
-    async def user_status(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_event({"message": message})
 
-    @sync_to_async
-    def set_online_status(self, user, status):
-        user_status, _ = UserStatus.objects.get_or_create(user=user)
-        user_status.is_online = status
-        user_status.save()
\ No newline at end of file
+    async def presence_batch(self, event):
+        await self.send_event(dict(status_batch_payload(event), _eid=event.get('_eid')),
+                              frames=event.get('_frames'))
\ No newline at end of file
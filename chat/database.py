@@ -0,0 +1,43 @@
+"""Threads the chat's database work runs on.
+
+SQLite has one writer at a time. Writes from the consumers all go through
+one dedicated thread, in the order they were submitted, so they never
+compete for the write lock with each other; reads run on a small pool, in
+parallel with that writer under WAL (see DATABASES in settings). Each thread
+keeps its connection open (CONN_MAX_AGE = None).
+
+HTTP views (reading a dialog, uploads) and management commands still write
+on their own threads. They are rarer than socket messages and take the lock
+in turn with the writer thread: transactions start IMMEDIATE and wait up to
+the busy timeout instead of failing.
+
+Both wrap like channels' database_sync_to_async:
+
+    saved = await db_write(write_batch)(batch)
+    latest = await db_read(latest_seq)(dialog_key)
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+from .metrics import Gauge
+
+DB_READER_THREADS = getattr(settings, 'CHAT_DB_READER_THREADS', 4)
+
+writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-db-writer')
+reader_executor = ThreadPoolExecutor(max_workers=DB_READER_THREADS, thread_name_prefix='chat-db-reader')
+
+
+def db_write(func):
+    """database_sync_to_async, on the single writer thread."""
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=writer_executor)
+
+
+def db_read(func):
+    """database_sync_to_async, on the reader pool. `func` must not write."""
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=reader_executor)
+
+
+Gauge('chat_db_writer_queue_depth', "Calls waiting for the database writer thread.",
+      callback=lambda: writer_executor._work_queue.qsize())
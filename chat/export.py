@@ -0,0 +1,224 @@
+"""Bulk export and import of messages as NDJSON or CSV.
+
+Exports run per dialog, oldest message first, starting with the dialog's
+archived segments (chat.archive). Every query fetches one page by keyset
+(timestamp, id), so memory stays at about CHAT_EXPORT_CHUNK_SIZE messages
+however many there are. No cursor stays open between pages, which lets the
+HTTP endpoint produce each page on whichever reader thread is free.
+
+One exported message:
+
+    {"id": 17, "sender": "alice", "recipient": "bob", "seq": 4, "timestamp": "2024-03-01T09:30:00+00:00",
+     "is_read": true, "content": "hi", "file": null}
+
+Imports refer to users by username and give messages new ids and seqs, so
+an export can be loaded into another database; `id` and `seq` are only
+informative there. Seqs are arrival order, which replay and delta sync go
+by, so imported messages come after the dialog's existing ones whatever
+their timestamps; history pages still order by timestamp. A message already
+in the dialog, hot or archived, with the same sender, timestamp and content
+is skipped, so loading the same export twice adds nothing. Cached unread
+counters catch up with imported unread messages at the next reconciliation
+(chat.notifications).
+"""
+import csv
+import io
+import json
+from itertools import chain, islice
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .archive import decode_segment
+from .models import ArchivedSegment, Conversation, PrivateMessage
+from .persistence import insert_messages, resolve_user_ids
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'CHAT_EXPORT_CHUNK_SIZE', 2000)
+IMPORT_BATCH_SIZE = getattr(settings, 'CHAT_IMPORT_BATCH_SIZE', 1000)
+
+EXPORT_FIELDS = ('id', 'sender', 'recipient', 'seq', 'timestamp', 'is_read', 'content', 'file')
+MESSAGE_COLUMNS = ('id', 'sender_id', 'recipient_id', 'seq', 'timestamp', 'is_read', 'content', 'file')
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv; charset=utf-8'}
+
+
+def scoped_conversations(user=None, other=None):
+    conversations = Conversation.objects.all()
+    if user is not None and other is not None:
+        conversations = conversations.filter(dialog_key=PrivateMessage.make_dialog_key(user.pk, other.pk))
+    elif user is not None:
+        conversations = conversations.filter(Q(user_low=user) | Q(user_high=user))
+    return conversations.select_related('user_low', 'user_high') \
+        .only('dialog_key', 'user_low__username', 'user_high__username')
+
+
+def export_record(message, usernames):
+    """A row of MESSAGE_COLUMNS, or an archive record, as exported."""
+    timestamp = message['timestamp']
+    return {
+        'id': message['id'],
+        'sender': usernames[message['sender_id']],
+        'recipient': usernames[message['recipient_id']],
+        'seq': message['seq'],
+        'timestamp': timestamp if isinstance(timestamp, str) else timestamp.isoformat(),
+        'is_read': message.get('is_read', True),
+        'content': message['content'],
+        'file': message['file'] or None,
+    }
+
+
+def dialog_records(conversation, segment_ids, chunk_size):
+    """Yield the dialog's messages oldest first: the archived ones, then PrivateMessage a page at a time."""
+    usernames = {
+        conversation.user_low_id: conversation.user_low.username,
+        conversation.user_high_id: conversation.user_high.username,
+    }
+    for segment_id in segment_ids:
+        for record in decode_segment(ArchivedSegment.objects.only('data').get(pk=segment_id)):
+            yield export_record(record, usernames)
+
+    position = None
+    while True:
+        messages = PrivateMessage.objects.filter(dialog_key=conversation.dialog_key)
+        if position is not None:
+            timestamp, pk = position
+            messages = messages.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk))
+        rows = list(messages.order_by('timestamp', 'id').values(*MESSAGE_COLUMNS)[:chunk_size])
+        for row in rows:
+            yield export_record(row, usernames)
+        if len(rows) < chunk_size:
+            return
+        position = rows[-1]['timestamp'], rows[-1]['id']
+
+
+def export_pages(user=None, other=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield lists of about `chunk_size` exported messages: every dialog, `user`'s, or theirs with `other`."""
+    last_pk = 0
+    while True:
+        conversations = list(scoped_conversations(user, other).filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not conversations:
+            return
+        last_pk = conversations[-1].pk
+        segments = {}
+        rows = ArchivedSegment.objects.filter(dialog_key__in=[c.dialog_key for c in conversations]) \
+            .order_by('first_timestamp', 'first_id').values_list('dialog_key', 'pk')
+        for dialog_key, pk in rows:
+            segments.setdefault(dialog_key, []).append(pk)
+        # Small dialogs share pages, so an export of many short dialogs is not one chunk per dialog.
+        records = chain.from_iterable(
+            dialog_records(conversation, segments.get(conversation.dialog_key, ()), chunk_size)
+            for conversation in conversations
+        )
+        while page := list(islice(records, chunk_size)):
+            yield page
+
+
+def encode_ndjson(records):
+    return ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+
+def encode_csv(records, header=False):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, EXPORT_FIELDS)
+    if header:
+        writer.writeheader()
+    writer.writerows(records)
+    return buffer.getvalue()
+
+
+def export_chunks(format, pages):
+    """Encode pages from export_pages as NDJSON or CSV text, one string per page."""
+    if format == 'csv':
+        yield encode_csv([], header=True)
+    encode = encode_csv if format == 'csv' else encode_ndjson
+    for records in pages:
+        yield encode(records)
+
+
+def read_records(stream, format):
+    """Parse an export from a text stream, one record at a time."""
+    if format == 'csv':
+        # CSV gives back strings; empty cells are what None was written as.
+        for row in csv.DictReader(stream):
+            row['is_read'] = row['is_read'] in ('True', 'true', '1')
+            row['file'] = row['file'] or None
+            yield row
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def message_identity(dialog_key, sender_id, timestamp, content, file):
+    """What makes an imported message the same as one already stored; ids and seqs differ between databases.
+
+    No content and no file are both '' here: CSV writes None as an empty cell.
+    """
+    return dialog_key, sender_id, timestamp, content or '', file or ''
+
+
+def existing_identities(messages):
+    """Identities of stored messages, hot or archived, in the timespan of unsaved `messages` per dialog."""
+    spans = {}
+    for message in messages:
+        low, high = spans.get(message.dialog_key, (message.timestamp, message.timestamp))
+        spans[message.dialog_key] = min(low, message.timestamp), max(high, message.timestamp)
+    identities = set()
+    for dialog_key, (low, high) in spans.items():
+        rows = PrivateMessage.objects.filter(dialog_key=dialog_key, timestamp__range=(low, high)) \
+            .values_list('sender_id', 'timestamp', 'content', 'file')
+        identities.update(message_identity(dialog_key, *row) for row in rows)
+        segments = ArchivedSegment.objects.filter(dialog_key=dialog_key, first_timestamp__lte=high,
+                                                  last_timestamp__gte=low).only('data')
+        for segment in segments:
+            identities.update(
+                message_identity(dialog_key, record['sender_id'], parse_datetime(record['timestamp']),
+                                 record['content'], record['file'])
+                for record in decode_segment(segment)
+            )
+    return identities
+
+
+def import_batch(records):
+    """Insert one batch of exported records; returns (imported, skipped).
+
+    Skipped are records with a sender or recipient unknown here and messages
+    that are already stored.
+    """
+    user_ids = resolve_user_ids({record['sender'] for record in records} | {record['recipient'] for record in records})
+    messages = []
+    for record in records:
+        sender_id, recipient_id = user_ids[record['sender']], user_ids[record['recipient']]
+        if sender_id is None or recipient_id is None:
+            continue
+        messages.append(PrivateMessage(
+            sender_id=sender_id,
+            recipient_id=recipient_id,
+            dialog_key=PrivateMessage.make_dialog_key(sender_id, recipient_id),
+            content=record['content'],
+            file=record['file'] or '',
+            is_read=record['is_read'],
+            timestamp=parse_datetime(record['timestamp']),
+        ))
+    if messages:
+        seen = existing_identities(messages)
+        new = []
+        for message in messages:
+            identity = message_identity(message.dialog_key, message.sender_id, message.timestamp, message.content,
+                                        message.file.name)
+            if identity not in seen:
+                seen.add(identity)
+                new.append(message)
+        messages = new
+    if messages:
+        # Oldest first, so seqs within one batch follow timestamps even for files not in export order.
+        messages.sort(key=lambda message: message.timestamp)
+        insert_messages(messages)
+    return len(messages), len(records) - len(messages)
+
+
+def import_records(records, batch_size=IMPORT_BATCH_SIZE):
+    """Insert records in batches, each with one bulk_create; yields (imported, skipped) per batch."""
+    records = iter(records)
+    while batch := list(islice(records, batch_size)):
+        yield import_batch(batch)
@@ -0,0 +1,92 @@
+"""Cached fragments of the chat page.
+
+The sidebar (who the user can chat with and who is online) is rendered once
+per user and kept in CHAT_FRAGMENT_CACHE, the Redis cache in production.
+Every key includes a shared version number; a change to any user or status
+bumps it, which retires every user's cached sidebar at once without having to
+find their keys.
+
+presence writes statuses with queryset updates, which send no signals, so it
+calls invalidate_sidebars itself.
+"""
+import logging
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .metrics import Counter
+from .models import UserStatus
+
+logger = logging.getLogger(__name__)
+
+FRAGMENT_CACHE = getattr(settings, 'CHAT_FRAGMENT_CACHE', 'default')
+SIDEBAR_CACHE_TIMEOUT = getattr(settings, 'CHAT_SIDEBAR_CACHE_TIMEOUT', 600)
+
+SIDEBAR_VERSION_KEY = 'chat:sidebar:version'
+
+FRAGMENT_LOOKUPS = Counter('chat_fragment_cache_lookups_total', "Cached page fragment lookups.",
+                           ['fragment', 'result'])
+
+
+def sidebar_version(cache):
+    version = cache.get(SIDEBAR_VERSION_KEY)
+    if version is None:
+        # Never expires: a version that went back to 1 could serve sidebars cached under the old 1.
+        cache.add(SIDEBAR_VERSION_KEY, 1, timeout=None)
+        version = cache.get(SIDEBAR_VERSION_KEY, 1)
+    return version
+
+
+def invalidate_sidebars():
+    cache = caches[FRAGMENT_CACHE]
+    try:
+        try:
+            cache.incr(SIDEBAR_VERSION_KEY)
+        except ValueError:
+            # Not set yet, so nothing can be cached under it either.
+            cache.add(SIDEBAR_VERSION_KEY, 1, timeout=None)
+    except Exception as e:
+        # Best effort: runs inside every user and status write, which must not fail because the
+        # cache is down. Sidebars cached meanwhile expire after SIDEBAR_CACHE_TIMEOUT.
+        logger.warning("Could not invalidate cached sidebars: %s", e)
+
+
+def sidebar_users(user):
+    # The same people user_list_view lists: superusers talk to regular users and the other way round.
+    return User.objects.filter(is_superuser=not user.is_superuser).exclude(pk=user.pk) \
+        .select_related('userstatus').order_by('username')
+
+
+def render_sidebar(user):
+    """The sidebar's HTML for `user`, from the cache when it has not changed since."""
+    cache = caches[FRAGMENT_CACHE]
+    key = f"chat:sidebar:{sidebar_version(cache)}:{user.pk}"
+    html = cache.get(key)
+    if html is not None:
+        FRAGMENT_LOOKUPS.inc('sidebar', 'hit')
+        # Rendered by us; a cache serializer may not keep it marked safe.
+        return mark_safe(html)
+    FRAGMENT_LOOKUPS.inc('sidebar', 'miss')
+    html = render_to_string('chat/sidebar.html', {'user': user, 'users': sidebar_users(user)})
+    cache.set(key, html, SIDEBAR_CACHE_TIMEOUT)
+    return html
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_on_user_change(sender, instance, update_fields=None, **kwargs):
+    # Logging in saves last_login, which the sidebar does not show.
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    invalidate_sidebars()
+
+
+@receiver(post_save, sender=UserStatus)
+@receiver(post_delete, sender=UserStatus)
+def invalidate_on_status_change(sender, **kwargs):
+    invalidate_sidebars()
@@ -0,0 +1,75 @@
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.urls import reverse
+
+from .archive import archived_messages
+from .models import PrivateMessage
+
+HISTORY_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+HISTORY_MAX_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 200)
+
+
+def encode_cursor(message):
+    raw = f"{message.timestamp.isoformat()}|{message.pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything that was not produced by encode_cursor.
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (UnicodeError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def dialog_messages(user, other):
+    dialog_key = PrivateMessage.make_dialog_key(user.pk, other.pk)
+    return PrivateMessage.objects.filter(dialog_key=dialog_key)
+
+
+def get_history_page(user, other, before=None, limit=HISTORY_PAGE_SIZE):
+    """Return (messages, next_cursor) for one page, newest message first.
+
+    `before` is a cursor from a previous page; `next_cursor` is None once the
+    start of the conversation has been reached. Pages continue into the
+    archive (chat.archive) past the oldest message still in PrivateMessage.
+    """
+    limit = max(1, min(int(limit), HISTORY_MAX_PAGE_SIZE))
+    messages = dialog_messages(user, other).select_related('sender')
+    position = None
+    if before:
+        position = decode_cursor(before)
+        timestamp, pk = position
+        messages = messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk))
+
+    page = list(messages.order_by('-timestamp', '-id')[:limit + 1])
+    if len(page) <= limit:
+        archived = archived_messages(PrivateMessage.make_dialog_key(user.pk, other.pk), position,
+                                     limit + 1 - len(page))
+        if archived:
+            page = sorted(page + archived, key=lambda message: (message.timestamp, message.pk), reverse=True)
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1])
+    return page, next_cursor
+
+
+def serialize_message(message):
+    # `message` went through attachments.annotate_images; only images get a thumbnail.
+    return {
+        'id': message.pk,
+        'seq': message.seq,
+        'sender': message.sender.username,
+        'content': message.content,
+        'file_url': message.file.name or None,
+        'attachment_url': reverse('attachment', args=[message.pk]) if message.file.name else None,
+        'thumbnail_url': reverse('attachment_thumbnail', args=[message.pk]) if message.is_image else None,
+        'is_image': message.is_image,
+        'timestamp': message.timestamp.strftime('%H:%M'),
+    }
@@ -0,0 +1,235 @@
+"""Channel layer between processes on one host, over Unix domain sockets.
+
+Used as the `transport` of LocalFirstChannelLayer when `manage.py runworkers`
+starts several workers. Every channel something receives on gets a socket
+`<path>/<channel>.sock`; senders connect to it directly. Group memberships
+are announced to every peer, so a group_send only writes to the processes
+that actually have members, and a room routed to one worker costs no IPC
+at all.
+"""
+import asyncio
+import logging
+import os
+import struct
+import time
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct('!I')
+SOCKET_SUFFIX = '.sock'
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = path
+        self.queues = {}
+        self.servers = {}
+        self.peers = set()
+        self.connections = {}
+        self.connecting = {}
+        self.members = {}
+        self.announced = set()
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        return f"{prefix}ipc{os.getpid()}!{os.urandom(6).hex()}"
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        if channel in self.servers:
+            self.put(channel, message)
+        else:
+            await self.write(channel, ['msg', channel, message])
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        await self.listen(channel)
+        queue = self.queue(channel)
+        while True:
+            expires, message = await queue.get()
+            if expires >= time.time():
+                return message
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.members.setdefault(group, set()).add(channel)
+        if (group, channel) not in self.announced:
+            self.announced.add((group, channel))
+            await self.broadcast(['add', group, channel])
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.forget(group, channel)
+        if (group, channel) in self.announced:
+            self.announced.discard((group, channel))
+            await self.broadcast(['discard', group, channel])
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        for channel in list(self.members.get(group, ())):
+            if channel in self.servers:
+                try:
+                    self.put(channel, message)
+                except ChannelFull:
+                    pass
+            else:
+                await self.write(channel, ['msg', channel, message])
+
+    # Flush extension
+
+    async def flush(self):
+        self.queues = {}
+        self.members = {}
+        self.announced = set()
+
+    async def close(self):
+        for writer in self.connections.values():
+            writer.close()
+        self.connections = {}
+        for channel, server in self.servers.items():
+            server.close()
+            try:
+                os.unlink(self.socket_path(channel))
+            except FileNotFoundError:
+                pass
+        self.servers = {}
+
+    # Local queues
+
+    def queue(self, channel):
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def put(self, channel, message):
+        try:
+            self.queue(channel).put_nowait((time.time() + self.expiry, message))
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+
+    def forget(self, group, channel):
+        members = self.members.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.members[group]
+
+    # Sockets
+
+    def socket_path(self, channel):
+        return os.path.join(self.path, channel + SOCKET_SUFFIX)
+
+    async def listen(self, channel):
+        if channel in self.servers:
+            return
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        path = self.socket_path(channel)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.servers[channel] = await asyncio.start_unix_server(self.serve, path=path)
+        # Find the peers already running, swap memberships with them.
+        self.peers.update(
+            name[:-len(SOCKET_SUFFIX)] for name in os.listdir(self.path)
+            if name.endswith(SOCKET_SUFFIX) and name[:-len(SOCKET_SUFFIX)] not in self.servers
+        )
+        await self.broadcast(['hello', channel])
+        for group, member in list(self.announced):
+            await self.broadcast(['add', group, member])
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                frame = msgpack.unpackb(await reader.readexactly(FRAME_HEADER.unpack(header)[0]))
+                await self.handle(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # The loop is shutting down; the peer sees the connection close.
+            pass
+        except Exception:
+            logger.exception("Dropping IPC connection after a bad frame")
+        finally:
+            writer.close()
+
+    async def handle(self, frame):
+        op = frame[0]
+        if op == 'msg':
+            _, channel, message = frame
+            if channel in self.servers:
+                try:
+                    self.put(channel, message)
+                except ChannelFull:
+                    logger.warning("Channel %s is full, dropping an IPC message", channel)
+        elif op == 'add':
+            _, group, channel = frame
+            self.peers.add(channel)
+            self.members.setdefault(group, set()).add(channel)
+        elif op == 'discard':
+            _, group, channel = frame
+            self.forget(group, channel)
+        elif op == 'hello':
+            peer = frame[1]
+            self.peers.add(peer)
+            for group, channel in list(self.announced):
+                await self.write(peer, ['add', group, channel])
+
+    async def broadcast(self, frame):
+        for peer in list(self.peers):
+            await self.write(peer, frame)
+
+    async def write(self, peer, frame):
+        data = msgpack.packb(frame)
+        try:
+            writer = await self.connection(peer)
+            writer.write(FRAME_HEADER.pack(len(data)) + data)
+            await writer.drain()
+        except ConnectionRefusedError:
+            # Nothing listens on it any more, the process that made it is gone.
+            self.drop_peer(peer)
+            try:
+                os.unlink(self.socket_path(peer))
+            except FileNotFoundError:
+                pass
+        except (FileNotFoundError, ConnectionError):
+            self.drop_peer(peer)
+
+    async def connection(self, peer):
+        writer = self.connections.get(peer)
+        if writer is not None and not writer.is_closing():
+            return writer
+        # One connection per peer, so frames to it stay in order.
+        lock = self.connecting.setdefault(peer, asyncio.Lock())
+        async with lock:
+            writer = self.connections.get(peer)
+            if writer is None or writer.is_closing():
+                _, writer = await asyncio.open_unix_connection(self.socket_path(peer))
+                self.connections[peer] = writer
+            return writer
+
+    def drop_peer(self, peer):
+        """A peer that cannot be reached has exited; forget it and its memberships."""
+        self.peers.discard(peer)
+        self.connecting.pop(peer, None)
+        writer = self.connections.pop(peer, None)
+        if writer is not None:
+            writer.close()
+        for group in list(self.members):
+            self.forget(group, peer)
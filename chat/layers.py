@@ -0,0 +1,255 @@
+"""A channel layer that delivers inside the process whenever it can.
+
+Channels created by this layer live in the process that created it. Sending
+to one of them, or to a group whose members are here, is a queue put with
+no serialization and no network round trip. Anything that has to cross
+processes goes through a second channel layer, the `transport` (usually
+channels_redis). Each process keeps one inbox channel on the transport and
+joins the transport's groups it has local members in.
+
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.LocalFirstChannelLayer',
+            'CONFIG': {
+                'capacity': 100,
+                'expiry': 60,
+                'transport': {
+                    'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                    'CONFIG': {'hosts': [...]},
+                },
+            },
+        },
+    }
+
+Leave `transport` out on a single-process install and nothing leaves the process.
+"""
+import asyncio
+import logging
+import re
+import time
+import uuid
+from collections import Counter
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, get_channel_layer
+from django.utils.module_loading import import_string
+
+from .metrics import Counter as CounterMetric, Gauge
+
+logger = logging.getLogger(__name__)
+
+NODE_INBOX_PREFIX = 'chatnode.'
+NODE_PATTERN = re.compile(r'(n[0-9a-f]{12})!')
+LAYER_EVENTS = ('local_deliveries', 'remote_sends', 'remote_deliveries', 'remote_echoes', 'expired', 'channel_full')
+
+
+class LocalFirstChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, transport=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.group_expiry = group_expiry
+        self.node_id = 'n' + uuid.uuid4().hex[:12]
+        self.inbox = NODE_INBOX_PREFIX + self.node_id
+        self.transport = None
+        if transport:
+            self.transport = import_string(transport['BACKEND'])(**transport.get('CONFIG', {}))
+        self.channels = {}
+        self.groups = {}
+        self.counters = Counter()
+        self._pump = None
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        return f"{prefix}{self.node_id}!{uuid.uuid4().hex[:12]}"
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        node = self.node_of(channel)
+        if node == self.node_id or (node is None and self.transport is None):
+            self.deliver(channel, message)
+            self.counters['local_deliveries'] += 1
+        elif node is None:
+            await self.transport.send(channel, message)
+            self.counters['remote_sends'] += 1
+        else:
+            await self.transport.send(NODE_INBOX_PREFIX + node, {'__channel__': channel, 'message': message})
+            self.counters['remote_sends'] += 1
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        node = self.node_of(channel)
+        if node is None and self.transport is not None:
+            return await self.transport.receive(channel)
+        if node is not None and node != self.node_id:
+            raise ValueError(f"Channel {channel} belongs to another process")
+        self.ensure_pump()
+        queue = self.queue(channel)
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+                self.counters['expired'] += 1
+        finally:
+            if queue.empty() and self.channels.get(channel) is queue:
+                del self.channels[channel]
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups.setdefault(group, {})[channel] = time.time()
+        if self.transport is not None:
+            # Re-joined on every local join, which also refreshes the transport's group expiry.
+            self.ensure_pump()
+            await self.transport.group_add(group, self.inbox)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.pop(channel, None)
+        if not members:
+            del self.groups[group]
+            if self.transport is not None:
+                await self.transport.group_discard(group, self.inbox)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        self.counters['local_deliveries'] += self.deliver_to_group(group, message)
+        if self.transport is not None:
+            # One publish per group, not per remote member; our own copy is dropped by the pump.
+            await self.transport.group_send(group, {'__group__': group, '__origin__': self.node_id, 'message': message})
+            self.counters['remote_sends'] += 1
+
+    # Flush extension
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+        if self.transport is not None and hasattr(self.transport, 'flush'):
+            await self.transport.flush()
+
+    async def close(self):
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = None
+        if self.transport is not None and hasattr(self.transport, 'close'):
+            await self.transport.close()
+
+    # Local delivery
+
+    def node_of(self, channel):
+        match = NODE_PATTERN.search(channel)
+        return match.group(1) if match else None
+
+    def queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def deliver(self, channel, message):
+        queue = self.queue(channel)
+        if queue.full():
+            self.drop_expired(channel, queue)
+        try:
+            # A shallow copy: receivers must not mutate nested values, which no consumer here does.
+            queue.put_nowait((time.time() + self.expiry, dict(message)))
+        except asyncio.QueueFull:
+            self.counters['channel_full'] += 1
+            raise ChannelFull(channel)
+
+    def drop_expired(self, channel, queue):
+        now = time.time()
+        dropped = 0
+        while not queue.empty() and queue._queue[0][0] < now:
+            queue.get_nowait()
+            dropped += 1
+        if dropped:
+            # Nobody is reading this channel any more; stop sending it group messages.
+            self.counters['expired'] += dropped
+            for members in self.groups.values():
+                members.pop(channel, None)
+
+    def deliver_to_group(self, group, message):
+        members = self.groups.get(group)
+        if not members:
+            return 0
+        stale_before = time.time() - self.group_expiry
+        delivered = 0
+        for channel, joined in list(members.items()):
+            if joined < stale_before:
+                members.pop(channel, None)
+                continue
+            try:
+                self.deliver(channel, message)
+            except ChannelFull:
+                continue
+            delivered += 1
+        return delivered
+
+    # Transport
+
+    def ensure_pump(self):
+        if self.transport is None:
+            return
+        if self._pump is not None and not self._pump.done() and self._pump.get_loop() is asyncio.get_running_loop():
+            return
+        self._pump = asyncio.ensure_future(self.pump())
+
+    async def pump(self):
+        """Move messages from this process's transport inbox onto the local channels."""
+        while True:
+            try:
+                envelope = await self.transport.receive(self.inbox)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Channel layer transport receive failed")
+                await asyncio.sleep(1)
+                continue
+            if '__group__' in envelope:
+                if envelope.get('__origin__') == self.node_id:
+                    self.counters['remote_echoes'] += 1
+                    continue
+                self.counters['remote_deliveries'] += self.deliver_to_group(envelope['__group__'], envelope['message'])
+            else:
+                try:
+                    self.deliver(envelope['__channel__'], envelope['message'])
+                except ChannelFull:
+                    continue
+                self.counters['remote_deliveries'] += 1
+
+    def metrics(self):
+        """Delivery counters for this process: local vs remote, expired and full-channel drops."""
+        return {
+            'node': self.node_id,
+            'local_channels': len(self.channels),
+            'groups': len(self.groups),
+            'queued_messages': sum(queue.qsize() for queue in self.channels.values()),
+            **{name: self.counters[name] for name in LAYER_EVENTS},
+        }
+
+
+def default_layer_metrics():
+    layer = get_channel_layer()
+    return layer.metrics() if isinstance(layer, LocalFirstChannelLayer) else {}
+
+
+Gauge('chat_channel_layer_channels', "Channels with a queue in this process.",
+      callback=lambda: default_layer_metrics().get('local_channels', 0))
+Gauge('chat_channel_layer_groups', "Groups with members in this process.",
+      callback=lambda: default_layer_metrics().get('groups', 0))
+Gauge('chat_channel_layer_queued_messages', "Messages waiting in this process's channel queues.",
+      callback=lambda: default_layer_metrics().get('queued_messages', 0))
+CounterMetric('chat_channel_layer_events_total', "Channel layer deliveries and drops, by kind.", ['event'],
+              callback=lambda: {name: value for name, value in default_layer_metrics().items()
+                                if name in LAYER_EVENTS})
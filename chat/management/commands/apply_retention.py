@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.archive import ARCHIVE_SEGMENT_MESSAGES
+from chat.retention import ORPHAN_GRACE_SECONDS, RETENTION_DAYS, archive_old_messages, clean_orphaned_files
+
+
+class Command(BaseCommand):
+    help = ("Move messages older than the retention period into compressed per-dialog archive segments, "
+            "then delete files under chat_files/ that nothing refers to.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=RETENTION_DAYS, help="Archive messages older than this.")
+        parser.add_argument('--segment-size', type=int, default=ARCHIVE_SEGMENT_MESSAGES,
+                            help="Messages per archive segment.")
+        parser.add_argument('--grace', type=int, default=ORPHAN_GRACE_SECONDS,
+                            help="Leave files younger than this many seconds alone.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Archive nothing and only report the files that would be removed.")
+        parser.add_argument('--skip-files', action='store_true', help="Only archive messages.")
+
+    def handle(self, *args, **options):
+        if not options['dry_run']:
+            start = time.perf_counter()
+            dialogs, messages = archive_old_messages(options['days'], options['segment_size'])
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f"Archived {messages} message(s) from {dialogs} dialog(s) in {elapsed:.1f}s "
+                              f"({messages / elapsed if elapsed else 0:.0f} messages/s).")
+        if not options['skip_files']:
+            removed = clean_orphaned_files(options['grace'], dry_run=options['dry_run'])
+            verb = "Would remove" if options['dry_run'] else "Removed"
+            self.stdout.write(f"{verb} {removed['blobs']} blob(s), {removed['uploads']} abandoned upload(s), "
+                              f"{removed['thumbnails']} thumbnail(s) and {removed['files']} other file(s).")
@@ -0,0 +1,129 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.shortcuts import render
+from django.test import RequestFactory
+from django.test.utils import setup_databases, teardown_databases
+from django.utils import timezone
+
+from chat.fragments import invalidate_sidebars
+from chat.management.commands.rebuild_conversations import rebuild
+from chat.models import Conversation, PrivateMessage, UserStatus
+from chat.views import chat_view
+
+
+def full_chat_view(request, username):
+    # The page as it was before fragments: every message, each sender loaded lazily, plus every user.
+    user = request.user
+    recipient = User.objects.get(username=username)
+    messages = PrivateMessage.objects.filter(
+        Q(sender=user, recipient=recipient) | Q(sender=recipient, recipient=user)
+    ).order_by('timestamp')
+    return render(request, 'chat/chat.html', {
+        'messages': messages,
+        'user': user,
+        'recipient': recipient,
+        'users': User.objects.all(),
+        'online_users': UserStatus.objects.filter(is_online=True),
+    })
+
+
+class Command(BaseCommand):
+    help = ("Measure time to first byte of the chat page for one long dialog in a throwaway test database: "
+            "the full server-side render against the shell page, with the sidebar fragment cold and cached.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=50_000, help="Messages in the dialog.")
+        parser.add_argument('--users', type=int, default=500, help="Other users listed in the sidebar.")
+        parser.add_argument('--requests', type=int, default=50, help="Page loads per variant.")
+        parser.add_argument('--full-requests', type=int, default=3,
+                            help="Page loads of the full render, which takes seconds each.")
+        parser.add_argument('--batch-size', type=int, default=10_000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.run(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def run(self, options):
+        rng = random.Random(options['seed'])
+        user = User.objects.create(username='page_bench_user')
+        recipient = User.objects.create(username='page_bench_admin', is_superuser=True)
+        others = User.objects.bulk_create([
+            User(username=f"page_bench_{i}", is_superuser=bool(i % 2)) for i in range(options['users'])
+        ])
+        UserStatus.objects.bulk_create([UserStatus(user=other, is_online=rng.random() < 0.3) for other in others])
+
+        start = time.perf_counter()
+        self.generate(rng, user, recipient, options['messages'], options['batch_size'])
+        rebuild(PrivateMessage, Conversation)
+        self.stdout.write(f"generated {options['messages']} messages in {time.perf_counter() - start:.1f}s")
+
+        factory = RequestFactory()
+
+        def page(view, cold=False):
+            def load():
+                if cold:
+                    invalidate_sidebars()
+                request = factory.get(f"/chat/{recipient.username}/")
+                request.user = user
+                return view(request, recipient.username)
+            return load
+
+        self.stdout.write(f"{'page':22} {'n':>4} {'p50 ms':>9} {'p99 ms':>9} {'queries':>8} {'kB':>8}")
+        self.report('full render', self.measure(page(full_chat_view), options['full_requests']))
+        self.report('shell, cold sidebar', self.measure(page(chat_view, cold=True), options['requests']))
+        self.report('shell, cached sidebar', self.measure(page(chat_view), options['requests']))
+
+    def generate(self, rng, user, recipient, count, batch_size):
+        dialog_key = PrivateMessage.make_dialog_key(user.pk, recipient.pk)
+        started = timezone.now() - timedelta(seconds=count)
+        for offset in range(0, count, batch_size):
+            batch = []
+            for i in range(offset, min(offset + batch_size, count)):
+                sender, other = (user, recipient) if rng.random() < 0.5 else (recipient, user)
+                batch.append(PrivateMessage(
+                    sender=sender,
+                    recipient=other,
+                    dialog_key=dialog_key,
+                    seq=i + 1,
+                    is_read=True,
+                    content=f"message {i} " + 'x' * rng.randint(10, 120),
+                    timestamp=started + timedelta(seconds=i),
+                ))
+            with transaction.atomic():
+                PrivateMessage.objects.bulk_create(batch)
+
+    def measure(self, load, count):
+        # The page is rendered whole before it is sent, so the first byte goes out when the view returns.
+        timings, queries, size = [], [0], 0
+
+        def count_query(execute, *args):
+            queries[0] += 1
+            return execute(*args)
+
+        for _ in range(count):
+            queries[0] = 0
+            # Not CaptureQueriesContext: the query log stops at 9000 entries and the full render runs more.
+            with connection.execute_wrapper(count_query):
+                start = time.perf_counter()
+                response = load()
+                timings.append((time.perf_counter() - start) * 1000)
+            size = len(response.content)
+        return timings, queries[0], size
+
+    def report(self, name, result):
+        timings, queries, size = result
+        timings.sort()
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        self.stdout.write(f"{name:22} {len(timings):4} {statistics.median(timings):9.1f} {p99:9.1f} "
+                          f"{queries:8} {size / 1024:8.1f}")
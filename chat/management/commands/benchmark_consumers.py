@@ -0,0 +1,111 @@
+import json
+import logging
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from chat.benchmarks import BENCHMARK_CACHES, BENCHMARK_CHANNEL_LAYERS, SCENARIOS, run_scenario
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the WebSocket consumers with simulated clients on an in-memory channel layer "
+            "and a throwaway test database, and print the results as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                            help="Scenario to run, may be repeated. Defaults to all of them.")
+        parser.add_argument('--clients', type=int, default=1000, help="Simulated clients per scenario.")
+        parser.add_argument('--messages', type=int, default=10, help="Messages sent per client.")
+        parser.add_argument('--watchers', type=int, default=50, help="Superusers watching online status.")
+        parser.add_argument('--screenshare-rooms', type=int, nargs='+', default=[1, 10, 100],
+                            help="Room counts for the screen-share scenario, one run per value.")
+        parser.add_argument('--screenshare-peers', type=int, default=2, help="Peers per screen-share room.")
+        parser.add_argument('--fanout-watchers', type=int, nargs='+', default=[10, 100, 1000],
+                            help="Group sizes for the fan-out scenario, one run per value.")
+        parser.add_argument('--fanout-broadcasts', type=int, default=20, help="Broadcasts per fan-out run.")
+        parser.add_argument('--layer', choices=sorted(BENCHMARK_CHANNEL_LAYERS), default='inmemory',
+                            help="Channel layer to run the consumers on.")
+        parser.add_argument('--trace-memory', action='store_true',
+                            help="Also report tracemalloc peaks (slows the run down).")
+        parser.add_argument('--log-level', default='WARNING',
+                            help="Level for the chat loggers while benchmarking; per-message INFO logs skew results.")
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+        parser.add_argument('--compare', help="Earlier JSON report to print throughput/latency deltas against.")
+
+    def scenario_options(self, name, options):
+        clients, messages = options['clients'], options['messages']
+        return {
+            'private_chat': {'pairs': max(1, clients // 2), 'messages': messages},
+            'notifications': {'clients': clients, 'messages': messages},
+            'online_status': {'watchers': options['watchers'], 'clients': clients},
+        }[name]
+
+    def runs(self, names, options):
+        for name in names:
+            if name == 'screenshare':
+                for rooms in options['screenshare_rooms']:
+                    yield name, {'rooms': rooms, 'peers': options['screenshare_peers'], 'signals': options['messages']}
+            elif name == 'fanout':
+                for watchers in options['fanout_watchers']:
+                    yield name, {'watchers': watchers, 'broadcasts': options['fanout_broadcasts']}
+            else:
+                yield name, self.scenario_options(name, options)
+
+    def handle(self, *args, **options):
+        names = options['scenario'] or list(SCENARIOS)
+        results = []
+        logging.getLogger('chat').setLevel(options['log_level'])
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(CACHES=BENCHMARK_CACHES, CHANNEL_LAYERS=BENCHMARK_CHANNEL_LAYERS[options['layer']]):
+                for name, scenario_options in self.runs(names, options):
+                    self.stderr.write(f"Running {name} {scenario_options}...")
+                    results.append(run_scenario(name, trace_memory=options['trace_memory'], **scenario_options))
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        report = {
+            'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'options': {key: options[key] for key in (
+                'clients', 'messages', 'watchers', 'screenshare_rooms', 'screenshare_peers',
+                'fanout_watchers', 'fanout_broadcasts', 'layer',
+            )},
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as file:
+                self.print_comparison(json.load(file), report)
+
+    def print_comparison(self, before, after):
+        previous = {result['scenario']: result for result in before['results']}
+        for result in after['results']:
+            old = previous.get(result['scenario'])
+            if old is None:
+                continue
+            self.stderr.write(
+                f"{result['scenario']}: "
+                f"{self.change(old['messages_per_s'], result['messages_per_s'])} msg/s, "
+                f"p99 {self.change(old['latency_ms']['p99'], result['latency_ms']['p99'])} ms"
+            )
+
+    def change(self, old, new):
+        if not old or new is None:
+            return f"{old} -> {new}"
+        return f"{old} -> {new} ({(new - old) / old:+.1%})"
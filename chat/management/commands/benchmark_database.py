@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+
+from chat.database import db_read, db_write
+from chat.models import PrivateMessage
+from chat.persistence import MessageWriter
+
+SETUPS = {
+    # Before: the stock configuration, every call on whichever pool thread is free.
+    'default': "default, thread pool",
+    'tuned-pool': "tuned, thread pool",
+    'tuned-writer': "tuned, writer thread",
+    # What the chat consumers do: MessageWriter batches, written on the writer thread.
+    'tuned-batched': "tuned, batched writer",
+}
+
+
+def write_message(sender_id, recipient_id, content):
+    # The model's own save: seq allocation, the message and the conversation counters in one transaction.
+    return PrivateMessage.objects.create(sender_id=sender_id, recipient_id=recipient_id, content=content)
+
+
+def read_history(dialog_key):
+    return list(PrivateMessage.objects.filter(dialog_key=dialog_key).order_by('-id')[:50])
+
+
+class Command(BaseCommand):
+    help = ("Compare concurrent message writes, with history reads running alongside, on a default SQLite "
+            "setup and on the tuned one from settings (WAL, one writer thread, a reader pool). Each setup "
+            "runs in its own process on a fresh database.")
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help="Messages written per run.")
+        parser.add_argument('--writers', type=int, default=50, help="Concurrent clients writing.")
+        parser.add_argument('--readers', type=int, default=8, help="Concurrent clients reading history meanwhile.")
+        parser.add_argument('--reads', type=int, default=2000, help="History reads per run.")
+        parser.add_argument('--threads', type=int, default=8,
+                            help="Threads that writes and reads share when they are not on chat.database's.")
+        parser.add_argument('--setup', choices=sorted(SETUPS), help="Run one setup here and print it as JSON.")
+        parser.add_argument('--database', help="Database file for --setup.")
+
+    def handle(self, *args, **options):
+        if options['setup']:
+            self.use_database(options['database'], tuned=options['setup'] != 'default')
+            result = asyncio.run(self.run(options['setup'], options))
+            self.stdout.write(json.dumps(result))
+            return
+
+        self.stdout.write(f"{options['messages']} messages from {options['writers']} writers, "
+                          f"{options['reads']} reads from {options['readers']} readers")
+        self.stdout.write(f"{'setup':22} {'writes/s':>9} {'reads/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'locked':>7}")
+        directory = tempfile.mkdtemp(prefix='chat-dbbench-')
+        try:
+            for setup, name in SETUPS.items():
+                output = subprocess.run([
+                    sys.executable, sys.argv[0], 'benchmark_database', '--setup', setup,
+                    '--database', os.path.join(directory, f"{setup}.sqlite3"),
+                    *(f"--{option}={options[option]}" for option in ('messages', 'writers', 'readers', 'reads', 'threads')),
+                ], check=True, capture_output=True, text=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                self.stdout.write(f"{name:22} {result['writes']:9.0f} {result['reads']:9.0f} "
+                                  f"{result['p50'] * 1000:8.2f} {result['p99'] * 1000:8.2f} {result['locked']:7}")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def use_database(self, path, tuned):
+        config = dict(settings.DATABASES['default'], NAME=path)
+        if not tuned:
+            config.update(OPTIONS={}, CONN_MAX_AGE=0)
+        connections.settings['default'] = connections.configure_settings({'default': config})['default']
+        try:
+            # Made with the old settings while the command started; the next access makes a new one.
+            del connections['default']
+        except AttributeError:
+            pass
+        call_command('migrate', verbosity=0)
+        if not tuned:
+            # The migrations switch the file to WAL; the baseline keeps SQLite's default journal.
+            with connections['default'].cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode=DELETE")
+
+    async def run(self, setup, options):
+        pool = ThreadPoolExecutor(max_workers=options['threads'])
+        message_writer = None
+        if setup == 'tuned-batched':
+            message_writer = MessageWriter()
+
+            async def write(sender_id, recipient_id, content):
+                return await (await message_writer.submit(sender_id, recipient_id, content))
+
+            read = db_read(read_history)
+        elif setup == 'tuned-writer':
+            write, read = db_write(write_message), db_read(read_history)
+        else:
+            write = sync_to_async(write_message, thread_sensitive=False, executor=pool)
+            read = sync_to_async(read_history, thread_sensitive=False, executor=pool)
+
+        users = await db_write(self.create_users)(options['writers'] * 2)
+        pairs = [(users[i], users[i + 1]) for i in range(0, len(users), 2)]
+        latencies, locked, reads = [], 0, 0
+
+        async def writer(sender_id, recipient_id, count):
+            nonlocal locked
+            for i in range(count):
+                start = time.perf_counter()
+                try:
+                    await write(sender_id, recipient_id, f"message {i}")
+                except OperationalError:
+                    locked += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        async def reader(dialog_key, count):
+            nonlocal locked, reads
+            for _ in range(count):
+                try:
+                    await read(dialog_key)
+                except OperationalError:
+                    locked += 1
+                    continue
+                reads += 1
+
+        # A fixed amount of both, so a setup cannot trade one for the other.
+        per_writer = split(options['messages'], len(pairs))
+        per_reader = split(options['reads'], options['readers'])
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(writer(*pair, count) for pair, count in zip(pairs, per_writer)),
+            *(reader(PrivateMessage.make_dialog_key(*pairs[i % len(pairs)]), count)
+              for i, count in enumerate(per_reader)),
+        )
+        elapsed = time.perf_counter() - start
+        if message_writer is not None:
+            await message_writer.aclose()
+        pool.shutdown()
+        latencies.sort()
+        return {
+            'writes': len(latencies) / elapsed,
+            'reads': reads / elapsed,
+            'p50': statistics.median(latencies) if latencies else 0,
+            'p99': latencies[int(len(latencies) * 0.99) - 1] if latencies else 0,
+            'locked': locked,
+        }
+
+    @staticmethod
+    def create_users(count):
+        users = User.objects.bulk_create([User(username=f"bench_db_{i}") for i in range(count)])
+        return [user.pk for user in users]
+
+
+def split(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
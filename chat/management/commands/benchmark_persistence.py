@@ -0,0 +1,67 @@
+import asyncio
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from chat.models import PrivateMessage
+from chat.persistence import MessageWriter
+
+
+class Command(BaseCommand):
+    help = "Compare per-message saves with the batched MessageWriter pipeline."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--clients', type=int, default=50, help="Concurrent simulated consumers.")
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        suffix = uuid.uuid4().hex[:8]
+        sender = User.objects.create(username=f"bench_sender_{suffix}")
+        recipient = User.objects.create(username=f"bench_recipient_{suffix}")
+        try:
+            count, clients = options['messages'], options['clients']
+            per_message = asyncio.run(self.run_per_message(sender.username, recipient.username, count, clients))
+            batched = asyncio.run(
+                self.run_batched(sender.username, recipient.username, count, clients, options['batch_size'])
+            )
+            self.stdout.write(f"per-message: {per_message:10.1f} msg/s")
+            self.stdout.write(f"batched:     {batched:10.1f} msg/s ({batched / per_message:.1f}x)")
+        finally:
+            User.objects.filter(pk__in=[sender.pk, recipient.pk]).delete()
+
+    async def run_per_message(self, sender, recipient, count, clients):
+        @sync_to_async
+        def save_message(content):
+            # The previous PrivateChatConsumer.save_message path.
+            sender_user = User.objects.get(username=sender)
+            recipient_user = User.objects.get(username=recipient)
+            return PrivateMessage.objects.create(sender=sender_user, recipient=recipient_user, content=content)
+
+        async def client(n):
+            for i in range(n):
+                await save_message(f"per-message {i}")
+
+        return await self.timed(count, [client(n) for n in self.split(count, clients)])
+
+    async def run_batched(self, sender, recipient, count, clients, batch_size):
+        writer = MessageWriter(batch_size=batch_size)
+
+        async def client(n):
+            saved = [await writer.submit(sender, recipient, f"batched {i}") for i in range(n)]
+            await asyncio.gather(*saved)
+
+        rate = await self.timed(count, [client(n) for n in self.split(count, clients)])
+        await writer.aclose()
+        return rate
+
+    async def timed(self, count, coroutines):
+        start = time.perf_counter()
+        await asyncio.gather(*coroutines)
+        return count / (time.perf_counter() - start)
+
+    def split(self, count, clients):
+        return [count // clients + (1 if i < count % clients else 0) for i in range(clients)]
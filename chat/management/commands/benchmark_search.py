@@ -0,0 +1,103 @@
+import itertools
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.test.utils import setup_databases, teardown_databases
+
+from chat.models import PrivateMessage
+from chat.search import fts_installed, inverted_index, search_messages
+
+
+class Command(BaseCommand):
+    help = ("Measure message search latency on a generated corpus in a throwaway test database, "
+            "comparing the FTS5 index, the in-process fallback and a LIKE scan.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000)
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--vocabulary', type=int, default=20_000, help="Distinct words in the corpus.")
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--batch-size', type=int, default=10_000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.run(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def run(self, options):
+        rng = random.Random(options['seed'])
+        words = [self.word(rng) for _ in range(options['vocabulary'])]
+        # Word frequencies roughly follow Zipf's law, as in real chat text.
+        weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+        users = User.objects.bulk_create([User(username=f"search_bench_{i}") for i in range(options['users'])])
+
+        start = time.perf_counter()
+        self.generate(rng, users, words, weights, options['messages'], options['batch_size'])
+        self.stdout.write(f"generated {options['messages']} messages in {time.perf_counter() - start:.1f}s "
+                          f"(fts5 index: {'yes' if fts_installed() else 'no'})")
+
+        queries = [
+            (rng.choice(users), ' '.join(rng.choices(words[:2000], k=rng.randint(1, 2))))
+            for _ in range(options['queries'])
+        ]
+        if fts_installed():
+            self.report('fts5', self.measure(queries, search_messages))
+
+        start = time.perf_counter()
+        # Index the whole corpus, not just the newest CHAT_SEARCH_FALLBACK_MAX_MESSAGES.
+        inverted_index.max_documents = max(inverted_index.max_documents, options['messages'])
+        inverted_index.catch_up()
+        self.stdout.write(f"fallback index built in {time.perf_counter() - start:.1f}s")
+        self.report('fallback', self.measure(queries, self.fallback_search))
+        self.report('like', self.measure(queries[:max(1, len(queries) // 10)], self.like_search))
+
+    def generate(self, rng, users, words, weights, count, batch_size):
+        for offset in range(0, count, batch_size):
+            batch = []
+            for _ in range(min(batch_size, count - offset)):
+                sender, recipient = rng.sample(users, 2)
+                batch.append(PrivateMessage(
+                    sender=sender,
+                    recipient=recipient,
+                    dialog_key=PrivateMessage.make_dialog_key(sender.pk, recipient.pk),
+                    content=' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(3, 20))),
+                ))
+            with transaction.atomic():
+                PrivateMessage.objects.bulk_create(batch)
+
+    def fallback_search(self, user, query):
+        return search_messages(user, query, use_fts=False)
+
+    def like_search(self, user, query):
+        # What a naive implementation would do: a scan over every message.
+        messages = PrivateMessage.objects.filter(
+            Q(sender=user) | Q(recipient=user), content__icontains=query.split()[0],
+        )
+        return list(messages.order_by('-timestamp')[:20]), None
+
+    def measure(self, queries, search):
+        timings = []
+        for user, query in queries:
+            start = time.perf_counter()
+            search(user, query)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def report(self, name, timings):
+        timings.sort()
+        percentile = lambda p: timings[min(len(timings) - 1, int(len(timings) * p))]
+        self.stdout.write(
+            f"{name:9} n={len(timings):4}  mean {statistics.mean(timings):8.2f} ms  "
+            f"p50 {percentile(0.5):8.2f}  p95 {percentile(0.95):8.2f}  p99 {percentile(0.99):8.2f}"
+        )
+
+    def word(self, rng):
+        return ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(3, 9)))
@@ -0,0 +1,92 @@
+import random
+import time
+import zlib
+
+from django.core.management.base import BaseCommand
+
+from chat.wire import CODECS, FrameCache, stamp
+
+
+class Command(BaseCommand):
+    help = ("Compare the WebSocket subprotocols: bytes on the wire, encode CPU per event, "
+            "encode-once fan-out and the effect of permessage-deflate.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=20_000, help="Events encoded per codec.")
+        parser.add_argument('--recipients', type=int, nargs='+', default=[1, 10, 100, 1000],
+                            help="Group sizes for the fan-out comparison.")
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        events = [self.event(rng, i) for i in range(options['events'])]
+        self.stdout.write(f"codecs: {', '.join(CODECS)}")
+        self.stdout.write(f"{'codec':16} {'bytes/event':>11} {'deflate':>9} {'deflate-nct':>11} "
+                          f"{'encode us':>9} {'decode us':>9}")
+        for codec in CODECS.values():
+            self.report_codec(codec, events)
+
+        self.stdout.write("\nfan-out, encode CPU per broadcast (us):")
+        self.stdout.write(f"{'codec':16} {'recipients':>10} {'per socket':>10} {'encode once':>11}")
+        for codec in CODECS.values():
+            for recipients in options['recipients']:
+                self.report_fanout(codec, events[:max(1, 20_000 // recipients)], recipients)
+
+    def event(self, rng, i):
+        kind = rng.random()
+        if kind < 0.8:
+            words = rng.randint(2, 30)
+            return {
+                'type': 'chat_message', 'id': 100_000 + i, 'seq': i + 1,
+                'message': ' '.join(rng.choice(('hi', 'ok', 'see', 'you', 'later', 'thanks', 'meeting',
+                                                'tomorrow', 'at', 'the', 'office')) for _ in range(words)),
+                'file_url': None, 'sender': 'alice', 'recipient': 'bob',
+            }
+        if kind < 0.9:
+            return {'type': 'read_receipt', 'reader': 'bob', 'up_to': 100_000 + i}
+        return {
+            'type': 'status_batch',
+            'changes': [{'user_id': n, 'username': f"user{n}", 'is_online': rng.random() < 0.5}
+                        for n in rng.sample(range(5000), rng.randint(1, 20))],
+        }
+
+    def report_codec(self, codec, events):
+        start = time.perf_counter()
+        frames = [codec.encode(event) for event in events]
+        encode = (time.perf_counter() - start) / len(events) * 1e6
+        raw = [frame if isinstance(frame, bytes) else frame.encode() for frame in frames]
+        start = time.perf_counter()
+        for frame in frames:
+            codec.decode(frame)
+        decode = (time.perf_counter() - start) / len(events) * 1e6
+        size = sum(map(len, raw)) / len(raw)
+        self.stdout.write(f"{codec.name:16} {size:11.1f} {self.deflated(raw, True):9.1f} "
+                          f"{self.deflated(raw, False):11.1f} {encode:9.2f} {decode:9.2f}")
+
+    def deflated(self, frames, context_takeover):
+        # permessage-deflate is raw deflate with a sync flush per message; with context
+        # takeover the window carries over between messages on the same socket.
+        compressor = zlib.compressobj(wbits=-15)
+        total = 0
+        for frame in frames:
+            if not context_takeover:
+                compressor = zlib.compressobj(wbits=-15)
+            # The trailing 00 00 ff ff of the flush is not sent (RFC 7692).
+            total += len(compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+        return total / len(frames)
+
+    def report_fanout(self, codec, events, recipients):
+        start = time.perf_counter()
+        for event in events:
+            for _ in range(recipients):
+                codec.encode(event)
+        per_socket = (time.perf_counter() - start) / len(events) * 1e6
+
+        cache = FrameCache()
+        stamped = [stamp(dict(event)) for event in events]
+        start = time.perf_counter()
+        for event in stamped:
+            for _ in range(recipients):
+                cache.encode(codec, event)
+        once = (time.perf_counter() - start) / len(events) * 1e6
+        self.stdout.write(f"{codec.name:16} {recipients:10} {per_socket:10.1f} {once:11.1f}")
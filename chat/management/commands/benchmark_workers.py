@@ -0,0 +1,181 @@
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.signaling import room_group_name
+from chat.workers import WorkerPool, worker_for_room
+
+
+class WebSocketClient:
+    """Just enough of RFC 6455 to drive the workers from a load generator."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host, port, path):
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+        ).encode())
+        status = (await reader.readuntil(b"\r\n\r\n")).split(b"\r\n", 1)[0]
+        if b" 101 " not in status:
+            raise ConnectionError(f"Handshake failed: {status!r}")
+        return cls(reader, writer)
+
+    async def send_text(self, text):
+        payload = text.encode()
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x81, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x81, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x81, 0x80 | 127, length)
+        key = int.from_bytes((mask * (length // 4 + 1))[:length], 'big')
+        masked = (int.from_bytes(payload, 'big') ^ key).to_bytes(length, 'big')
+        self.writer.write(header + mask + masked)
+        await self.writer.drain()
+
+    async def receive_text(self):
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7f
+            if length == 126:
+                length, = struct.unpack('!H', await self.reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', await self.reader.readexactly(8))
+            payload = await self.reader.readexactly(length)
+            opcode = first & 0x0f
+            if opcode == 0x8:
+                raise ConnectionError("Closed by the server")
+            if opcode == 0x1:
+                return payload.decode()
+
+    def close(self):
+        self.writer.close()
+
+
+async def drive_rooms(host, port, workers, sticky, rooms, peers, signals):
+    """Connect `peers` sockets to each room, then have every peer broadcast `signals` offers."""
+    def port_for(room):
+        if not sticky:
+            return port
+        return port + 1 + worker_for_room(room_group_name(room), workers)
+
+    start = time.perf_counter()
+    clients = []
+    for room in rooms:
+        for _ in range(peers):
+            client = await WebSocketClient.connect(host, port_for(room), f"/ws/screenshare/{room}/")
+            await client.receive_text()  # welcome
+            clients.append(client)
+    connect_seconds = time.perf_counter() - start
+    expected = signals * (peers - 1)
+
+    async def send(client, index):
+        for n in range(signals):
+            await client.send_text(json.dumps({'offer': f"{index}:{n}"}))
+
+    async def receive(client):
+        received = 0
+        while received < expected:
+            if 'offer' in json.loads(await client.receive_text()):
+                received += 1
+        return received
+
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(send(client, index) for index, client in enumerate(clients)),
+        *(receive(client) for client in clients),
+    )
+    message_seconds = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    return {
+        'connections': len(clients),
+        'connect_seconds': connect_seconds,
+        'delivered': sum(results[len(clients):]),
+        'message_seconds': message_seconds,
+    }
+
+
+def run_client(args):
+    return asyncio.run(drive_rooms(*args))
+
+
+def wait_for_worker(pool, host, port, timeout=30):
+    # The launcher already holds the listening socket, so wait for an actual HTTP response.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if any(process.poll() is not None for process in pool.processes):
+            raise CommandError("A worker exited during startup")
+        try:
+            with socket.create_connection((host, port), timeout=1) as sock:
+                sock.sendall(b"GET / HTTP/1.0\r\n\r\n")
+                if sock.recv(1):
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError(f"Workers did not come up on {host}:{port}")
+
+
+class Command(BaseCommand):
+    help = ("Start `runworkers` pools of increasing size and measure how connection setup and "
+            "screen-share signaling throughput scale, with and without sticky room routing.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+        parser.add_argument('--routing', choices=['sticky', 'shared', 'both'], default='both')
+        parser.add_argument('--rooms', type=int, default=200)
+        parser.add_argument('--peers', type=int, default=2, help="Sockets per room.")
+        parser.add_argument('--signals', type=int, default=20, help="Broadcasts per socket.")
+        parser.add_argument('--client-processes', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=18000)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"cores: {os.cpu_count()}  rooms: {options['rooms']}  peers: {options['peers']}  "
+                          f"signals: {options['signals']}")
+        self.stdout.write(f"{'workers':>7} {'routing':>8} {'conn/s':>9} {'msg/s':>10}")
+        routings = ['sticky', 'shared'] if options['routing'] == 'both' else [options['routing']]
+        for workers in options['workers']:
+            for routing in routings:
+                if routing == 'sticky' and workers == 1 and 'shared' in routings:
+                    continue
+                result = self.measure(workers, routing == 'sticky', options)
+                self.stdout.write(f"{workers:>7} {routing:>8} {result['connections_per_s']:>9.0f} "
+                                  f"{result['messages_per_s']:>10.0f}")
+
+    def measure(self, workers, sticky, options):
+        host, port = options['host'], options['port']
+        pool = WorkerPool('chat_project.asgi:application', workers, host=host, port=port, sticky=sticky,
+                          server_args=['-v', '0'], env={'CHAT_LOG_LEVEL': 'WARNING'})
+        pool.start()
+        try:
+            wait_for_worker(pool, host, port)
+            for index in range(workers if pool.sticky else 0):
+                wait_for_worker(pool, host, port + 1 + index)
+            rooms = [f"bench{room}" for room in range(options['rooms'])]
+            processes = max(1, min(options['client_processes'], len(rooms)))
+            jobs = [(host, port, workers, pool.sticky, rooms[index::processes], options['peers'], options['signals'])
+                    for index in range(processes)]
+            with multiprocessing.get_context('fork').Pool(processes) as clients:
+                results = clients.map(run_client, jobs)
+        finally:
+            pool.stop()
+        return {
+            'connections_per_s': sum(r['connections'] for r in results) / max(r['connect_seconds'] for r in results),
+            'messages_per_s': sum(r['delivered'] for r in results) / max(r['message_seconds'] for r in results),
+        }
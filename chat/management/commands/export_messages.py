@@ -0,0 +1,48 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.export import CONTENT_TYPES, EXPORT_CHUNK_SIZE, export_chunks, export_pages
+
+
+class Command(BaseCommand):
+    help = ("Stream messages, archived ones included, as NDJSON or CSV: everything, one user's dialogs "
+            "(--user) or one dialog (--user and --with).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help="Only this user's dialogs.")
+        parser.add_argument('--with', dest='other', help="Only the dialog between --user and this user.")
+        parser.add_argument('--format', choices=sorted(CONTENT_TYPES), default='ndjson')
+        parser.add_argument('-o', '--output', help="File to write to instead of stdout.")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help="Messages per query.")
+
+    def handle(self, *args, **options):
+        if options['other'] and not options['user']:
+            raise CommandError("--with needs --user")
+        try:
+            user = User.objects.get(username=options['user']) if options['user'] else None
+            other = User.objects.get(username=options['other']) if options['other'] else None
+        except User.DoesNotExist as e:
+            raise CommandError(e)
+
+        total = 0
+
+        def counted(pages):
+            nonlocal total
+            for page in pages:
+                total += len(page)
+                yield page
+
+        chunks = export_chunks(options['format'], counted(export_pages(user, other, options['chunk_size'])))
+        start = time.perf_counter()
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+        elapsed = time.perf_counter() - start
+        # stderr, since stdout may be the export itself.
+        self.stderr.write(f"Exported {total} message(s) in {elapsed:.1f}s "
+                          f"({total / elapsed if elapsed else 0:.0f} messages/s).")
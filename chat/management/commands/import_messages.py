@@ -0,0 +1,45 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.export import CONTENT_TYPES, IMPORT_BATCH_SIZE, import_records, read_records
+
+
+class Command(BaseCommand):
+    help = ("Load an NDJSON or CSV export from export_messages, inserting a batch at a time. Messages get new ids "
+            "and seqs, appended after each dialog's existing ones; those whose sender or recipient has no account "
+            "here, or that are already stored with the same sender, timestamp and content, are skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Export file, or - for stdin.")
+        parser.add_argument('--format', choices=sorted(CONTENT_TYPES),
+                            help="Defaults to csv for .csv files and ndjson otherwise.")
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+        parser.add_argument('--progress-every', type=int, default=100_000,
+                            help="Report progress every this many records; 0 for only the total.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+        stream = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+        imported = skipped = 0
+        reported = 0
+        start = time.perf_counter()
+        try:
+            for batch_imported, batch_skipped in import_records(read_records(stream, format), options['batch_size']):
+                imported += batch_imported
+                skipped += batch_skipped
+                if options['progress_every'] and imported + skipped - reported >= options['progress_every']:
+                    reported = imported + skipped
+                    self.stdout.write(f"{reported} record(s), {self.rate(reported, start):.0f} records/s")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        self.stdout.write(f"Imported {imported} message(s), skipped {skipped}, in {time.perf_counter() - start:.1f}s "
+                          f"({self.rate(imported + skipped, start):.0f} records/s).")
+
+    @staticmethod
+    def rate(count, start):
+        elapsed = time.perf_counter() - start
+        return count / elapsed if elapsed else 0
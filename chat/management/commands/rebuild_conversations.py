@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+
+from chat.models import Conversation, PrivateMessage, message_preview
+
+
+def rebuild(message_model, conversation_model, batch_size=1000):
+    """Recompute every conversation summary from the messages table.
+
+    Takes the models as arguments so migrations can run it on historical models;
+    columns those models do not have yet are skipped.
+    """
+    conversation_fields = {field.name for field in conversation_model._meta.get_fields()}
+
+    unread = {}
+    unread_rows = message_model.objects.filter(is_read=False).order_by() \
+        .values('dialog_key', 'recipient_id').annotate(count=Count('id'))
+    for row in unread_rows:
+        unread[(row['dialog_key'], row['recipient_id'])] = row['count']
+
+    last_seqs = {}
+    if 'last_seq' in conversation_fields:
+        last_seqs = dict(
+            message_model.objects.exclude(dialog_key='').order_by()
+            .values('dialog_key').annotate(last=Max('seq')).values_list('dialog_key', 'last')
+        )
+
+    read_up_to = {}
+    if 'read_up_to_low' in conversation_fields:
+        read_rows = message_model.objects.filter(is_read=True).order_by() \
+            .values('dialog_key', 'recipient_id').annotate(last=Max('id'))
+        for row in read_rows:
+            read_up_to[(row['dialog_key'], row['recipient_id'])] = row['last']
+
+    conversations = []
+    dialog_keys = message_model.objects.exclude(dialog_key='').order_by() \
+        .values_list('dialog_key', flat=True).distinct()
+    for dialog_key in dialog_keys.iterator():
+        last = message_model.objects.filter(dialog_key=dialog_key).order_by('-timestamp', '-id').first()
+        low, high = (int(user_id) for user_id in dialog_key.split(':'))
+        extra = {}
+        if 'read_up_to_low' in conversation_fields:
+            extra.update(
+                read_up_to_low=read_up_to.get((dialog_key, low), 0),
+                read_up_to_high=read_up_to.get((dialog_key, high), 0),
+            )
+        if 'last_seq' in conversation_fields:
+            extra['last_seq'] = last_seqs.get(dialog_key) or 0
+        conversations.append(conversation_model(
+            dialog_key=dialog_key,
+            user_low_id=low,
+            user_high_id=high,
+            last_message_id=last.pk,
+            last_sender_id=last.sender_id,
+            last_message_preview=message_preview(last),
+            last_message_at=last.timestamp,
+            unread_low=unread.get((dialog_key, low), 0),
+            unread_high=unread.get((dialog_key, high), 0),
+            **extra,
+        ))
+
+    with transaction.atomic():
+        conversation_model.objects.all().delete()
+        conversation_model.objects.bulk_create(conversations, batch_size=batch_size)
+    return len(conversations)
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Conversation summary table from PrivateMessage."
+
+    def handle(self, *args, **options):
+        count = rebuild(PrivateMessage, Conversation)
+        self.stdout.write(f"Rebuilt {count} conversation(s).")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat.search import FTS_TABLE, fts_installed, fts_supported, install_fts, inverted_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the FTS5 message search index (and its triggers) from PrivateMessage."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--optimize', action='store_true', help="Merge the index b-trees after rebuilding.")
+
+    def handle(self, *args, **options):
+        if not fts_supported():
+            # Nothing persistent to rebuild; each process builds the fallback index on first search.
+            inverted_index.catch_up()
+            self.stdout.write(f"FTS5 is not available, indexed {inverted_index.documents} message(s) in memory.")
+            return
+        created = not fts_installed()
+        install_fts()
+        if options['optimize']:
+            with connection.cursor() as cursor:
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+        self.stdout.write(f"{'Created' if created else 'Rebuilt'} the {FTS_TABLE} index.")
@@ -0,0 +1,19 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from chat.presence import PRESENCE_STALE_AFTER, reconcile_stale_statuses, send_presence_changes
+
+
+class Command(BaseCommand):
+    help = "Mark users offline whose presence heartbeat has gone stale, e.g. after a worker crash."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-after', type=int, default=PRESENCE_STALE_AFTER,
+                            help="Seconds without a heartbeat before a user counts as offline.")
+
+    def handle(self, *args, **options):
+        changes = reconcile_stale_statuses(options['stale_after'])
+        if changes:
+            async_to_sync(send_presence_changes)(get_channel_layer(), changes)
+        self.stdout.write(f"Marked {len(changes)} stale user(s) offline.")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat.notifications import reconcile_unread_counters
+
+
+class Command(BaseCommand):
+    help = "Correct cached unread counters that have drifted from their Conversation rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = reconcile_unread_counters(options['batch_size'])
+        self.stdout.write(f"Corrected {count} unread counter(s).")
@@ -0,0 +1,50 @@
+import json
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.utils.dateparse import parse_datetime
+
+from chat.models import PrivateMessage
+from chat.persistence import restore_messages
+from chat.utils import MESSAGE_LOG_DIR, iter_message_log
+
+
+class Command(BaseCommand):
+    help = ("Stream the NDJSON message log, either to stdout (audit export) "
+            "or back into the database (--import), without loading it into memory.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', default=MESSAGE_LOG_DIR)
+        parser.add_argument('--start-segment', type=int, help="First segment number to read.")
+        parser.add_argument('--follow', action='store_true', help="Keep waiting for new records, like tail -f.")
+        parser.add_argument('--import', dest='import_records', action='store_true',
+                            help="Insert records into PrivateMessage with their ids and seqs, skipping ids and seqs "
+                                 "that already exist.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        records = iter_message_log(options['directory'], options['start_segment'], follow=options['follow'])
+        if not options['import_records']:
+            for record in records:
+                self.stdout.write(json.dumps(record))
+            return
+
+        total = restored = 0
+        while True:
+            batch = list(islice(records, options['batch_size']))
+            if not batch:
+                break
+            restored += len(restore_messages([
+                PrivateMessage(
+                    id=record['id'],
+                    sender_id=record['sender_id'],
+                    recipient_id=record['recipient_id'],
+                    dialog_key=record['dialog_key'],
+                    seq=record.get('seq'),
+                    content=record['content'],
+                    file=record['file'] or '',
+                    timestamp=parse_datetime(record['timestamp']),
+                ) for record in batch
+            ]))
+            total += len(batch)
+        self.stdout.write(f"Replayed {total} record(s), {restored} new.")
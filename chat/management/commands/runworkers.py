@@ -0,0 +1,45 @@
+import os
+import signal
+
+from django.core.management.base import BaseCommand
+
+from chat.retention import RETENTION_INTERVAL
+from chat.workers import WorkerPool
+
+
+class Command(BaseCommand):
+    help = ("Run several Daphne workers on one port with SO_REUSEPORT. Chat rooms are routed to a fixed "
+            "worker through per-worker sticky ports, and workers reach each other over Unix sockets.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('-b', '--bind', default='127.0.0.1')
+        parser.add_argument('-p', '--port', type=int, default=8000,
+                            help="Shared port; worker n also listens on port + 1 + n for its sticky rooms.")
+        parser.add_argument('--no-sticky', action='store_true', help="Only listen on the shared port.")
+        parser.add_argument('--ipc-dir', help="Directory for the workers' Unix sockets. Defaults to a new temp dir.")
+        parser.add_argument('--application', default='chat_project.asgi:application')
+        parser.add_argument('--retention-interval', type=float, default=RETENTION_INTERVAL,
+                            help="Seconds between apply_retention runs. Off unless given or CHAT_RETENTION_INTERVAL "
+                                 "is set.")
+        parser.add_argument('server_args', nargs='*', help="Extra arguments for every daphne worker, after --.")
+
+    def handle(self, *args, **options):
+        pool = WorkerPool(
+            options['application'], options['workers'], host=options['bind'], port=options['port'],
+            sticky=not options['no_sticky'], ipc_dir=options['ipc_dir'], server_args=options['server_args'],
+            retention_interval=options['retention_interval'],
+        )
+
+        def shutdown(signum, frame):
+            pool.stopping = True
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        pool.start()
+        self.stdout.write(f"Started {pool.workers} worker(s) on {pool.host}:{pool.port}"
+                          + (f", sticky ports {pool.port + 1}-{pool.port + pool.workers}" if pool.sticky else ""))
+        try:
+            pool.supervise()
+        finally:
+            pool.stop()
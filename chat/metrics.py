@@ -0,0 +1,145 @@
+"""In-process counters, gauges and histograms, served at /metrics in the Prometheus text format.
+
+Recording a value is a dict update and, for histograms, a bisect; nothing is
+formatted until a scrape, so the instruments stay on in production. Labels
+are positional and should come from a small fixed set (consumer class,
+event type, codec), never from user input.
+
+Each process has its own registry. Under `manage.py runworkers` scrape every
+worker on its sticky port; the shared port reaches whichever worker accepts.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Bearer token required by the endpoint; None leaves it open, for scrapers on a private network.
+METRICS_TOKEN = getattr(settings, 'CHAT_METRICS_TOKEN', None)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+ENCODE_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+
+REGISTRY = []
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base for the instruments. Values live in `values`, {label values: value}.
+
+    With `callback`, values are instead read at scrape time: it returns a
+    number, or {label values: number} for a labelled metric. That is how
+    counters other modules already keep are exported without a second count.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        values = self.values if self.callback is None else self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield self.name, labels if isinstance(labels, tuple) else (labels,), '', value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, extra, value in self.samples():
+            lines.append(f"{name}{format_labels(self.labelnames, labels, extra)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            # Per-bucket counts (the last is +Inf), then sum and count.
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        for labels, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                yield f"{self.name}_bucket", labels, f'le="{format_value(bound)}"', cumulative
+            yield f"{self.name}_sum", labels, '', series[-2]
+            yield f"{self.name}_count", labels, '', series[-1]
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# WebSocket traffic, labelled with the consumer class.
+CONNECTIONS = Gauge('chat_websocket_connections', "Open WebSocket connections.", ['consumer'])
+FRAMES_IN = Counter('chat_websocket_frames_received_total', "Frames decoded from clients.", ['consumer'])
+FRAMES_OUT = Counter('chat_websocket_frames_sent_total', "Frames sent to clients.", ['consumer'])
+BYTES_OUT = Counter('chat_websocket_bytes_sent_total',
+                    "Payload sent to clients, in bytes (characters for text frames).", ['consumer'])
+ENCODE_SECONDS = Histogram('chat_encode_seconds', "Time to serialize one frame.", ['codec'],
+                           buckets=ENCODE_BUCKETS)
+
+# Channel layer and persistence.
+GROUP_SEND_SECONDS = Histogram('chat_group_send_seconds', "Latency of channel layer group_send.", ['event'])
+DB_WRITE_SECONDS = Histogram('chat_db_write_seconds', "Time to write one batch of messages.")
+MESSAGE_SAVE_SECONDS = Histogram('chat_message_save_seconds',
+                                 "Time from a message being queued for writing to it being saved.")
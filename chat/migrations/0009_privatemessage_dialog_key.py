@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_dialog_key(apps, schema_editor):
+    PrivateMessage = apps.get_model('chat', 'PrivateMessage')
+    pairs = PrivateMessage.objects.values_list('sender_id', 'recipient_id').distinct()
+    for sender_id, recipient_id in pairs:
+        low, high = sorted((sender_id, recipient_id))
+        PrivateMessage.objects.filter(sender_id=sender_id, recipient_id=recipient_id).update(
+            dialog_key=f"{low}:{high}"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_remove_privatemessage_deleted'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='privatemessage',
+            name='dialog_key',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.RunPython(backfill_dialog_key, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['dialog_key', 'timestamp', 'id'], name='chat_msg_dialog_ts_idx'),
+        ),
+    ]
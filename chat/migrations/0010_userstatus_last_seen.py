@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_privatemessage_dialog_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstatus',
+            name='last_seen',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:16
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_userstatus_last_seen'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='privatemessage',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
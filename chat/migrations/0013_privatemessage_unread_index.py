@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:18
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_conversation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['dialog_key', 'recipient'], name='chat_msg_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_blob_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='content_type',
+            field=models.CharField(default='application/octet-stream', max_length=100),
+        ),
+    ]
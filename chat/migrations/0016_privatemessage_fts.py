@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from chat.search import fts_supported, install_fts
+    # Without FTS5, search falls back to chat.search.InvertedIndex, built in each process.
+    if fts_supported(schema_editor.connection):
+        install_fts(schema_editor.connection)
+
+
+def drop_search_index(apps, schema_editor):
+    from chat.search import drop_fts
+    if schema_editor.connection.vendor == 'sqlite':
+        drop_fts(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_blob_content_type'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:31
+
+from django.db import migrations, models
+
+
+def fill_read_watermarks(apps, schema_editor):
+    from chat.management.commands.rebuild_conversations import rebuild
+    rebuild(apps.get_model('chat', 'PrivateMessage'), apps.get_model('chat', 'Conversation'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_privatemessage_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='read_up_to_high',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='read_up_to_low',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_read_watermarks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:34
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    from chat.management.commands.rebuild_conversations import rebuild
+    PrivateMessage = apps.get_model('chat', 'PrivateMessage')
+    dialog_keys = PrivateMessage.objects.exclude(dialog_key='').order_by() \
+        .values_list('dialog_key', flat=True).distinct()
+    for dialog_key in dialog_keys.iterator():
+        messages = PrivateMessage.objects.filter(dialog_key=dialog_key).order_by('timestamp', 'id').only('id')
+        numbered = []
+        for seq, message in enumerate(messages.iterator(), start=1):
+            message.seq = seq
+            numbered.append(message)
+        PrivateMessage.objects.bulk_update(numbered, ['seq'], batch_size=1000)
+    # Sets Conversation.last_seq from the numbers just assigned.
+    rebuild(PrivateMessage, apps.get_model('chat', 'Conversation'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_conversation_read_up_to'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='privatemessage',
+            constraint=models.UniqueConstraint(fields=('dialog_key', 'seq'), name='chat_msg_dialog_seq_uniq'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def set_journal_mode(mode):
+    def apply(apps, schema_editor):
+        # Stored in the database file, so it is set once here rather than on every connection.
+        if schema_editor.connection.vendor == 'sqlite':
+            with schema_editor.connection.cursor() as cursor:
+                cursor.execute(f"PRAGMA journal_mode={mode}")
+    return apply
+
+
+class Migration(migrations.Migration):
+    # journal_mode cannot change inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('chat', '0019_archivedsegment'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_journal_mode('WAL'), set_journal_mode('DELETE')),
+    ]
@@ -1,13 +1,26 @@
-from django.db import models
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db.models import F, Max, Q, Value
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.utils import timezone
+
+
+def message_preview(message):
+    if message.content:
+        return message.content[:100]
+    return 'Attachment' if message.file else ''
 
 
 class UserStatus(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     is_online = models.BooleanField(default=False)
+    last_seen = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return f"{self.user.username} - {'Online' if self.is_online else 'Offline'}"
@@ -21,24 +34,73 @@ class PrivateMessage(models.Model):
     sender = models.ForeignKey(User, related_name='sent_messages', on_delete=models.CASCADE)
     recipient = models.ForeignKey(User, related_name='received_messages', on_delete=models.CASCADE)
     content = models.TextField(blank=True, null=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # default rather than auto_now_add so that replayed/imported messages keep their time.
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     file = models.FileField(upload_to='chat_files/', blank=True, null=True)
     is_read = models.BooleanField(default=False)
+    dialog_key = models.CharField(max_length=64, blank=True, default='')
+    # Position in the dialog, assigned when the message is written; null for rows bulk-inserted without one.
+    seq = models.PositiveBigIntegerField(blank=True, null=True, editable=False)
+
+    class Meta:
+        constraints = [
+            # Also the index behind seq range queries when a client resumes.
+            models.UniqueConstraint(fields=['dialog_key', 'seq'], name='chat_msg_dialog_seq_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['dialog_key', 'timestamp', 'id'], name='chat_msg_dialog_ts_idx'),
+            # Only unread rows are indexed, so it stays small however long the history gets.
+            models.Index(fields=['dialog_key', 'recipient'], condition=Q(is_read=False), name='chat_msg_unread_idx'),
+        ]
 
     def __str__(self):
         return f"{self.sender.username} -> {self.recipient.username}: {self.content}"
 
     def mark_as_read(self):
+        if self.is_read:
+            return
         self.is_read = True
-        self.save()
+        self.save(update_fields=['is_read'])
+        side = 'low' if self.dialog_key.startswith(f"{self.recipient_id}:") else 'high'
+        Conversation.objects.filter(dialog_key=self.dialog_key).update(**{
+            f'unread_{side}': Greatest(F(f'unread_{side}') - 1, 0),
+            f'read_up_to_{side}': Greatest(F(f'read_up_to_{side}'), Value(self.pk)),
+        })
 
     def delete_message(self):
         self.is_deleted = True
         self.save()
 
+    @staticmethod
+    def make_dialog_key(user_a_id, user_b_id):
+        # Both directions of a conversation share one key, lower id first.
+        low, high = sorted((int(user_a_id), int(user_b_id)))
+        return f"{low}:{high}"
+
     @staticmethod
     def get_unread_count_for_dialog_with_user(sender, recipient):
-        return PrivateMessage.objects.filter(sender_id=sender, recipient_id=recipient, read=False).count()
+        return PrivateMessage.objects.filter(
+            dialog_key=PrivateMessage.make_dialog_key(sender, recipient), recipient_id=recipient, is_read=False
+        ).count()
+
+    @staticmethod
+    def mark_read_up_to(reader_id, other_id, message_id=None):
+        """Mark what `other_id` sent to `reader_id` as read with one UPDATE, up to `message_id` if given."""
+        dialog_key = PrivateMessage.make_dialog_key(reader_id, other_id)
+        messages = PrivateMessage.objects.filter(dialog_key=dialog_key, recipient_id=reader_id, is_read=False)
+        if message_id is None:
+            # Pin the watermark first so a message written meanwhile is not reported as read.
+            message_id = messages.aggregate(last=Max('id'))['last']
+            if message_id is None:
+                return 0
+        updated = messages.filter(id__lte=message_id).update(is_read=True)
+        if updated:
+            side = 'low' if int(reader_id) <= int(other_id) else 'high'
+            Conversation.objects.filter(dialog_key=dialog_key).update(**{
+                f'unread_{side}': Greatest(F(f'unread_{side}') - updated, 0),
+                f'read_up_to_{side}': Greatest(F(f'read_up_to_{side}'), Value(message_id)),
+            })
+        return updated
 
     @staticmethod
     def get_last_message_for_dialog(sender, recipient):
@@ -50,4 +112,215 @@ class PrivateMessage(models.Model):
         return str(self.pk)
 
     def save(self, *args, **kwargs):
-        super(PrivateMessage, self).save(*args, **kwargs)
+        if not self.dialog_key:
+            self.dialog_key = PrivateMessage.make_dialog_key(self.sender_id, self.recipient_id)
+        created = self._state.adding
+        with transaction.atomic():
+            if created and self.seq is None:
+                Conversation.allocate_seqs([self])
+            super(PrivateMessage, self).save(*args, **kwargs)
+            if created:
+                Conversation.record_messages([self])
+                Blob.adjust_refs([self.file.name], 1)
+
+
+@receiver(post_delete, sender=PrivateMessage)
+def release_message_blob(sender, instance, **kwargs):
+    Blob.adjust_refs([instance.file.name], -1)
+
+
+class Conversation(models.Model):
+    """Denormalized per-dialog summary behind the inbox, one row per pair of users.
+
+    Kept up to date incrementally by Conversation.record_messages and
+    Conversation.mark_read; `manage.py rebuild_conversations` recomputes it.
+    """
+    dialog_key = models.CharField(max_length=64, unique=True)
+    user_low = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    user_high = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    last_message = models.ForeignKey(PrivateMessage, related_name='+', blank=True, null=True,
+                                     on_delete=models.SET_NULL)
+    last_sender = models.ForeignKey(User, related_name='+', blank=True, null=True, on_delete=models.SET_NULL)
+    last_message_preview = models.CharField(max_length=100, blank=True, default='')
+    last_message_at = models.DateTimeField(blank=True, null=True)
+    unread_low = models.PositiveIntegerField(default=0)
+    unread_high = models.PositiveIntegerField(default=0)
+    # Highest message id each side has read; everything it received up to there is read.
+    read_up_to_low = models.BigIntegerField(default=0)
+    read_up_to_high = models.BigIntegerField(default=0)
+    last_seq = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_low', '-last_message_at'], name='chat_conv_low_activity_idx'),
+            models.Index(fields=['user_high', '-last_message_at'], name='chat_conv_high_activity_idx'),
+        ]
+
+    def __str__(self):
+        return self.dialog_key
+
+    def other_user(self, user):
+        return self.user_high if user.pk == self.user_low_id else self.user_low
+
+    def unread_for(self, user):
+        return self.unread_low if user.pk == self.user_low_id else self.unread_high
+
+    def read_up_to_for(self, user):
+        return self.read_up_to_low if user.pk == self.user_low_id else self.read_up_to_high
+
+    @staticmethod
+    def for_user(user):
+        return Conversation.objects.filter(Q(user_low=user) | Q(user_high=user)) \
+            .select_related('user_low__userstatus', 'user_high__userstatus') \
+            .order_by(F('last_message_at').desc(nulls_last=True))
+
+
+    @staticmethod
+    def ensure(dialog_keys):
+        Conversation.objects.bulk_create([
+            Conversation(dialog_key=key, user_low_id=int(key.split(':')[0]), user_high_id=int(key.split(':')[1]))
+            for key in dialog_keys
+        ], ignore_conflicts=True)
+
+    @staticmethod
+    def allocate_seqs(messages):
+        """Give unsaved messages consecutive per-dialog sequence numbers, in list order.
+
+        Must run in the transaction that inserts them: the UPDATE holds the
+        conversation row (the database, on SQLite) until commit, so concurrent
+        writers get disjoint ranges in commit order.
+        """
+        dialogs = {}
+        for message in messages:
+            dialogs.setdefault(message.dialog_key, []).append(message)
+        Conversation.ensure(dialogs)
+        for dialog_key, dialog_messages in dialogs.items():
+            conversation = Conversation.objects.filter(dialog_key=dialog_key)
+            conversation.update(last_seq=F('last_seq') + len(dialog_messages))
+            last_seq = conversation.values_list('last_seq', flat=True).get()
+            for seq, message in enumerate(dialog_messages, start=last_seq - len(dialog_messages) + 1):
+                message.seq = seq
+
+    @staticmethod
+    def record_messages(messages):
+        """Fold newly created messages into their conversations, two UPDATEs per dialog."""
+        dialogs = {}
+        for message in messages:
+            dialogs.setdefault(message.dialog_key, []).append(message)
+
+        Conversation.ensure(dialogs)
+
+        for dialog_key, dialog_messages in dialogs.items():
+            low_id = int(dialog_key.split(':')[0])
+            unread_low = sum(1 for m in dialog_messages if not m.is_read and m.recipient_id == low_id)
+            unread_high = sum(1 for m in dialog_messages if not m.is_read and m.recipient_id != low_id)
+            if unread_low or unread_high:
+                Conversation.objects.filter(dialog_key=dialog_key).update(
+                    unread_low=F('unread_low') + unread_low,
+                    unread_high=F('unread_high') + unread_high,
+                )
+            last = max(dialog_messages, key=lambda m: (m.timestamp, m.pk))
+            Conversation.objects.filter(dialog_key=dialog_key) \
+                .filter(Q(last_message_at__isnull=True) | Q(last_message_at__lte=last.timestamp)) \
+                .update(
+                    last_message=last,
+                    last_sender_id=last.sender_id,
+                    last_message_preview=message_preview(last),
+                    last_message_at=last.timestamp,
+                )
+
+    @staticmethod
+    def mark_read(reader, other):
+        """Mark everything `other` sent to `reader` as read and clear the reader's counter."""
+        return PrivateMessage.mark_read_up_to(reader.pk, other.pk)
+
+    @staticmethod
+    def unread_count(reader, other):
+        dialog_key = PrivateMessage.make_dialog_key(reader.pk, other.pk)
+        counter = 'unread_low' if reader.pk <= other.pk else 'unread_high'
+        counts = Conversation.objects.filter(dialog_key=dialog_key).values_list(counter, flat=True)
+        return next(iter(counts), 0)
+
+
+class Blob(models.Model):
+    """An uploaded file stored once under its SHA-256 digest.
+
+    `ref_count` is the number of messages whose `file` points at it, archived
+    ones included; chat.retention deletes blobs once it is 0.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    content_type = models.CharField(max_length=100, default='application/octet-stream')
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.sha256
+
+    @staticmethod
+    def name_from_file_value(value):
+        # Messages store either the storage name or the URL the upload endpoint returned.
+        if value and value.startswith(settings.MEDIA_URL):
+            return value[len(settings.MEDIA_URL):]
+        return value
+
+    @staticmethod
+    def adjust_refs(file_values, delta):
+        counts = Counter(
+            name for name in map(Blob.name_from_file_value, file_values)
+            if name and name.startswith('chat_files/blobs/')
+        )
+        for name, count in counts.items():
+            Blob.objects.filter(name=name).update(ref_count=Greatest(F('ref_count') + delta * count, 0))
+
+
+class UploadSession(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, related_name='upload_sessions', on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    blob = models.ForeignKey(Blob, related_name='uploads', blank=True, null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(default=timezone.now)
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+    @property
+    def is_complete(self):
+        return self.completed_at is not None
+
+
+class ArchivedSegment(models.Model):
+    """Old messages of one dialog, moved out of PrivateMessage as gzip-compressed JSON lines.
+
+    A dialog's segments hold the start of its history in order, oldest
+    first; what comes after the newest one is still in PrivateMessage.
+    Written and read by chat.archive.
+    """
+    dialog_key = models.CharField(max_length=64)
+    user_low = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    user_high = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    # Position of the first and last message in history order, (timestamp, id).
+    first_timestamp = models.DateTimeField()
+    first_id = models.BigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_id = models.BigIntegerField()
+    # Id range, for finding a message by id.
+    min_id = models.BigIntegerField()
+    max_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    # Attachment file values, so cleanup does not have to decompress the segment.
+    files = models.JSONField(default=list, blank=True)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['dialog_key', '-last_timestamp', '-last_id'], name='chat_archive_dialog_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.dialog_key} ({self.message_count} messages)"
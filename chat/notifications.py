@@ -0,0 +1,250 @@
+"""Unread counters kept in the cache and pushed to each user's notification sockets.
+
+Every saved message adds one to the recipient's counter for the dialog,
+`chat:unread:<user id>:<dialog key>` in CHAT_UNREAD_CACHE, with an atomic
+INCR; reading the dialog resets it. Changes are collected per process and
+applied every CHAT_NOTIFICATION_INTERVAL seconds: one INCR per counter, then
+one `notification_message` event per user to `notifications_<username>`
+carrying the new totals, however many messages arrived meanwhile.
+
+Badge reads (unread_count) come from the cache. A missing counter is seeded
+from the Conversation row, which the message write keeps exact. The cache
+can still drift from it, e.g. when a counter is seeded between a message
+being saved and its increment being applied, so every
+CHAT_UNREAD_RECONCILE_INTERVAL seconds one process corrects the counters that
+differ (also `manage.py reconcile_unread`).
+"""
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+
+from .database import db_read
+from .metrics import GROUP_SEND_SECONDS, Counter, Gauge
+from .models import Conversation, PrivateMessage, message_preview
+from .wire import fanout
+
+logger = logging.getLogger(__name__)
+
+UNREAD_CACHE = getattr(settings, 'CHAT_UNREAD_CACHE', 'default')
+UNREAD_COUNTER_TIMEOUT = getattr(settings, 'CHAT_UNREAD_COUNTER_TIMEOUT', 7 * 24 * 3600)
+NOTIFICATION_INTERVAL = getattr(settings, 'CHAT_NOTIFICATION_INTERVAL', 0.5)
+UNREAD_RECONCILE_INTERVAL = getattr(settings, 'CHAT_UNREAD_RECONCILE_INTERVAL', 300)
+
+RECONCILE_LOCK_KEY = 'chat:unread:reconcile'
+
+# How a read changes a counter before later increments are added.
+ZERO = 'zero'  # everything was read
+RELOAD = 'reload'  # read up to a message, the remainder comes from the database
+
+UNREAD_LOOKUPS = Counter('chat_unread_counter_lookups_total', "Unread badge reads, by whether the cache had it.",
+                         ['result'])
+NOTIFICATIONS_SENT = Counter('chat_notifications_sent_total', "Coalesced notification events sent to users.")
+
+
+def unread_key(user_id, dialog_key):
+    return f"chat:unread:{user_id}:{dialog_key}"
+
+
+def notification_group_name(username):
+    return f"notifications_{username}"
+
+
+def notification_event(dialogs):
+    """The group event for `notifications_<username>`; `dialogs` as in notification_payload."""
+    return {'type': 'notification_message', 'dialogs': dialogs}
+
+
+def notification_payload(event):
+    """What NotificationConsumer sends for a notification_message event."""
+    return {'type': 'notification', 'dialogs': event['dialogs']}
+
+
+class PendingChange:
+    __slots__ = ('user_id', 'dialog_key', 'username', 'other', 'reset', 'delta', 'message')
+
+    def __init__(self, user_id, dialog_key, username, other):
+        self.user_id = user_id
+        self.dialog_key = dialog_key
+        self.username = username
+        self.other = other
+        self.reset = None
+        self.delta = 0
+        self.message = None
+
+
+class UnreadNotifier:
+    """Coalesces counter changes and notifications for every consumer in the process."""
+
+    def __init__(self, interval=NOTIFICATION_INTERVAL, reconcile_interval=UNREAD_RECONCILE_INTERVAL):
+        self.interval = interval
+        self.reconcile_interval = reconcile_interval
+        self.loop = asyncio.get_running_loop()
+        self.channel_layer = get_channel_layer()
+        self._changes = {}
+        self._flush_task = self.loop.create_task(self._flush_loop())
+        self._reconcile_task = self.loop.create_task(self._reconcile_loop()) if reconcile_interval else None
+
+    def _change(self, user_id, dialog_key, username, other):
+        change = self._changes.get((user_id, dialog_key))
+        if change is None:
+            change = self._changes[(user_id, dialog_key)] = PendingChange(user_id, dialog_key, username, other)
+        return change
+
+    def message_saved(self, message, sender_username, recipient_username):
+        change = self._change(message.recipient_id, message.dialog_key, recipient_username, sender_username)
+        change.delta += 1
+        change.message = message_preview(message)
+
+    def dialog_read(self, reader, other, everything=True):
+        # Increments queued before the read are covered by it.
+        change = self._change(reader.pk, PrivateMessage.make_dialog_key(reader.pk, other.pk),
+                              reader.username, other.username)
+        change.reset = ZERO if everything else RELOAD
+        change.delta = 0
+        change.message = None
+
+    async def flush(self):
+        if not self._changes:
+            return
+        changes, self._changes = list(self._changes.values()), {}
+        totals = await db_read(apply_unread_changes)(changes)
+        by_user = {}
+        for change in changes:
+            entry = {'sender': change.other, 'unread': totals[unread_key(change.user_id, change.dialog_key)]}
+            if change.message is not None:
+                entry['message'] = change.message
+            by_user.setdefault(change.username, []).append(entry)
+        for username, dialogs in by_user.items():
+            event = notification_event(dialogs)
+            NOTIFICATIONS_SENT.inc()
+            with GROUP_SEND_SECONDS.time('notification_message'):
+                await self.channel_layer.group_send(
+                    notification_group_name(username), fanout(event, notification_payload(event))
+                )
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to apply unread counter changes")
+
+    async def _reconcile_loop(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                # One process per interval does it; the lock expires in time for the next run.
+                if caches[UNREAD_CACHE].add(RECONCILE_LOCK_KEY, 1, timeout=self.reconcile_interval):
+                    corrected = await db_read(reconcile_unread_counters)()
+                    if corrected:
+                        logger.info("Corrected %d drifted unread counters", corrected)
+            except Exception:
+                logger.exception("Unread counter reconciliation failed")
+
+
+def stored_unread(conversation, user_id):
+    return conversation.unread_low if user_id == conversation.user_low_id else conversation.unread_high
+
+
+def seed_unread_counters(cache, counters):
+    """Load (user id, dialog key) counters missing from the cache from their conversations."""
+    conversations = Conversation.objects.filter(dialog_key__in={dialog_key for _, dialog_key in counters}) \
+        .only('dialog_key', 'user_low', 'unread_low', 'unread_high')
+    conversations = {conversation.dialog_key: conversation for conversation in conversations}
+    totals = {}
+    for user_id, dialog_key in counters:
+        key = unread_key(user_id, dialog_key)
+        conversation = conversations.get(dialog_key)
+        count = stored_unread(conversation, user_id) if conversation is not None else 0
+        if not cache.add(key, count, UNREAD_COUNTER_TIMEOUT):
+            # Seeded by someone else meanwhile, theirs is as good.
+            count = cache.get(key, count)
+        totals[key] = count
+    return totals
+
+
+def apply_unread_changes(changes):
+    """Apply coalesced PendingChanges to the cache; returns {counter key: new total}."""
+    cache = caches[UNREAD_CACHE]
+    totals, missing = {}, []
+    for change in changes:
+        key = unread_key(change.user_id, change.dialog_key)
+        if change.reset == ZERO:
+            cache.set(key, change.delta, UNREAD_COUNTER_TIMEOUT)
+            totals[key] = change.delta
+            continue
+        if change.reset == RELOAD:
+            cache.delete(key)
+            missing.append((change.user_id, change.dialog_key))
+            continue
+        try:
+            totals[key] = cache.incr(key, change.delta)
+        except ValueError:
+            # Not cached; the conversation row already counts these messages.
+            missing.append((change.user_id, change.dialog_key))
+    if missing:
+        totals.update(seed_unread_counters(cache, missing))
+    return totals
+
+
+def unread_count(reader, other):
+    """The reader's unread count for the dialog with `other`, without the database once cached."""
+    cache = caches[UNREAD_CACHE]
+    dialog_key = PrivateMessage.make_dialog_key(reader.pk, other.pk)
+    key = unread_key(reader.pk, dialog_key)
+    count = cache.get(key)
+    if count is not None:
+        UNREAD_LOOKUPS.inc('hit')
+        return count
+    UNREAD_LOOKUPS.inc('miss')
+    return seed_unread_counters(cache, [(reader.pk, dialog_key)])[key]
+
+
+def reset_unread_count(reader, other):
+    """For reads outside the chat socket, e.g. opening the chat page."""
+    dialog_key = PrivateMessage.make_dialog_key(reader.pk, other.pk)
+    caches[UNREAD_CACHE].set(unread_key(reader.pk, dialog_key), 0, UNREAD_COUNTER_TIMEOUT)
+
+
+def reconcile_unread_counters(batch_size=1000):
+    """Overwrite cached counters that differ from their conversation rows; returns how many did."""
+    cache = caches[UNREAD_CACHE]
+    conversations = Conversation.objects.only('dialog_key', 'user_low', 'user_high', 'unread_low', 'unread_high') \
+        .order_by('pk')
+    corrected = 0
+    expected = {}
+    for conversation in conversations.iterator(chunk_size=batch_size):
+        for user_id in (conversation.user_low_id, conversation.user_high_id):
+            expected[unread_key(user_id, conversation.dialog_key)] = stored_unread(conversation, user_id)
+        if len(expected) >= batch_size:
+            corrected += correct_counters(cache, expected)
+            expected = {}
+    if expected:
+        corrected += correct_counters(cache, expected)
+    return corrected
+
+
+def correct_counters(cache, expected):
+    # Only counters already cached; the rest are seeded on their next read.
+    cached = cache.get_many(list(expected))
+    drifted = {key: expected[key] for key, count in cached.items() if count != expected[key]}
+    if drifted:
+        cache.set_many(drifted, UNREAD_COUNTER_TIMEOUT)
+    return len(drifted)
+
+
+_notifier = None
+Gauge('chat_notification_pending_changes', "Unread counter changes waiting for the next flush.",
+      callback=lambda: len(_notifier._changes) if _notifier is not None else 0)
+
+
+def get_unread_notifier():
+    global _notifier
+    loop = asyncio.get_running_loop()
+    if _notifier is None or _notifier.loop is not loop or _notifier.loop.is_closed():
+        _notifier = UnreadNotifier()
+    return _notifier
@@ -0,0 +1,253 @@
+import asyncio
+import atexit
+import logging
+from collections import deque
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from .database import db_write
+from .metrics import DB_WRITE_SECONDS, MESSAGE_SAVE_SECONDS, Counter, Gauge
+from .models import Blob, Conversation, PrivateMessage
+from .utils import message_log
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = getattr(settings, 'CHAT_WRITE_BATCH_SIZE', 200)
+WRITE_FLUSH_INTERVAL = getattr(settings, 'CHAT_WRITE_FLUSH_INTERVAL', 0.05)
+WRITE_QUEUE_SIZE = getattr(settings, 'CHAT_WRITE_QUEUE_SIZE', 5000)
+WRITE_ENQUEUE_TIMEOUT = getattr(settings, 'CHAT_WRITE_ENQUEUE_TIMEOUT', 2.0)
+# Also append every written message to the NDJSON message log (chat.utils).
+MESSAGE_LOG_ENABLED = getattr(settings, 'CHAT_MESSAGE_LOG_ENABLED', False)
+
+
+class WriteQueueFull(Exception):
+    pass
+
+
+class PendingMessage:
+    __slots__ = ('sender', 'recipient', 'content', 'file_url', 'future', 'queued')
+
+    def __init__(self, sender, recipient, content, file_url, future, queued):
+        self.sender = sender
+        self.recipient = recipient
+        self.content = content
+        self.file_url = file_url
+        self.future = future
+        self.queued = queued
+
+
+class MessageWriter:
+    """Write-behind queue shared by every chat consumer in the process.
+
+    Messages are collected from all connections and written with one
+    bulk_create per batch, flushed when `batch_size` messages are waiting or
+    `flush_interval` seconds after the first one arrived, whichever is first.
+    `submit` returns a future that resolves to the saved PrivateMessage, with
+    its id and per-dialog `seq`.
+    """
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL,
+                 max_pending=WRITE_QUEUE_SIZE, enqueue_timeout=WRITE_ENQUEUE_TIMEOUT):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.enqueue_timeout = enqueue_timeout
+        self.loop = asyncio.get_running_loop()
+        self._pending = deque()
+        self._slots = asyncio.Semaphore(max_pending)
+        self._has_items = asyncio.Event()
+        self._batch_ready = asyncio.Event()
+        self._closed = False
+        self._task = self.loop.create_task(self._run())
+        self.written = 0
+        self.batches = 0
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    async def submit(self, sender, recipient, content, file_url=None):
+        # Sender and recipient are usernames, or user ids once they are known.
+        if self._closed:
+            raise WriteQueueFull("Message writer is shut down")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            raise WriteQueueFull(f"{self.max_pending} messages already waiting to be written")
+
+        future = self.loop.create_future()
+        self._pending.append(PendingMessage(sender, recipient, content, file_url, future, self.loop.time()))
+        self._has_items.set()
+        if len(self._pending) >= self.batch_size:
+            self._batch_ready.set()
+        return future
+
+    async def _run(self):
+        while not self._closed or self._pending:
+            await self._has_items.wait()
+            if not self._closed and len(self._pending) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._has_items.clear()
+            self._batch_ready.clear()
+            while self._pending:
+                await self.flush()
+
+    async def flush(self):
+        batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+        if not batch:
+            return
+        try:
+            with DB_WRITE_SECONDS.time():
+                saved = await db_write(write_batch)(batch)
+        except Exception as e:
+            logger.exception("Failed to write batch of %d messages", len(batch))
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+        else:
+            self.written += len(batch)
+            self.batches += 1
+            now = self.loop.time()
+            for item, message in zip(batch, saved):
+                MESSAGE_SAVE_SECONDS.observe(now - item.queued)
+                if item.future.done():
+                    continue
+                if message is None:
+                    item.future.set_exception(User.DoesNotExist(f"Unknown user in message from {item.sender!r}"))
+                else:
+                    item.future.set_result(message)
+        finally:
+            for _ in batch:
+                self._slots.release()
+
+    async def aclose(self):
+        self._closed = True
+        self._has_items.set()
+        self._batch_ready.set()
+        await self._task
+
+    def drain_sync(self):
+        # Last-resort flush from atexit, after the event loop has stopped.
+        self._closed = True
+        batch = list(self._pending)
+        self._pending.clear()
+        if batch:
+            write_batch(batch)
+            logger.info("Flushed %d pending messages on shutdown", len(batch))
+
+
+def resolve_user_ids(values):
+    # One query per batch for every username in it; ids pass through as-is.
+    usernames = {value for value in values if isinstance(value, str)}
+    ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id')) if usernames else {}
+    return {value: ids.get(value) if isinstance(value, str) else value for value in values}
+
+
+def write_batch(batch):
+    """Insert a batch with one bulk_create; returns the messages in batch order, None for rejected rows."""
+    user_ids = resolve_user_ids({item.sender for item in batch} | {item.recipient for item in batch})
+    messages = []
+    for item in batch:
+        sender_id = user_ids[item.sender]
+        recipient_id = user_ids[item.recipient]
+        if sender_id is None or recipient_id is None:
+            messages.append(None)
+            continue
+        messages.append(PrivateMessage(
+            sender_id=sender_id,
+            recipient_id=recipient_id,
+            content=item.content,
+            file=item.file_url,
+            dialog_key=PrivateMessage.make_dialog_key(sender_id, recipient_id),
+        ))
+    insert_messages([message for message in messages if message is not None])
+    return messages
+
+
+def insert_messages(messages):
+    """Insert unsaved messages with one bulk_create, keeping seqs, Conversation rows and blob refs in step."""
+    with transaction.atomic():
+        # Sequence numbers follow list order, which for the writer is also the order messages are broadcast in.
+        Conversation.allocate_seqs(messages)
+        created = PrivateMessage.objects.bulk_create(messages)
+        Conversation.record_messages(created)
+        Blob.adjust_refs([message.file.name for message in created], 1)
+    if MESSAGE_LOG_ENABLED:
+        message_log.append_many([message_record(message) for message in created])
+    return created
+
+
+def restore_messages(messages):
+    """Insert messages read back from the message log, keeping their ids and logged seqs.
+
+    Ids and (dialog, seq) pairs that are already stored are skipped, and
+    messages logged without a seq get the next ones. Conversations and blob
+    refs are brought up to date as in insert_messages. Returns the messages
+    inserted.
+    """
+    with transaction.atomic():
+        taken_ids = set(PrivateMessage.objects.filter(pk__in=[message.pk for message in messages])
+                        .values_list('pk', flat=True))
+        logged = [message for message in messages if message.seq is not None]
+        taken_seqs = set(PrivateMessage.objects.filter(
+            dialog_key__in={message.dialog_key for message in logged},
+            seq__in={message.seq for message in logged},
+        ).values_list('dialog_key', 'seq'))
+        messages = [message for message in messages
+                    if message.pk not in taken_ids and (message.dialog_key, message.seq) not in taken_seqs]
+        if not messages:
+            return []
+        highest = {}
+        for message in messages:
+            if message.seq is not None:
+                highest[message.dialog_key] = max(highest.get(message.dialog_key, 0), message.seq)
+        Conversation.ensure(highest)
+        for dialog_key, seq in highest.items():
+            # Live messages carry on after the restored ones.
+            Conversation.objects.filter(dialog_key=dialog_key).update(last_seq=Greatest(F('last_seq'), seq))
+        Conversation.allocate_seqs([message for message in messages if message.seq is None])
+        created = PrivateMessage.objects.bulk_create(messages)
+        Conversation.record_messages(created)
+        Blob.adjust_refs([message.file.name for message in created], 1)
+    return created
+
+
+def message_record(message):
+    return {
+        'id': message.pk,
+        'sender_id': message.sender_id,
+        'recipient_id': message.recipient_id,
+        'dialog_key': message.dialog_key,
+        'seq': message.seq,
+        'content': message.content,
+        'file': message.file.name or None,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+_writer = None
+Gauge('chat_write_queue_depth', "Messages waiting for the message writer.",
+      callback=lambda: _writer.depth if _writer is not None else 0)
+Counter('chat_messages_written_total', "Messages written by the message writer.",
+        callback=lambda: _writer.written if _writer is not None else 0)
+
+
+def get_message_writer():
+    global _writer
+    loop = asyncio.get_running_loop()
+    if _writer is None or _writer.loop is not loop or _writer.loop.is_closed():
+        _writer = MessageWriter()
+    return _writer
+
+
+@atexit.register
+def _flush_on_exit():
+    if _writer is not None and _writer.depth:
+        _writer.drain_sync()
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+from .database import db_write
+from .fragments import invalidate_sidebars
+from .metrics import GROUP_SEND_SECONDS, Gauge
+from .models import UserStatus
+from .wire import fanout
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_CACHE = getattr(settings, 'CHAT_PRESENCE_CACHE', 'default')
+PRESENCE_BROADCAST_INTERVAL = getattr(settings, 'CHAT_PRESENCE_BROADCAST_INTERVAL', 0.5)
+PRESENCE_HEARTBEAT_INTERVAL = getattr(settings, 'CHAT_PRESENCE_HEARTBEAT_INTERVAL', 30)
+PRESENCE_STALE_AFTER = getattr(settings, 'CHAT_PRESENCE_STALE_AFTER', 90)
+
+# Superusers list the regular users and regular users list the superusers
+# (see user_list_view), so each side only needs the other side's changes.
+SUPERUSER_WATCHERS_GROUP = 'presence_superusers'
+USER_WATCHERS_GROUP = 'presence_users'
+
+
+def watcher_group_for(user):
+    return SUPERUSER_WATCHERS_GROUP if user.is_superuser else USER_WATCHERS_GROUP
+
+
+def audience_group_for(user):
+    return USER_WATCHERS_GROUP if user.is_superuser else SUPERUSER_WATCHERS_GROUP
+
+
+def status_batch_payload(event):
+    """What OnlineStatusConsumer sends for a presence_batch event."""
+    return {'type': 'status_batch', 'changes': event['changes']}
+
+
+def connections_key(user_id):
+    return f"chat:presence:{user_id}"
+
+
+def presence_change(user, is_online):
+    return {
+        'user_id': user.pk,
+        'username': user.username,
+        'is_online': is_online,
+        'group': audience_group_for(user),
+    }
+
+
+async def send_presence_changes(channel_layer, changes):
+    """Send presence_change dicts to their watching groups, one `presence_batch` event per group."""
+    by_group = {}
+    for change in changes:
+        change = dict(change)
+        group = change.pop('group')
+        by_group.setdefault(group, []).append(change)
+    for group, group_changes in by_group.items():
+        event = {'type': 'presence_batch', 'changes': group_changes}
+        with GROUP_SEND_SECONDS.time('presence_batch'):
+            await channel_layer.group_send(group, fanout(event, status_batch_payload(event)))
+
+
+class PresenceTracker:
+    """Reference-counted presence for every OnlineStatusConsumer in the process.
+
+    The count of a user's connections lives in CHAT_PRESENCE_CACHE, shared by
+    every worker, so a user only goes online with their first connection
+    anywhere and offline with their last one; only those transitions are
+    written to UserStatus. `connections` is this process's share, which the
+    heartbeat keeps alive. Transitions are coalesced and sent to the watching
+    group as one `presence_batch` event every `broadcast_interval` seconds.
+    """
+
+    def __init__(self, broadcast_interval=PRESENCE_BROADCAST_INTERVAL,
+                 heartbeat_interval=PRESENCE_HEARTBEAT_INTERVAL, stale_after=PRESENCE_STALE_AFTER):
+        self.broadcast_interval = broadcast_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.loop = asyncio.get_running_loop()
+        self.channel_layer = get_channel_layer()
+        self.connections = {}
+        self._changes = {}
+        self._broadcast_task = self.loop.create_task(self._broadcast_loop())
+        self._heartbeat_task = self.loop.create_task(self._heartbeat_loop())
+
+    def is_online(self, user_id):
+        return self.connections.get(user_id, 0) > 0
+
+    async def connect(self, user):
+        self.connections[user.pk] = self.connections.get(user.pk, 0) + 1
+        if await db_write(open_connection)(user.pk, self.stale_after):
+            self._record(presence_change(user, True))
+
+    async def disconnect(self, user):
+        count = self.connections.get(user.pk, 0) - 1
+        if count > 0:
+            self.connections[user.pk] = count
+        else:
+            self.connections.pop(user.pk, None)
+        if await db_write(close_connection)(user.pk):
+            self._record(presence_change(user, False))
+
+    def _record(self, change):
+        user_id = change['user_id']
+        previous = self._changes.get(user_id)
+        if previous is not None and previous['is_online'] != change['is_online']:
+            # Flipped back within one interval, watchers never saw the first change.
+            del self._changes[user_id]
+            return
+        self._changes[user_id] = change
+
+    async def flush(self):
+        if not self._changes:
+            return
+        changes, self._changes = self._changes, {}
+        await send_presence_changes(self.channel_layer, changes.values())
+
+    async def _broadcast_loop(self):
+        while True:
+            await asyncio.sleep(self.broadcast_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to broadcast presence changes")
+
+    async def _heartbeat_loop(self):
+        while True:
+            try:
+                await db_write(touch_last_seen)(list(self.connections), self.stale_after)
+                for change in await db_write(reconcile_stale_statuses)(self.stale_after):
+                    self._record(change)
+            except Exception:
+                logger.exception("Presence heartbeat failed")
+            await asyncio.sleep(self.heartbeat_interval)
+
+
+def open_connection(user_id, stale_after=PRESENCE_STALE_AFTER):
+    """Count one more connection of the user's; returns whether they just came online.
+
+    The count and the status change share a write transaction, which SQLite
+    (transaction_mode IMMEDIATE) serializes across processes, so two workers
+    can't write a user's transitions in the opposite order of their counts.
+    """
+    cache = caches[PRESENCE_CACHE]
+    key = connections_key(user_id)
+    with transaction.atomic():
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # Expired or never counted; the heartbeat keeps live counts from expiring.
+            count = 1 if cache.add(key, 1, timeout=stale_after) else cache.incr(key)
+        if count == 1:
+            set_online_status(user_id, True)
+        return count == 1
+
+
+def close_connection(user_id):
+    """Count one connection of the user's less; returns whether that was their last."""
+    cache = caches[PRESENCE_CACHE]
+    with transaction.atomic():
+        try:
+            count = cache.decr(connections_key(user_id))
+        except ValueError:
+            count = 0
+        if count <= 0:
+            set_online_status(user_id, False)
+        return count <= 0
+
+
+def set_online_status(user_id, is_online):
+    updated = UserStatus.objects.filter(user_id=user_id).update(is_online=is_online, last_seen=timezone.now())
+    if not updated:
+        UserStatus.objects.create(user_id=user_id, is_online=is_online, last_seen=timezone.now())
+    else:
+        invalidate_sidebars()
+
+
+def touch_last_seen(user_ids, stale_after=PRESENCE_STALE_AFTER):
+    if user_ids:
+        UserStatus.objects.filter(user_id__in=user_ids).update(last_seen=timezone.now())
+        cache = caches[PRESENCE_CACHE]
+        for user_id in user_ids:
+            cache.touch(connections_key(user_id), stale_after)
+
+
+def reconcile_stale_statuses(stale_after=PRESENCE_STALE_AFTER):
+    """Mark users offline whose process stopped heartbeating, e.g. after a crash.
+
+    Returns their presence changes for send_presence_changes. Their connection
+    counts go too, since a crashed worker never took its connections off them.
+    """
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    with transaction.atomic():
+        stale = list(UserStatus.objects.filter(is_online=True).exclude(last_seen__gte=cutoff)
+                     .select_related('user').only('user', 'user__username', 'user__is_superuser'))
+        if not stale:
+            return []
+        UserStatus.objects.filter(pk__in=[status.pk for status in stale]).update(is_online=False)
+        caches[PRESENCE_CACHE].delete_many([connections_key(status.user_id) for status in stale])
+    invalidate_sidebars()
+    return [presence_change(status.user, False) for status in stale]
+
+
+_tracker = None
+Gauge('chat_presence_online_users', "Users with an open status connection to this process.",
+      callback=lambda: len(_tracker.connections) if _tracker is not None else 0)
+Gauge('chat_presence_pending_changes', "Presence changes waiting for the next broadcast.",
+      callback=lambda: len(_tracker._changes) if _tracker is not None else 0)
+
+
+def get_presence_tracker():
+    global _tracker
+    loop = asyncio.get_running_loop()
+    if _tracker is None or _tracker.loop is not loop or _tracker.loop.is_closed():
+        _tracker = PresenceTracker()
+    return _tracker
@@ -0,0 +1,85 @@
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.urls import reverse
+
+from .attachments import annotate_images
+from .models import Conversation, PrivateMessage
+
+REPLAY_BUFFER_SIZE = getattr(settings, 'CHAT_REPLAY_BUFFER_SIZE', 256)
+REPLAY_BUFFER_ROOMS = getattr(settings, 'CHAT_REPLAY_BUFFER_ROOMS', 1000)
+# Gaps larger than this are not replayed; the client is told to resync over HTTP instead.
+REPLAY_MAX_MESSAGES = getattr(settings, 'CHAT_REPLAY_MAX_MESSAGES', 1000)
+REPLAY_DB_CHUNK = 200
+
+
+def message_event(message, sender_username, recipient_username, is_image=False):
+    event = {
+        'type': 'chat_message',
+        'id': message.pk,
+        'seq': message.seq,
+        'message': message.content,
+        'file_url': message.file.name or None,
+        'sender': sender_username,
+        'recipient': recipient_username,
+    }
+    if message.file.name:
+        event['attachment_url'] = reverse('attachment', args=[message.pk])
+        if is_image:
+            event['thumbnail_url'] = reverse('attachment_thumbnail', args=[message.pk])
+            event['is_image'] = True
+    return event
+
+
+class ReplayBuffers:
+    """Process-local ring buffers of the latest chat_message events per room.
+
+    Each buffer only ever holds a run of consecutive sequence numbers; an
+    event that does not follow on starts the run again. Rooms are evicted
+    least recently used once there are more than `max_rooms`.
+    """
+
+    def __init__(self, size=REPLAY_BUFFER_SIZE, max_rooms=REPLAY_BUFFER_ROOMS):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.rooms = OrderedDict()
+
+    def record(self, room, event):
+        seq = event.get('seq')
+        if seq is None:
+            return
+        events = self.rooms.get(room)
+        if events is None:
+            events = self.rooms[room] = deque(maxlen=self.size)
+            if len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room)
+        if events and seq <= events[-1]['seq']:
+            return  # already recorded by another consumer of this room
+        if events and seq != events[-1]['seq'] + 1:
+            events.clear()
+        events.append(event)
+
+    def events_after(self, room, seq, latest_seq):
+        """Events with seq in (seq, latest_seq], or None if the buffer does not cover all of them."""
+        events = self.rooms.get(room)
+        if not events or events[0]['seq'] > seq + 1 or events[-1]['seq'] < latest_seq:
+            return None
+        return [event for event in events if seq < event['seq'] <= latest_seq]
+
+
+replay_buffers = ReplayBuffers()
+
+
+def latest_seq(dialog_key):
+    counts = Conversation.objects.filter(dialog_key=dialog_key).values_list('last_seq', flat=True)
+    return next(iter(counts), 0)
+
+
+def missed_messages(dialog_key, after_seq, up_to_seq, limit=REPLAY_DB_CHUNK):
+    """One chunk of the gap from the database, in seq order, via the (dialog_key, seq) index."""
+    messages = PrivateMessage.objects.filter(dialog_key=dialog_key, seq__gt=after_seq, seq__lte=up_to_seq) \
+        .select_related('sender', 'recipient').order_by('seq')[:limit]
+    return [message_event(message, message.sender.username, message.recipient.username, message.is_image)
+            for message in annotate_images(list(messages))]
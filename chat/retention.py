@@ -0,0 +1,119 @@
+"""The retention job: archive old messages, then delete files nothing refers to.
+
+Run by `manage.py apply_retention`, from cron or, with CHAT_RETENTION_INTERVAL
+set, by `manage.py runworkers` every that many seconds.
+
+Files under chat_files/ are kept while a message refers to them, in
+PrivateMessage or in the archive. For blobs that is Blob.ref_count, which
+archived messages keep holding; other files are looked up in the messages.
+Everything else older than CHAT_ORPHAN_GRACE_SECONDS goes: blobs and their
+rows, thumbnails of files that are gone, partial files of abandoned uploads
+and untracked files. The grace period covers uploads that have finished but
+are not in a message yet.
+"""
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .archive import ARCHIVE_SEGMENT_MESSAGES, archive_dialog, archived_file_names
+from .attachments import THUMBNAIL_DIR, blob_etag, stat_etag, thumbnail_key
+from .models import Blob, Conversation, PrivateMessage, UploadSession
+from .uploads import BLOB_DIR, PARTIAL_DIR, partial_path
+
+RETENTION_DAYS = getattr(settings, 'CHAT_RETENTION_DAYS', 180)
+RETENTION_INTERVAL = getattr(settings, 'CHAT_RETENTION_INTERVAL', None)
+ORPHAN_GRACE_SECONDS = getattr(settings, 'CHAT_ORPHAN_GRACE_SECONDS', 24 * 3600)
+
+FILES_DIR = 'chat_files'
+
+
+def archive_old_messages(days=RETENTION_DAYS, segment_size=ARCHIVE_SEGMENT_MESSAGES):
+    """Archive every dialog's messages older than `days`; returns (dialogs, messages) archived."""
+    cutoff = timezone.now() - timedelta(days=days)
+    dialogs = messages = 0
+    conversations = Conversation.objects.only('dialog_key', 'user_low', 'user_high', 'last_message') \
+        .order_by('pk')
+    for conversation in conversations.iterator():
+        if not PrivateMessage.objects.filter(dialog_key=conversation.dialog_key, timestamp__lt=cutoff).exists():
+            continue
+        moved = archive_dialog(conversation, cutoff, segment_size)
+        if moved:
+            dialogs += 1
+            messages += moved
+    return dialogs, messages
+
+
+def legacy_file_names():
+    """Files outside BLOB_DIR that messages refer to, hot or archived; blobs count their references."""
+    values = PrivateMessage.objects.exclude(Q(file='') | Q(file__isnull=True)) \
+        .exclude(file__startswith=BLOB_DIR + '/').exclude(file__startswith=settings.MEDIA_URL + BLOB_DIR + '/')
+    names = {Blob.name_from_file_value(value) for value in values.values_list('file', flat=True).distinct().iterator()}
+    names.update(Blob.name_from_file_value(value) for value in archived_file_names())
+    return {name for name in names if not name.startswith(BLOB_DIR + '/')}
+
+
+def clean_orphaned_files(grace_seconds=ORPHAN_GRACE_SECONDS, dry_run=False):
+    """Delete what nothing under chat_files/ needs any more; returns counts by kind."""
+    cutoff = timezone.now() - timedelta(seconds=grace_seconds)
+    root = os.path.join(settings.MEDIA_ROOT, FILES_DIR)
+    removed = {'blobs': 0, 'uploads': 0, 'thumbnails': 0, 'files': 0}
+    legacy = legacy_file_names()
+
+    def remove(path, kind):
+        removed[kind] += 1
+        if not dry_run:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # Blobs no message refers to, unless an upload finished with them recently.
+    recent = set(UploadSession.objects.filter(completed_at__gte=cutoff).values_list('blob_id', flat=True))
+    unreferenced = Blob.objects.filter(ref_count=0, created_at__lt=cutoff).exclude(pk__in=recent)
+    for blob in unreferenced.only('name').iterator():
+        # Still unreferenced when deleted, so a message sent meanwhile keeps its file.
+        if dry_run or Blob.objects.filter(pk=blob.pk, ref_count=0).delete()[0]:
+            remove(os.path.join(settings.MEDIA_ROOT, blob.name), 'blobs')
+
+    abandoned = UploadSession.objects.filter(completed_at__isnull=True, created_at__lt=cutoff)
+    for session in abandoned.iterator():
+        remove(partial_path(session), 'uploads')
+    if not dry_run:
+        abandoned.delete()
+
+    blobs = dict(Blob.objects.values_list('name', 'sha256'))
+    open_uploads = {f"{pk}.part" for pk in UploadSession.objects.filter(completed_at__isnull=True)
+                    .values_list('pk', flat=True)}
+    thumbnails = set()
+    old = cutoff.timestamp()
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+            if name.startswith(THUMBNAIL_DIR + '/'):
+                thumbnails.add(path)
+                continue
+            stat = os.stat(path)
+            if name.startswith(BLOB_DIR + '/'):
+                if name not in blobs and stat.st_mtime < old:
+                    remove(path, 'blobs')
+            elif name.startswith(PARTIAL_DIR + '/'):
+                if filename not in open_uploads and stat.st_mtime < old:
+                    remove(path, 'uploads')
+            elif name not in legacy and stat.st_mtime < old:
+                remove(path, 'files')
+
+    # Thumbnails are named after the file and its validator, see attachments.thumbnail_for.
+    keys = {thumbnail_key(name, blob_etag(Blob(sha256=sha256))) for name, sha256 in blobs.items()}
+    for name in legacy:
+        path = os.path.join(settings.MEDIA_ROOT, name)
+        if os.path.isfile(path):
+            keys.add(thumbnail_key(name, stat_etag(os.stat(path))))
+    for path in thumbnails:
+        if os.path.basename(path).split('-', 1)[0] not in keys and os.stat(path).st_mtime < old:
+            remove(path, 'thumbnails')
+    return removed
+
@@ -7,6 +7,7 @@ from .consumers import OnlineStatusConsumer
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<sender_username>\w+)/(?P<recipient_username>\w+)/$', consumers.PrivateChatConsumer.as_asgi(), name='chat'),
     re_path(r'ws/screenshare/$', consumers.ScreenShareConsumer.as_asgi()),
+    re_path(r'ws/screenshare/(?P<room_name>\w+)/$', consumers.ScreenShareConsumer.as_asgi()),
     re_path(r"ws/online_status/$", OnlineStatusConsumer.as_asgi()),
     re_path(r'ws/notifications/$', consumers.NotificationConsumer.as_asgi()),
 
@@ -0,0 +1,346 @@
+import base64
+import html
+import json
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import Q
+
+from .models import PrivateMessage
+
+SEARCH_PAGE_SIZE = getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 20)
+SEARCH_MAX_PAGE_SIZE = getattr(settings, 'CHAT_SEARCH_MAX_PAGE_SIZE', 100)
+SEARCH_SNIPPET_TOKENS = getattr(settings, 'CHAT_SEARCH_SNIPPET_TOKENS', 12)
+SEARCH_MAX_TERMS = 8
+# The fallback index (InvertedIndex) keeps this many of the newest messages per process.
+SEARCH_FALLBACK_MAX_MESSAGES = getattr(settings, 'CHAT_SEARCH_FALLBACK_MAX_MESSAGES', 200_000)
+SEARCH_FALLBACK_REBUILD_INTERVAL = getattr(settings, 'CHAT_SEARCH_FALLBACK_REBUILD_INTERVAL', 3600)
+
+FTS_TABLE = 'chat_privatemessage_fts'
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+# Markers that cannot appear in user text; they are swapped for <mark> after escaping.
+MARK_START, MARK_END = '\x02', '\x03'
+
+FTS_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        content, content='chat_privatemessage', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    # Triggers rather than save hooks, so bulk_create and raw SQL writes are indexed too.
+    f"""CREATE TRIGGER IF NOT EXISTS chat_privatemessage_fts_ai AFTER INSERT ON chat_privatemessage BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS chat_privatemessage_fts_ad AFTER DELETE ON chat_privatemessage BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS chat_privatemessage_fts_au AFTER UPDATE OF content ON chat_privatemessage BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+FTS_TRIGGERS = ('chat_privatemessage_fts_ai', 'chat_privatemessage_fts_ad', 'chat_privatemessage_fts_au')
+FTS_DROP = [
+    'DROP TRIGGER IF EXISTS chat_privatemessage_fts_au',
+    'DROP TRIGGER IF EXISTS chat_privatemessage_fts_ad',
+    'DROP TRIGGER IF EXISTS chat_privatemessage_fts_ai',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+]
+
+
+def fts_supported(db=connection):
+    if db.vendor != 'sqlite':
+        return False
+    with db.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def fts_installed(db=connection):
+    if db.vendor != 'sqlite':
+        return False
+    with db.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+def install_fts(db=connection, rebuild=True):
+    """Create the FTS5 table and its triggers, then index the existing messages."""
+    with db.cursor() as cursor:
+        for statement in FTS_SCHEMA:
+            cursor.execute(statement)
+        if rebuild:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def repair_fts_triggers(sender, using, **kwargs):
+    """post_migrate handler: SQLite ALTERs rebuild the messages table, which drops its triggers."""
+    db = connections[using]
+    if not fts_installed(db):
+        return
+    with db.cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (%s, %s, %s)", FTS_TRIGGERS
+        )
+        if cursor.fetchone()[0] == len(FTS_TRIGGERS):
+            return
+    install_fts(db)
+
+
+def drop_fts(db=connection):
+    with db.cursor() as cursor:
+        for statement in FTS_DROP:
+            cursor.execute(statement)
+
+
+def tokenize(text):
+    # Folds case and diacritics like the FTS5 unicode61 tokenizer does.
+    folded = ''.join(char for char in unicodedata.normalize('NFKD', text or '') if not unicodedata.combining(char))
+    return [token.lower() for token in TOKEN_PATTERN.findall(folded)]
+
+
+def query_terms(query):
+    terms = list(dict.fromkeys(tokenize(query)))
+    return terms[:SEARCH_MAX_TERMS]
+
+
+def fts_query(terms):
+    # Every term is quoted so user input can never be parsed as FTS5 syntax;
+    # the last one is a prefix match for search-as-you-type.
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def encode_cursor(offset, until_id):
+    raw = json.dumps([offset, until_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(offset, until_id): where the next page starts in the ranking of messages up to `until_id`."""
+    try:
+        offset, until_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        offset, until_id = int(offset), int(until_id)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    if offset < 0:
+        raise ValueError("Invalid cursor")
+    return offset, until_id
+
+
+def render_highlight(marked):
+    escaped = html.escape(marked)
+    return escaped.replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+class InvertedIndex:
+    """In-process fallback for databases without FTS5.
+
+    The index catches up incrementally on every search by reading messages
+    with a higher id than the last one it saw, so writes from other
+    processes show up too. It holds the newest `max_documents` messages,
+    evicting the oldest, and is rebuilt from the database every
+    `rebuild_interval` seconds so edits and deletions made elsewhere are
+    picked up; until then, hits are checked against the stored content.
+    """
+
+    def __init__(self, max_documents=SEARCH_FALLBACK_MAX_MESSAGES, rebuild_interval=SEARCH_FALLBACK_REBUILD_INTERVAL,
+                 batch_size=5000):
+        self.max_documents = max_documents
+        self.rebuild_interval = rebuild_interval
+        self.batch_size = batch_size
+        self.postings = defaultdict(dict)
+        # Message id to its distinct tokens, oldest message first.
+        self.tokens = OrderedDict()
+        self.last_id = None
+        self.built_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def documents(self):
+        return len(self.tokens)
+
+    def reset(self):
+        self.postings.clear()
+        self.tokens.clear()
+        # Only the newest max_documents messages are worth reading.
+        first = PrivateMessage.objects.order_by('-id').values_list('id', flat=True)[self.max_documents - 1:].first()
+        self.last_id = first - 1 if first is not None else 0
+        self.built_at = time.monotonic()
+
+    def catch_up(self):
+        with self._lock:
+            if self.last_id is None or time.monotonic() - self.built_at > self.rebuild_interval:
+                self.reset()
+            while True:
+                rows = list(
+                    PrivateMessage.objects.filter(id__gt=self.last_id).order_by('id')
+                    .values_list('id', 'content')[:self.batch_size]
+                )
+                if not rows:
+                    return
+                for message_id, content in rows:
+                    self.add(message_id, content)
+                self.last_id = rows[-1][0]
+                while len(self.tokens) > self.max_documents:
+                    self.remove(next(iter(self.tokens)))
+
+    def add(self, message_id, content):
+        self.remove(message_id)
+        counts = Counter(tokenize(content))
+        if not counts:
+            return
+        for token, count in counts.items():
+            self.postings[token][message_id] = count
+        self.tokens[message_id] = tuple(counts)
+
+    def remove(self, message_id):
+        for token in self.tokens.pop(message_id, ()):
+            postings = self.postings[token]
+            postings.pop(message_id, None)
+            if not postings:
+                del self.postings[token]
+
+    def matching_tokens(self, term, prefix):
+        if not prefix:
+            return [term] if term in self.postings else []
+        return [token for token in self.postings if token.startswith(term)]
+
+    def scores(self, terms):
+        """{message_id: score} for messages containing every term, higher is better."""
+        self.catch_up()
+        with self._lock:
+            scores = None
+            for position, term in enumerate(terms):
+                term_scores = defaultdict(float)
+                for token in self.matching_tokens(term, prefix=position == len(terms) - 1):
+                    postings = self.postings[token]
+                    idf = math.log(1 + len(self.tokens) / len(postings))
+                    for message_id, count in postings.items():
+                        term_scores[message_id] += count * idf
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {message_id: score + term_scores[message_id]
+                              for message_id, score in scores.items() if message_id in term_scores}
+                if not scores:
+                    return {}
+            return scores or {}
+
+
+inverted_index = InvertedIndex()
+
+
+def matches_terms(content, terms):
+    """Whether `content` still holds every term, the last one as a prefix, as the index matched it."""
+    tokens = set(tokenize(content))
+    *whole, last = terms
+    return all(term in tokens for term in whole) and any(token.startswith(last) for token in tokens)
+
+
+def scoped_messages(user, other=None):
+    if other is not None:
+        return PrivateMessage.objects.filter(dialog_key=PrivateMessage.make_dialog_key(user.pk, other.pk))
+    return PrivateMessage.objects.filter(Q(sender=user) | Q(recipient=user))
+
+
+def search_messages(user, query, other=None, cursor=None, limit=SEARCH_PAGE_SIZE, use_fts=None):
+    """Rank the user's messages against `query`.
+
+    Returns (results, next_cursor). Each result is (message, highlight_html);
+    results are ordered best match first, ties newest first. Without FTS5
+    the in-process InvertedIndex ranks them, over the newest
+    CHAT_SEARCH_FALLBACK_MAX_MESSAGES messages only.
+
+    The cursor is an offset into the ranking plus the newest message id the
+    first page saw; later pages leave out newer messages, so new arrivals
+    cannot shift results from one page onto the next.
+    """
+    limit = max(1, min(int(limit), SEARCH_MAX_PAGE_SIZE))
+    if cursor:
+        offset, until_id = decode_cursor(cursor)
+    else:
+        offset, until_id = 0, PrivateMessage.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    terms = query_terms(query)
+    if not terms:
+        return [], None
+    if use_fts is None:
+        use_fts = fts_installed()
+    if use_fts:
+        ids = fts_ranked_ids(user, other, terms, until_id, offset, limit + 1)
+    else:
+        ids = fallback_ranked_ids(user, other, terms, until_id, offset, limit + 1)
+
+    next_cursor = encode_cursor(offset + limit, until_id) if len(ids) > limit else None
+    ids = ids[:limit]
+    messages = PrivateMessage.objects.select_related('sender', 'recipient').in_bulk(ids)
+    highlights = fts_highlights(terms, ids) if use_fts else {}
+    results = []
+    for message_id in ids:
+        message = messages.get(message_id)
+        if message is None:
+            continue
+        marked = highlights.get(message_id) or mark_terms(message.content, terms)
+        results.append((message, render_highlight(marked)))
+    return results, next_cursor
+
+
+def fts_ranked_ids(user, other, terms, until_id, offset, limit):
+    if other is not None:
+        scope, params = 'm.dialog_key = %s', [PrivateMessage.make_dialog_key(user.pk, other.pk)]
+    else:
+        scope, params = '(m.sender_id = %s OR m.recipient_id = %s)', [user.pk, user.pk]
+    # bm25() is lower for better matches.
+    sql = f"""
+        SELECT m.id FROM {FTS_TABLE} JOIN chat_privatemessage m ON m.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH %s AND m.id <= %s AND {scope}
+        ORDER BY bm25({FTS_TABLE}), m.id DESC LIMIT %s OFFSET %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [fts_query(terms), until_id] + params + [limit, offset])
+        return [message_id for message_id, in cursor.fetchall()]
+
+
+def fts_highlights(terms, ids):
+    if not ids:
+        return {}
+    # Snippets only for the page being returned, not for every match.
+    placeholders = ', '.join(['%s'] * len(ids))
+    sql = f"""
+        SELECT rowid, snippet({FTS_TABLE}, 0, %s, %s, '…', %s)
+        FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid IN ({placeholders})
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [MARK_START, MARK_END, SEARCH_SNIPPET_TOKENS, fts_query(terms)] + ids)
+        return dict(cursor.fetchall())
+
+
+def fallback_ranked_ids(user, other, terms, until_id, offset, limit):
+    scores = inverted_index.scores(terms)
+    ranked = sorted((message_id for message_id, score in scores.items() if message_id <= until_id),
+                    key=lambda message_id: (-scores[message_id], -message_id))
+    allowed = scoped_messages(user, other)
+    visible = []
+    # Filter the candidates through the user's dialogs a chunk at a time. The content is checked
+    # too, in case the message was edited or deleted since it was indexed.
+    chunk_size = max(limit * 4, 100)
+    for start in range(0, len(ranked), chunk_size):
+        chunk = ranked[start:start + chunk_size]
+        contents = dict(allowed.filter(id__in=chunk).values_list('id', 'content'))
+        visible.extend(message_id for message_id in chunk
+                       if message_id in contents and matches_terms(contents[message_id], terms))
+        if len(visible) >= offset + limit:
+            break
+    return visible[offset:offset + limit]
+
+
+def mark_terms(content, terms):
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(term) for term in terms) + r')\w*', re.IGNORECASE)
+    return pattern.sub(lambda match: MARK_START + match.group(0) + MARK_END, content or '')
@@ -0,0 +1,144 @@
+"""Daphne with the chat's WebSocket options applied.
+
+Run with ``python -m chat.server`` and the usual daphne arguments, e.g.
+``python -m chat.server -b 0.0.0.0 -p 8000 chat_project.asgi:application``.
+"""
+import logging
+import os
+
+import django
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from daphne.ws_protocol import WebSocketProtocol
+from django.conf import settings
+from twisted.internet.interfaces import IPushProducer
+
+# Named explicitly: this module usually runs as __main__.
+logger = logging.getLogger('chat.server')
+
+
+def permessage_deflate_accept(options):
+    """An autobahn perMessageCompressionAccept callback for CHAT_WS_PERMESSAGE_DEFLATE."""
+    from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+
+    def accept(offers):
+        for offer in offers:
+            if isinstance(offer, PerMessageDeflateOffer):
+                return PerMessageDeflateOfferAccept(
+                    offer,
+                    request_no_context_takeover=options.get('request_no_context_takeover', False),
+                    no_context_takeover=options.get('no_context_takeover'),
+                    window_bits=options.get('window_bits'),
+                    mem_level=options.get('mem_level'),
+                    max_message_size=options.get('max_message_size'),
+                )
+        return None
+
+    return accept
+
+
+def configure_permessage_deflate(ws_factory, options=None):
+    # CHAT_WS_PERMESSAGE_DEFLATE keys: enabled, window_bits (9-15), mem_level (1-9),
+    # no_context_takeover, request_no_context_takeover, max_message_size. Off unless
+    # enabled; dropping context takeover trades ratio for memory per socket. Read
+    # here rather than at import so `python -m chat.server` can set up settings first.
+    if options is None:
+        options = getattr(settings, 'CHAT_WS_PERMESSAGE_DEFLATE', {})
+    if options.get('enabled'):
+        ws_factory.setProtocolOptions(perMessageCompressionAccept=permessage_deflate_accept(options))
+
+
+class ChatWebSocketProtocol(WebSocketProtocol):
+    """Daphne's WebSocket protocol with a bound on what is queued for a client that does not read.
+
+    Twisted pauses a socket's producer once its write buffer is past the
+    high-water mark. While paused, frames beyond the factory's
+    `slow_consumer_buffer` bytes are dropped, or the connection is aborted, per
+    its `slow_consumer_action`.
+    """
+    congested = False
+    queued_while_congested = 0
+
+    def onOpen(self):
+        super().onOpen()
+        # The HTTP channel the upgrade came through is still registered as the producer.
+        self.network_producer = IPushProducer(self.transport, None)
+        self.unregisterProducer()
+        self.registerProducer(self, True)
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        if self.congested:
+            return
+        self.congested = True
+        self.queued_while_congested = 0
+        # Stop reading from the client too, as the HTTP channel did.
+        if self.network_producer is not None:
+            self.network_producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.congested = False
+        if self.network_producer is not None:
+            self.network_producer.resumeProducing()
+
+    def stopProducing(self):
+        pass
+
+    def serverSend(self, content, binary=False):
+        if self.state == self.STATE_CLOSED:
+            return
+        if self.congested:
+            self.queued_while_congested += len(content)
+            if self.queued_while_congested > self.factory.slow_consumer_buffer:
+                self.shed(len(content))
+                return
+        super().serverSend(content, binary)
+
+    def shed(self, size):
+        from .throttling import throttle_counters
+        if self.factory.slow_consumer_action == 'drop':
+            throttle_counters['slow_dropped'] += 1
+            self.queued_while_congested -= size
+            return
+        throttle_counters['slow_closed'] += 1
+        logger.warning("Closing %s: more than %s bytes queued", self.client_addr, self.factory.slow_consumer_buffer)
+        # Abort rather than close: a close frame would wait behind everything already queued.
+        self.dropConnection(abort=True)
+
+
+def configure_backpressure(ws_factory):
+    # Read here, like CHAT_WS_PERMESSAGE_DEFLATE, once settings are set up.
+    from .throttling import SLOW_CONSUMER_ACTION, SLOW_CONSUMER_BUFFER
+    ws_factory.protocol = ChatWebSocketProtocol
+    ws_factory.slow_consumer_buffer = SLOW_CONSUMER_BUFFER
+    ws_factory.slow_consumer_action = SLOW_CONSUMER_ACTION
+
+
+class ChatServer(Server):
+    """daphne.server.Server that configures its WebSocket factory as soon as run() creates it."""
+
+    @property
+    def ws_factory(self):
+        return self._ws_factory
+
+    @ws_factory.setter
+    def ws_factory(self, factory):
+        self._ws_factory = factory
+        configure_permessage_deflate(factory)
+        configure_backpressure(factory)
+
+
+class ChatCommandLineInterface(CommandLineInterface):
+    server_class = ChatServer
+
+
+def main():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.settings')
+    # chat_project.asgi imports the consumers before it sets Django up itself.
+    django.setup()
+    ChatCommandLineInterface.entrypoint()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import re
+
+from django.conf import settings
+from django.core.cache import caches
+
+SCREENSHARE_MAX_PEERS = getattr(settings, 'CHAT_SCREENSHARE_MAX_PEERS', 4)
+SCREENSHARE_CANDIDATE_WINDOW = getattr(settings, 'CHAT_SCREENSHARE_CANDIDATE_WINDOW', 0.05)
+SCREENSHARE_CANDIDATE_BATCH = getattr(settings, 'CHAT_SCREENSHARE_CANDIDATE_BATCH', 20)
+# Peers that signal less often than this lose their seat; a running share re-signals on renegotiation.
+SCREENSHARE_SEAT_TIMEOUT = getattr(settings, 'CHAT_SCREENSHARE_SEAT_TIMEOUT', 6 * 60 * 60)
+# Signals refresh their peer's seat at most this often.
+SEAT_TOUCH_INTERVAL = 60
+SIGNALING_CACHE = getattr(settings, 'CHAT_SIGNALING_CACHE', 'default')
+DEFAULT_ROOM = 'lobby'
+
+
+class RoomFull(Exception):
+    pass
+
+
+class SignalingRooms:
+    """Screen-share peers of every worker, room -> {peer_id: channel_name}.
+
+    Peers address each other by peer id; the registry maps that to the
+    channel name so signals go straight to one peer instead of the room.
+    A room is `max_peers` seats in CHAT_SIGNALING_CACHE, each taken with an
+    atomic cache add, so the cap holds across workers without sticky routing.
+    A seat expires `seat_timeout` seconds after its peer last signalled,
+    which frees the seats of a worker that crashed.
+    """
+
+    def __init__(self, max_peers=SCREENSHARE_MAX_PEERS, cache_alias=SIGNALING_CACHE, seat_timeout=SCREENSHARE_SEAT_TIMEOUT):
+        self.max_peers = max_peers
+        self.cache_alias = cache_alias
+        self.seat_timeout = seat_timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def seat_keys(self, room):
+        return [f"chat:signaling:{room_group_name(room)}:{seat}" for seat in range(self.max_peers)]
+
+    async def seats(self, room):
+        """{peer_id: (seat key, channel_name)} for the peers in the room."""
+        taken = await self.cache.aget_many(self.seat_keys(room))
+        return {peer_id: (key, channel_name) for key, (peer_id, channel_name) in taken.items()}
+
+    async def join(self, room, peer_id, channel_name):
+        for key in self.seat_keys(room):
+            if await self.cache.aadd(key, (peer_id, channel_name), timeout=self.seat_timeout):
+                return
+        raise RoomFull(f"Room {room!r} already has {self.max_peers} peers")
+
+    async def leave(self, room, peer_id):
+        seat = (await self.seats(room)).get(peer_id)
+        if seat is not None:
+            await self.cache.adelete(seat[0])
+
+    async def touch(self, room, peer_id):
+        seat = (await self.seats(room)).get(peer_id)
+        if seat is not None:
+            await self.cache.atouch(seat[0], self.seat_timeout)
+
+    async def peers(self, room, exclude=None):
+        return [peer_id for peer_id in await self.seats(room) if peer_id != exclude]
+
+    async def channel_for(self, room, peer_id):
+        seat = (await self.seats(room)).get(peer_id)
+        return seat[1] if seat is not None else None
+
+
+signaling_rooms = SignalingRooms()
+
+
+def room_group_name(room_name):
+    # Group names only allow a limited alphabet, and the room comes from the URL.
+    return 'screenshare_' + re.sub(r'[^\w.-]', '_', room_name)[:80]
@@ -0,0 +1,119 @@
+import asyncio
+import base64
+from collections import namedtuple
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .database import db_read
+from .history import dialog_messages
+from .models import Conversation, PrivateMessage
+
+SYNC_PAGE_SIZE = getattr(settings, 'CHAT_SYNC_PAGE_SIZE', 200)
+SYNC_MAX_WAIT = getattr(settings, 'CHAT_SYNC_MAX_WAIT', 30)
+
+
+def chat_group_name(username_a, username_b):
+    """The channel layer group PrivateChatConsumer uses for a dialog."""
+    low, high = sorted((username_a, username_b))
+    return f"chat_chat_{low}_{high}"
+
+
+class SyncState(namedtuple('SyncState', 'last_seq read_low read_high')):
+    """What a client has seen of a dialog: the seq of its newest message and both read watermarks.
+
+    Positions are seqs rather than timestamps: seqs are handed out in commit
+    order, so a message imported later with an older timestamp is still after
+    every token issued before it. Encoded as an opaque token; equal tokens mean
+    there is nothing new.
+    """
+
+    def encode(self):
+        raw = f"{self.last_seq}|{self.read_low}|{self.read_high}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @classmethod
+    def decode(cls, token):
+        # Raises ValueError for anything that was not produced by encode().
+        try:
+            last_seq, read_low, read_high = base64.urlsafe_b64decode(token.encode()).decode().split('|')
+            return cls(int(last_seq), int(read_low), int(read_high))
+        except (UnicodeError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid sync token: {token!r}") from e
+
+
+EMPTY_STATE = SyncState(0, 0, 0)
+
+
+def dialog_state(user, other):
+    """Current SyncState of the dialog, from its Conversation row alone."""
+    row = Conversation.objects.filter(dialog_key=PrivateMessage.make_dialog_key(user.pk, other.pk)) \
+        .values_list('last_seq', 'read_up_to_low', 'read_up_to_high').first()
+    return SyncState(*row) if row is not None else EMPTY_STATE
+
+
+def state_after_message(user, other, message_id):
+    """SyncState for a client that only knows the id of the last message it has."""
+    last = dialog_messages(user, other).filter(pk=message_id).only('seq').first()
+    if last is None:
+        raise ValueError(f"No message {message_id} in this dialog")
+    # Read watermarks are unknown, so the first delta always reports them.
+    return SyncState(last.seq or 0, -1, -1)
+
+
+def get_delta(user, other, since, limit=SYNC_PAGE_SIZE):
+    """Messages after `since` (oldest first) and the state token to send next time.
+
+    Returns (messages, state, has_more). When has_more is set the client should
+    call again straight away with the returned state.
+    """
+    limit = max(1, min(int(limit), SYNC_PAGE_SIZE))
+    # A range scan of the (dialog_key, seq) unique index.
+    messages = dialog_messages(user, other).filter(seq__gt=since.last_seq).select_related('sender')
+    page = list(messages.order_by('seq')[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    current = dialog_state(user, other)
+    # The token only advances past messages actually returned, so nothing written
+    # between the two queries can be skipped.
+    last_seq = page[-1].seq if page else since.last_seq
+    return page, current._replace(last_seq=last_seq), has_more
+
+
+async def wait_for_change(user, other, state, timeout):
+    """Block until the dialog's state differs from `state` or `timeout` expires.
+
+    Wakes up on the dialog's channel layer group rather than polling, so an
+    idle long-poll costs one database read at each end. Messages and read
+    receipts are only broadcast once committed, so one read after a wake-up
+    sees the change.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(timeout, SYNC_MAX_WAIT)
+    layer = get_channel_layer()
+    if layer is None:
+        current = await db_read(dialog_state)(user, other)
+        while current == state and loop.time() < deadline:
+            await asyncio.sleep(min(1.0, max(0, deadline - loop.time())))
+            current = await db_read(dialog_state)(user, other)
+        return current
+
+    group = chat_group_name(user.username, other.username)
+    channel = await layer.new_channel('sync.')
+    # Join before the first check so a change in between still wakes us up.
+    await layer.group_add(group, channel)
+    try:
+        current = await db_read(dialog_state)(user, other)
+        while current == state:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(layer.receive(channel), remaining)
+            except asyncio.TimeoutError:
+                break
+            current = await db_read(dialog_state)(user, other)
+    finally:
+        await layer.group_discard(group, channel)
+    return current
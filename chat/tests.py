@@ -0,0 +1,976 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock, skipIf
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from chat.archive import find_archived_message
+from chat.attachments import Image, RangeNotSatisfiable, parse_range
+from chat.benchmarks import BENCHMARK_CACHES, BENCHMARK_CHANNEL_LAYERS, run_scenario
+from chat.consumers import PrivateChatConsumer
+from chat.export import export_chunks, export_pages, import_records, read_records
+from chat.history import get_history_page
+from chat.ipc import UnixSocketChannelLayer
+from chat.layers import LocalFirstChannelLayer
+from chat.models import ArchivedSegment, Blob, Conversation, PrivateMessage, UserStatus
+from chat.notifications import stored_unread
+from chat.persistence import MessageWriter, WriteQueueFull, insert_messages, message_record
+from chat.presence import (
+    SUPERUSER_WATCHERS_GROUP, close_connection, open_connection, reconcile_stale_statuses,
+)
+from chat.replay import ReplayBuffers, message_event
+from chat.retention import archive_old_messages, clean_orphaned_files
+from chat.routing import websocket_urlpatterns
+from chat.search import InvertedIndex, fts_installed, search_messages
+from chat.signaling import RoomFull, SignalingRooms
+from chat.sync import chat_group_name
+from chat.throttling import RATE_LIMIT_CLOSE_CODE, TokenBucket, UserBuckets, throttle_counters
+from chat.uploads import UploadConflict, append_chunk, start_upload
+from chat.utils import MessageLog
+
+
+def save_messages(sender, recipient, *contents):
+    dialog_key = PrivateMessage.make_dialog_key(sender.pk, recipient.pk)
+    return insert_messages([
+        PrivateMessage(sender=sender, recipient=recipient, dialog_key=dialog_key, content=content)
+        for content in contents
+    ])
+
+
+# Nothing here may need Redis.
+@override_settings(CACHES=BENCHMARK_CACHES, CHANNEL_LAYERS=BENCHMARK_CHANNEL_LAYERS['inmemory'])
+class BenchmarkScenarioTests(TransactionTestCase):
+    """The benchmark scenarios build their events by hand; a small run catches them drifting from the consumers."""
+
+    def test_notifications(self):
+        result = run_scenario('notifications', clients=2, messages=3)
+        self.assertEqual(result['delivered'], 6)
+
+    def test_private_chat(self):
+        result = run_scenario('private_chat', pairs=2, messages=3)
+        self.assertEqual((result['sent'], result['delivered']), (6, 6))
+
+    def test_online_status(self):
+        result = run_scenario('online_status', watchers=2, clients=3)
+        self.assertEqual(result['delivered'], 6)
+
+    def test_screenshare(self):
+        result = run_scenario('screenshare', rooms=2, peers=2, signals=2)
+        self.assertEqual((result['sent'], result['delivered']), (8, 8))
+
+    def test_fanout(self):
+        result = run_scenario('fanout', watchers=2, broadcasts=2, changes=2)
+        self.assertEqual(result['delivered'], 4)
+
+
+class ParseRangeTests(SimpleTestCase):
+
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-5000', 1000), (0, 999))
+        self.assertEqual(parse_range('bytes=990-2000', 1000), (990, 999))
+
+    def test_whole_file(self):
+        self.assertIsNone(parse_range('bytes=0-1,5-9', 1000))
+        self.assertIsNone(parse_range('items=0-1', 1000))
+        self.assertIsNone(parse_range('bytes=-', 1000))
+
+    def test_not_satisfiable(self):
+        for header in ('bytes=1000-', 'bytes=5-4', 'bytes=-0'):
+            with self.subTest(header=header), self.assertRaises(RangeNotSatisfiable):
+                parse_range(header, 1000)
+
+
+@override_settings(CACHES=BENCHMARK_CACHES)
+class MessageWriterTests(TransactionTestCase):
+    """The writer runs its batches on the database writer thread, hence TransactionTestCase."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+
+    def test_full_batch_is_written_at_once(self):
+        async def main():
+            writer = MessageWriter(batch_size=3, flush_interval=60)
+            futures = [await writer.submit(self.alice.pk, self.bob.pk, f"m{n}") for n in range(3)]
+            saved = await asyncio.wait_for(asyncio.gather(*futures), 5)
+            await writer.aclose()
+            return saved, writer.batches
+
+        saved, batches = asyncio.run(main())
+        self.assertEqual([message.seq for message in saved], [1, 2, 3])
+        self.assertEqual(batches, 1)
+        self.assertEqual(Conversation.objects.get().last_seq, 3)
+
+    def test_partial_batch_is_written_after_interval(self):
+        async def main():
+            writer = MessageWriter(batch_size=100, flush_interval=0.05)
+            message = await asyncio.wait_for(await writer.submit('alice', 'bob', "hi"), 5)
+            await writer.aclose()
+            return message
+
+        self.assertEqual(asyncio.run(main()).content, "hi")
+
+    def test_full_queue_rejects(self):
+        async def main():
+            writer = MessageWriter(batch_size=100, flush_interval=60, max_pending=1, enqueue_timeout=0.01)
+            first = await writer.submit(self.alice.pk, self.bob.pk, "first")
+            with self.assertRaises(WriteQueueFull):
+                await writer.submit(self.alice.pk, self.bob.pk, "second")
+            # Closing writes what was accepted.
+            await writer.aclose()
+            return first.result()
+
+        self.assertEqual(asyncio.run(main()).content, "first")
+        self.assertEqual(PrivateMessage.objects.count(), 1)
+
+
+class ReplayBufferTests(SimpleTestCase):
+
+    def test_duplicates_and_gaps(self):
+        buffers = ReplayBuffers(size=10)
+        for seq in (1, 2, 2, 3):
+            buffers.record('room', {'seq': seq})
+        self.assertEqual([event['seq'] for event in buffers.events_after('room', 1, 3)], [2, 3])
+        # A gap starts the run again, so the buffer no longer covers seq 2.
+        buffers.record('room', {'seq': 5})
+        self.assertIsNone(buffers.events_after('room', 1, 5))
+        self.assertEqual(buffers.events_after('room', 4, 5), [{'seq': 5}])
+
+
+@override_settings(CACHES=BENCHMARK_CACHES, CHANNEL_LAYERS=BENCHMARK_CHANNEL_LAYERS['inmemory'])
+class ResumeTests(TransactionTestCase):
+    """Reconnecting with ?resume_from=<seq> replays the gap once, then only newer live events."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.saved = save_messages(self.alice, self.bob, "one", "two", "three")
+
+    async def connect(self, resume_from, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns),
+                                             f"/ws/chat/bob/alice/?resume_from={resume_from}")
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def resume(self, resume_from):
+        communicator, connected = await self.connect(resume_from, self.bob)
+        self.assertTrue(connected)
+        return communicator
+
+    async def live(self, message):
+        await get_channel_layer().group_send(chat_group_name('alice', 'bob'), message_event(message, 'alice', 'bob'))
+
+    async def received_seqs(self, communicator):
+        seqs = []
+        while not await communicator.receive_nothing(0.2):
+            seqs.append(json.loads(await communicator.receive_from())['seq'])
+        return seqs
+
+    def test_replays_gap_and_drops_repeated_live_events(self):
+        async def main():
+            communicator = await self.resume(1)
+            replayed = await self.received_seqs(communicator)
+            # Already replayed; another consumer's broadcast of it arrives late.
+            await self.live(self.saved[2])
+            newer = (await asyncio.to_thread(save_messages, self.alice, self.bob, "four"))[0]
+            await self.live(newer)
+            live = await self.received_seqs(communicator)
+            await communicator.disconnect()
+            return replayed, live
+
+        self.assertEqual(asyncio.run(main()), ([2, 3], [4]))
+
+    def test_resume_past_latest_is_clamped(self):
+        async def main():
+            communicator = await self.resume(99)
+            replayed = await self.received_seqs(communicator)
+            newer = (await asyncio.to_thread(save_messages, self.alice, self.bob, "four"))[0]
+            await self.live(newer)
+            live = await self.received_seqs(communicator)
+            await communicator.disconnect()
+            return replayed, live
+
+        self.assertEqual(asyncio.run(main()), ([], [4]))
+
+    def test_only_the_sender_may_connect(self):
+        # Anyone else would be sent the dialog's history.
+        for user in (AnonymousUser(), self.alice):
+            with self.subTest(user=user):
+                communicator, connected = asyncio.run(self.connect(0, user))
+                self.assertFalse(connected)
+
+
+@override_settings(CACHES=BENCHMARK_CACHES, CHANNEL_LAYERS=BENCHMARK_CHANNEL_LAYERS['inmemory'])
+class ReadReceiptTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.saved = save_messages(self.alice, self.bob, "one", "two", "three")
+
+    def test_receipt_marks_up_to_watermark(self):
+        async def main():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/bob/alice/")
+            communicator.scope['user'] = self.bob
+            await communicator.connect()
+            await communicator.send_to(text_data=json.dumps({'type': 'read', 'up_to': self.saved[1].pk}))
+            event = json.loads(await communicator.receive_from(timeout=2))
+            await communicator.disconnect()
+            return event
+
+        event = asyncio.run(main())
+        self.assertEqual((event['type'], event['reader'], event['up_to']), ('read_receipt', 'bob', self.saved[1].pk))
+        self.assertEqual(list(PrivateMessage.objects.order_by('seq').values_list('is_read', flat=True)),
+                         [True, True, False])
+        self.assertEqual(stored_unread(Conversation.objects.get(), self.bob.pk), 1)
+
+    def test_receipt_from_another_user_is_rejected(self):
+        consumer = PrivateChatConsumer()
+        consumer.scope = {'user': self.alice}
+        consumer.sender_user = self.bob
+        consumer.read_flush = None
+        sent = []
+
+        async def send_event(event, frames=None):
+            sent.append(event)
+
+        consumer.send_event = send_event
+        asyncio.run(consumer.queue_read_receipt(None))
+        self.assertEqual(sent, [{'error': 'Not allowed'}])
+        self.assertIsNone(consumer.read_flush)
+        self.assertFalse(PrivateMessage.objects.filter(is_read=True).exists())
+
+
+@override_settings(CACHES=BENCHMARK_CACHES)
+class ReplayMessageLogTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.blob = Blob.objects.create(sha256='0' * 64, name='chat_files/blobs/00/00/' + '0' * 64, size=1)
+        dialog_key = PrivateMessage.make_dialog_key(self.alice.pk, self.bob.pk)
+        saved = insert_messages([
+            PrivateMessage(sender=self.alice, recipient=self.bob, dialog_key=dialog_key, content=content, file=file)
+            for content, file in (("one", ''), ("two", self.blob.name), ("three", ''))
+        ])
+        log = MessageLog(self.directory)
+        log.append_many([message_record(message) for message in saved])
+        log.close()
+        # The database is lost, the log is what is left.
+        Conversation.objects.all().delete()
+        PrivateMessage.objects.all().delete()
+
+    def replay(self):
+        out = io.StringIO()
+        call_command('replay_message_log', '--import', directory=self.directory, stdout=out)
+        return out.getvalue().strip()
+
+    def test_live_messages_follow_replayed_ones(self):
+        self.assertEqual(self.replay(), "Replayed 3 record(s), 3 new.")
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.last_seq, 3)
+        self.assertEqual(conversation.last_message.content, "three")
+        self.assertEqual(stored_unread(conversation, self.bob.pk), 3)
+        self.blob.refresh_from_db()
+        self.assertEqual(self.blob.ref_count, 1)
+
+        live = save_messages(self.bob, self.alice, "four")[0]
+        self.assertEqual(live.seq, 4)
+
+        # Replaying again adds nothing, not even to the counts.
+        self.assertEqual(self.replay(), "Replayed 3 record(s), 0 new.")
+        self.blob.refresh_from_db()
+        self.assertEqual(self.blob.ref_count, 1)
+        self.assertEqual(PrivateMessage.objects.count(), 4)
+
+
+def upload(user, filename, data):
+    session = start_upload(user, filename, len(data))
+    return append_chunk(session, 0, [data]).blob
+
+
+# A 1x1 PNG.
+PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==')
+
+
+@override_settings(CACHES=BENCHMARK_CACHES, CHANNEL_LAYERS=BENCHMARK_CHANNEL_LAYERS['inmemory'])
+class AttachmentTests(TransactionTestCase):
+    """Attachments are served to the dialog's participants only, and only images get thumbnails."""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carol = User.objects.create(username='carol')
+        self.image = upload(self.alice, 'dot.png', PNG)
+        self.document = upload(self.alice, 'notes.pdf', b'%PDF-1.4 ' + b'x' * 5000)
+        dialog_key = PrivateMessage.make_dialog_key(self.alice.pk, self.bob.pk)
+        self.image_message, self.document_message = insert_messages([
+            PrivateMessage(sender=self.alice, recipient=self.bob, dialog_key=dialog_key, content='', file=blob.name)
+            for blob in (self.image, self.document)
+        ])
+
+    def get(self, user, name, message, **params):
+        self.client.force_login(user)
+        return self.client.get(reverse(name, args=[message.pk]), params)
+
+    def test_participants_only(self):
+        response = self.get(self.bob, 'attachment', self.document_message)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'%PDF-1.4 ' + b'x' * 5000)
+        self.assertEqual(self.get(self.carol, 'attachment', self.document_message).status_code, 404)
+
+    def test_blob_uploaded_by_someone_else(self):
+        # Bob names Alice's blob in his own message; it is not his to attach.
+        dialog_key = PrivateMessage.make_dialog_key(self.bob.pk, self.carol.pk)
+        message = insert_messages([PrivateMessage(
+            sender=self.bob, recipient=self.carol, dialog_key=dialog_key, content='', file=self.document.name,
+        )])[0]
+        self.assertEqual(self.get(self.carol, 'attachment', message).status_code, 404)
+
+    @skipIf(Image is None, "Pillow is not installed")
+    def test_thumbnails_only_for_images(self):
+        response = self.get(self.bob, 'attachment_thumbnail', self.image_message)
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'image/jpeg'))
+        self.assertEqual(self.get(self.bob, 'attachment_thumbnail', self.document_message).status_code, 404)
+
+    def test_payload_flags_images(self):
+        self.client.force_login(self.bob)
+        messages = self.client.get(reverse('fetch_new_messages', args=['alice'])).json()['messages']
+        flags = {message['id']: (message['is_image'], message['thumbnail_url'] is not None) for message in messages}
+        self.assertEqual(flags, {self.image_message.pk: (True, True), self.document_message.pk: (False, False)})
+        page = self.client.get(reverse('chat', args=['alice'])).content.decode()
+        self.assertIn(reverse('attachment_thumbnail', args=[self.image_message.pk]), page)
+        self.assertNotIn(reverse('attachment_thumbnail', args=[self.document_message.pk]), page)
+
+    def test_socket_rejects_files_the_sender_did_not_upload(self):
+        async def main():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/bob/alice/")
+            communicator.scope['user'] = self.bob
+            await communicator.connect()
+            await communicator.send_to(text_data=json.dumps(
+                {'message': 'mine now', 'file_url': self.image.name, 'client_id': 'c1'}
+            ))
+            event = json.loads(await communicator.receive_from(timeout=2))
+            await communicator.disconnect()
+            return event
+
+        self.assertEqual(asyncio.run(main()), {'error': 'File not found', 'client_id': 'c1'})
+
+
+@override_settings(CACHES=BENCHMARK_CACHES)
+class SearchTests(TestCase):
+    """The same expectations hold for the FTS5 index and the in-process fallback."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carol = User.objects.create(username='carol')
+        save_messages(self.alice, self.bob, "lunch today?", "Lunch lunch LUNCH", "no thanks", "<b>lunchbox</b>")
+        save_messages(self.carol, self.bob, "lunch with carol")
+        self.index = InvertedIndex()
+        self.enterContext(mock.patch('chat.search.inverted_index', self.index))
+
+    def search(self, use_fts, query, **options):
+        results, cursor = search_messages(self.alice, query, use_fts=use_fts, **options)
+        return [message.content for message, _ in results], cursor
+
+    def backends(self):
+        return (True, False) if fts_installed() else (False,)
+
+    def test_ranked_and_scoped(self):
+        for use_fts in self.backends():
+            with self.subTest(fts=use_fts):
+                contents, _ = self.search(use_fts, 'lunch')
+                # Carol's dialog is not Alice's; the last term matches as a prefix.
+                self.assertEqual(contents[0], "Lunch lunch LUNCH")
+                self.assertCountEqual(contents, ["Lunch lunch LUNCH", "lunch today?", "<b>lunchbox</b>"])
+                self.assertEqual(self.search(use_fts, 'lunch', other=self.carol)[0], [])
+
+    def test_highlight_is_escaped(self):
+        for use_fts in self.backends():
+            with self.subTest(fts=use_fts):
+                results, _ = search_messages(self.alice, 'lunchbox', use_fts=use_fts)
+                self.assertEqual(results[0][1], '&lt;b&gt;<mark>lunchbox</mark>&lt;/b&gt;')
+
+    def test_pages_do_not_shift(self):
+        for use_fts in self.backends():
+            with self.subTest(fts=use_fts):
+                first, cursor = self.search(use_fts, 'lunch', limit=2)
+                # A better match arriving between pages waits for the next search.
+                new = save_messages(self.bob, self.alice, "lunch lunch lunch lunch")[0]
+                second, cursor = self.search(use_fts, 'lunch', limit=2, cursor=cursor)
+                self.assertIsNone(cursor)
+                self.assertCountEqual(first + second, ["Lunch lunch LUNCH", "lunch today?", "<b>lunchbox</b>"])
+                new.delete()
+
+    def test_fallback_drops_edited_messages(self):
+        self.search(False, 'lunch')
+        PrivateMessage.objects.filter(content="lunch today?").update(content="dinner today?")
+        self.assertCountEqual(self.search(False, 'lunch')[0], ["Lunch lunch LUNCH", "<b>lunchbox</b>"])
+
+    def test_fallback_keeps_newest_messages(self):
+        self.index.max_documents = 2
+        self.assertEqual(self.search(False, 'lunch')[0], ["<b>lunchbox</b>"])
+        self.assertEqual(self.index.documents, 2)
+
+
+@override_settings(CACHES=BENCHMARK_CACHES)
+class RetentionTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.kept_blob = upload(self.alice, 'kept.txt', b'kept')
+        self.orphan_blob = upload(self.alice, 'orphan.txt', b'orphan')
+        dialog_key = PrivateMessage.make_dialog_key(self.alice.pk, self.bob.pk)
+        old = timezone.now() - timedelta(days=400)
+        rows = [
+            (self.alice, self.bob, "m0", self.kept_blob.name, True),
+            (self.bob, self.alice, "m1", '', True),
+            (self.bob, self.alice, "m2", '', False),
+            (self.alice, self.bob, "m3", '', True),
+            (self.alice, self.bob, "m4", '', True),
+        ]
+        self.saved = insert_messages([
+            PrivateMessage(sender=sender, recipient=recipient, dialog_key=dialog_key, content=content, file=file,
+                           is_read=is_read, timestamp=old + timedelta(minutes=n))
+            for n, (sender, recipient, content, file, is_read) in enumerate(rows)
+        ])
+
+    def hot(self):
+        return list(PrivateMessage.objects.order_by('seq').values_list('content', flat=True))
+
+    def history(self):
+        contents, cursor = [], None
+        while True:
+            page, cursor = get_history_page(self.alice, self.bob, before=cursor, limit=2)
+            contents += [(message.content, message.seq) for message in page]
+            if cursor is None:
+                return contents[::-1]
+
+    def test_archive_stops_at_unread_and_last_message(self):
+        self.assertEqual(archive_old_messages(days=180), (1, 2))
+        self.assertEqual(self.hot(), ["m2", "m3", "m4"])
+        PrivateMessage.mark_read_up_to(self.alice.pk, self.bob.pk)
+        self.assertEqual(archive_old_messages(days=180), (1, 2))
+        # The conversation still points at its last message.
+        self.assertEqual(self.hot(), ["m4"])
+        self.assertEqual(ArchivedSegment.objects.get().message_count, 4)
+
+    def test_history_continues_into_archive(self):
+        archive_old_messages(days=180)
+        self.assertEqual(self.history(), [(f"m{n}", n + 1) for n in range(5)])
+        archived = find_archived_message(self.bob, self.saved[0].pk)
+        self.assertEqual((archived.content, archived.file.name), ("m0", self.kept_blob.name))
+
+    def test_archived_references_keep_blobs(self):
+        archive_old_messages(days=180)
+        self.kept_blob.refresh_from_db()
+        self.assertEqual(self.kept_blob.ref_count, 1)
+        # A negative grace period makes everything old enough.
+        removed = clean_orphaned_files(grace_seconds=-60)
+        self.assertEqual(removed['blobs'], 1)
+        self.assertEqual(list(Blob.objects.values_list('pk', flat=True)), [self.kept_blob.pk])
+        self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, self.kept_blob.name)))
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, self.orphan_blob.name)))
+
+    def test_dry_run_deletes_nothing(self):
+        self.assertEqual(clean_orphaned_files(grace_seconds=-60, dry_run=True)['blobs'], 1)
+        self.assertEqual(Blob.objects.count(), 2)
+
+
+@override_settings(CACHES=BENCHMARK_CACHES, CHANNEL_LAYERS=BENCHMARK_CHANNEL_LAYERS['inmemory'])
+class DeltaSyncTests(TransactionTestCase):
+    """fetch_new_messages with `since` or `sync`: deltas by seq, 304 when unchanged, long-polling."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.saved = save_messages(self.alice, self.bob, "one", "two", "three")
+        self.client.force_login(self.bob)
+        self.url = reverse('fetch_new_messages', args=['alice'])
+
+    def test_delta_then_not_modified(self):
+        response = self.client.get(self.url, {'since': self.saved[0].pk})
+        self.assertEqual([message['content'] for message in response.json()['messages']], ["two", "three"])
+        token = response.json()['sync']
+        self.assertEqual(response['ETag'], f'"{token}"')
+
+        self.assertEqual(self.client.get(self.url, {'sync': token}).status_code, 304)
+        self.assertEqual(self.client.get(self.url, headers={'If-None-Match': f'"{token}"'}).status_code, 304)
+
+        save_messages(self.alice, self.bob, "four")
+        response = self.client.get(self.url, {'sync': token})
+        self.assertEqual([message['content'] for message in response.json()['messages']], ["four"])
+
+    def test_paged_delta(self):
+        response = self.client.get(self.url, {'since': self.saved[0].pk, 'limit': 1}).json()
+        self.assertEqual(([m['content'] for m in response['messages']], response['has_more']), (["two"], True))
+        response = self.client.get(self.url, {'sync': response['sync'], 'limit': 1}).json()
+        self.assertEqual(([m['content'] for m in response['messages']], response['has_more']), (["three"], False))
+
+    def test_read_receipt_changes_token(self):
+        token = self.client.get(self.url, {'since': self.saved[-1].pk}).json()['sync']
+        PrivateMessage.mark_read_up_to(self.bob.pk, self.alice.pk)
+        response = self.client.get(self.url, {'sync': token}).json()
+        self.assertEqual((response['messages'], response['read_up_to']['bob']), ([], self.saved[-1].pk))
+
+    def test_bad_token(self):
+        self.assertEqual(self.client.get(self.url, {'sync': 'nonsense'}).status_code, 400)
+
+    def test_long_poll_wakes_on_message(self):
+        token = self.client.get(self.url, {'since': self.saved[-1].pk}).json()['sync']
+        client = AsyncClient()
+        client.force_login(self.bob)
+
+        async def main():
+            async def send_later():
+                await asyncio.sleep(0.2)
+                message = (await asyncio.to_thread(save_messages, self.alice, self.bob, "four"))[0]
+                await get_channel_layer().group_send(chat_group_name('alice', 'bob'),
+                                                     message_event(message, 'alice', 'bob'))
+
+            started = asyncio.get_running_loop().time()
+            response, _ = await asyncio.gather(client.get(self.url, {'sync': token, 'wait': 10}), send_later())
+            return response, asyncio.get_running_loop().time() - started
+
+        response, elapsed = asyncio.run(main())
+        self.assertEqual([message['content'] for message in response.json()['messages']], ["four"])
+        self.assertLess(elapsed, 5)
+
+    def test_long_poll_times_out(self):
+        token = self.client.get(self.url, {'since': self.saved[-1].pk}).json()['sync']
+        self.assertEqual(self.client.get(self.url, {'sync': token, 'wait': 0.2}).status_code, 304)
+
+
+@override_settings(CACHES=BENCHMARK_CACHES, CHANNEL_LAYERS=BENCHMARK_CHANNEL_LAYERS['inmemory'])
+class PresenceTests(TransactionTestCase):
+    """Connection counts are shared by every worker, so a user is online from their first tab anywhere to their last."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.admin = User.objects.create(username='admin', is_superuser=True)
+
+    def is_online(self):
+        return UserStatus.objects.get(user=self.alice).is_online
+
+    def test_counts_span_workers(self):
+        # Two tabs, each counted by a different process.
+        self.assertTrue(open_connection(self.alice.pk))
+        self.assertFalse(open_connection(self.alice.pk))
+        self.assertFalse(close_connection(self.alice.pk))
+        self.assertTrue(self.is_online())
+        self.assertTrue(close_connection(self.alice.pk))
+        self.assertFalse(self.is_online())
+
+    def test_reconcile_reports_and_forgets_stale_users(self):
+        open_connection(self.alice.pk)
+        UserStatus.objects.filter(user=self.alice).update(last_seen=timezone.now() - timedelta(seconds=600))
+        changes = reconcile_stale_statuses(90)
+        self.assertEqual(changes, [{'user_id': self.alice.pk, 'username': 'alice', 'is_online': False,
+                                    'group': SUPERUSER_WATCHERS_GROUP}])
+        self.assertFalse(self.is_online())
+        # The crashed worker's count is gone, so the next connection is a transition again.
+        self.assertTrue(open_connection(self.alice.pk))
+
+    def test_watchers_see_first_and_last_connection(self):
+        async def connect(user):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/online_status/")
+            communicator.scope['user'] = user
+            await communicator.connect()
+            return communicator
+
+        async def changes(watcher):
+            event = json.loads(await watcher.receive_from(timeout=2))
+            return [(change['username'], change['is_online']) for change in event['changes']]
+
+        async def main():
+            watcher = await connect(self.admin)
+            tabs = [await connect(self.alice), await connect(self.alice)]
+            online = await changes(watcher)
+            await tabs[0].disconnect()
+            quiet = await watcher.receive_nothing(1)
+            await tabs[1].disconnect()
+            offline = await changes(watcher)
+            await watcher.disconnect()
+            return online, quiet, offline
+
+        with mock.patch('chat.presence.PRESENCE_BROADCAST_INTERVAL', 0.05):
+            self.assertEqual(asyncio.run(main()), ([('alice', True)], True, [('alice', False)]))
+
+
+class LocalFirstChannelLayerTests(SimpleTestCase):
+    """Local channels are served from queues; only other nodes' traffic goes through the transport."""
+
+    def test_local_delivery(self):
+        async def main():
+            layer = LocalFirstChannelLayer()
+            first, second = await layer.new_channel(), await layer.new_channel()
+            await layer.group_add('room', first)
+            await layer.group_add('room', second)
+            await layer.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+            await layer.group_discard('room', second)
+            await layer.send(second, {'type': 'direct'})
+            received = [await layer.receive(first), await layer.receive(second), await layer.receive(second)]
+            return received, layer.metrics()
+
+        received, metrics = asyncio.run(main())
+        self.assertEqual([message['type'] for message in received], ['chat.message', 'chat.message', 'direct'])
+        self.assertEqual((metrics['local_deliveries'], metrics['remote_sends']), (3, 0))
+        # Drained queues are dropped, so only the group is left.
+        self.assertEqual((metrics['groups'], metrics['local_channels'], metrics['queued_messages']), (1, 0, 0))
+
+    def test_full_channel_drops_expired_before_refusing(self):
+        async def main():
+            layer = LocalFirstChannelLayer(capacity=2, expiry=0.05)
+            channel = await layer.new_channel()
+            await layer.group_add('room', channel)
+            for _ in range(2):
+                await layer.send(channel, {'type': 'old'})
+            await asyncio.sleep(0.1)
+            # Nobody read the expired messages: they make room and the channel leaves its groups.
+            await layer.send(channel, {'type': 'new'})
+            left_groups = not layer.groups['room']
+            await layer.send(channel, {'type': 'new'})
+            with self.assertRaises(ChannelFull):
+                await layer.send(channel, {'type': 'new'})
+            return left_groups, layer.metrics()
+
+        left_groups, metrics = asyncio.run(main())
+        self.assertTrue(left_groups)
+        self.assertEqual((metrics['expired'], metrics['channel_full']), (2, 1))
+
+    def test_remote_delivery_through_transport(self):
+        async def main():
+            transport = InMemoryChannelLayer()
+            here, there = LocalFirstChannelLayer(), LocalFirstChannelLayer()
+            here.transport = there.transport = transport
+            local, remote = await here.new_channel(), await there.new_channel()
+            for layer, channel in ((here, local), (there, remote)):
+                await layer.group_add('room', channel)
+            await here.send(remote, {'type': 'direct'})
+            await here.group_send('room', {'type': 'chat.message'})
+            received = [await asyncio.wait_for(there.receive(remote), 1) for _ in range(2)]
+            received.append(await here.receive(local))
+            # The sender's own copy of the group publish comes back and is dropped.
+            await asyncio.sleep(0.05)
+            metrics = here.metrics(), there.metrics()
+            for layer in (here, there):
+                await layer.close()
+            return received, metrics
+
+        received, (here, there) = asyncio.run(main())
+        self.assertEqual([message['type'] for message in received], ['direct', 'chat.message', 'chat.message'])
+        self.assertEqual((here['local_deliveries'], here['remote_sends'], here['remote_echoes']), (1, 2, 1))
+        self.assertEqual((there['local_deliveries'], there['remote_deliveries']), (0, 2))
+
+
+class UnixSocketChannelLayerTests(SimpleTestCase):
+    """Workers on one host exchange messages and group memberships over Unix sockets."""
+
+    def setUp(self):
+        self.path = self.enterContext(tempfile.TemporaryDirectory())
+
+    async def start(self, layer):
+        channel = await layer.new_channel()
+        await layer.listen(channel)
+        return channel
+
+    async def settle(self):
+        await asyncio.sleep(0.05)
+
+    def test_send_and_group_send_between_workers(self):
+        async def main():
+            first, second = UnixSocketChannelLayer(self.path), UnixSocketChannelLayer(self.path)
+            a, b = await self.start(first), await self.start(second)
+            await self.settle()
+            await second.group_add('room', b)
+            await first.group_add('room', a)
+            await self.settle()
+            await first.send(b, {'type': 'direct'})
+            await first.group_send('room', {'type': 'chat.message'})
+            received = [await asyncio.wait_for(second.receive(b), 1) for _ in range(2)]
+            received.append(await first.receive(a))
+            members = first.members['room'], second.members['room']
+            for layer in (first, second):
+                await layer.close()
+            return received, members
+
+        received, members = asyncio.run(main())
+        self.assertEqual([message['type'] for message in received], ['direct', 'chat.message', 'chat.message'])
+        self.assertEqual(members[0], members[1])
+
+    def test_late_worker_learns_existing_memberships(self):
+        async def main():
+            first = UnixSocketChannelLayer(self.path)
+            a = await self.start(first)
+            await first.group_add('room', a)
+            second = UnixSocketChannelLayer(self.path)
+            await self.start(second)
+            await self.settle()
+            await second.group_send('room', {'type': 'chat.message'})
+            received = await asyncio.wait_for(first.receive(a), 1)
+            for layer in (first, second):
+                await layer.close()
+            return received
+
+        self.assertEqual(asyncio.run(main())['type'], 'chat.message')
+
+    def test_exited_worker_is_forgotten(self):
+        async def main():
+            first, second = UnixSocketChannelLayer(self.path), UnixSocketChannelLayer(self.path)
+            await self.start(first)
+            b = await self.start(second)
+            await second.group_add('room', b)
+            await self.settle()
+            await second.close()
+            await first.group_send('room', {'type': 'chat.message'})
+            state = first.members.get('room'), b in first.peers, os.path.exists(second.socket_path(b))
+            await first.close()
+            return state
+
+        self.assertEqual(asyncio.run(main()), (None, False, False))
+
+
+@override_settings(CACHES=BENCHMARK_CACHES, CHANNEL_LAYERS=BENCHMARK_CHANNEL_LAYERS['inmemory'])
+class SignalingRoomsTests(SimpleTestCase):
+    """Screen-share rooms live in the shared cache, so peers on different workers see one room."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_room_is_shared_between_workers(self):
+        async def main():
+            # One registry per worker process.
+            first, second = SignalingRooms(max_peers=2), SignalingRooms(max_peers=2)
+            await first.join('lobby', 'a', 'specific.a')
+            await second.join('lobby', 'b', 'specific.b')
+            with self.assertRaises(RoomFull):
+                await first.join('lobby', 'c', 'specific.c')
+            seen = await first.peers('lobby', exclude='a'), await second.channel_for('lobby', 'a')
+            await first.leave('lobby', 'a')
+            await second.join('lobby', 'c', 'specific.c')
+            return seen, sorted(await first.peers('lobby'))
+
+        self.assertEqual(asyncio.run(main()), ((['b'], 'specific.a'), ['b', 'c']))
+
+    def test_full_room_closes_the_socket(self):
+        async def connect():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/screenshare/lobby/")
+            await communicator.connect()
+            return communicator
+
+        async def main():
+            peers = [await connect(), await connect()]
+            welcome = json.loads(await peers[1].receive_from())
+            rejected = await connect()
+            error = json.loads(await rejected.receive_from())
+            closed = await rejected.receive_output()
+            for communicator in peers:
+                await communicator.disconnect()
+            return welcome, error, closed
+
+        with mock.patch('chat.consumers.signaling_rooms', SignalingRooms(max_peers=2)):
+            welcome, error, closed = asyncio.run(main())
+        self.assertEqual((welcome['type'], len(welcome['peers'])), ('welcome', 1))
+        self.assertEqual(error, {'error': 'Room is full'})
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': 4003})
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(2, 3)
+        now = bucket.updated
+        self.assertEqual([bucket.take(now) for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(bucket.retry_after(), 0.5)
+        self.assertTrue(bucket.take(now + 0.5))
+        self.assertFalse(bucket.take(now + 0.5))
+
+    def test_prune_forgets_only_refilled_buckets(self):
+        buckets = UserBuckets()
+        idle = buckets.get('chat', 'user:1', 1000, 5)
+        busy = buckets.get('chat', 'user:2', 0.001, 5)
+        for bucket in (idle, busy):
+            bucket.take()
+        time.sleep(0.01)
+        buckets.prune()
+        self.assertEqual(list(buckets.buckets), [('chat', 'user:2')])
+
+
+@override_settings(CACHES=BENCHMARK_CACHES, CHANNEL_LAYERS=BENCHMARK_CHANNEL_LAYERS['inmemory'])
+class ThrottleTests(TransactionTestCase):
+    """Frames over the limit are dropped with one error per run, and a flooding socket is closed."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        limits = {'status': {'connection': (0.001, 2), 'user': (0.001, 3)}}
+        self.enterContext(mock.patch('chat.throttling.RATE_LIMITS', limits))
+        self.enterContext(mock.patch('chat.throttling.RATE_LIMIT_CLOSE_AFTER', 4))
+        self.enterContext(mock.patch('chat.throttling.user_buckets', UserBuckets()))
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/online_status/")
+        communicator.scope['user'] = self.alice
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def send(self, communicator, count):
+        for i in range(count):
+            await communicator.send_to(text_data=json.dumps({'message': i}))
+
+    async def replies(self, communicator):
+        replies = []
+        while not await communicator.receive_nothing(0.2):
+            output = await communicator.receive_output()
+            replies.append(json.loads(output['text']) if output['type'] == 'websocket.send' else output)
+        return replies
+
+    def test_drops_and_closes_flooding_connection(self):
+        async def main():
+            communicator = await self.connect()
+            await self.send(communicator, 2)
+            allowed = await self.replies(communicator)
+            await self.send(communicator, 3)
+            dropped = await self.replies(communicator)
+            await self.send(communicator, 1)
+            closed = await self.replies(communicator)
+            await communicator.disconnect()
+            return allowed, dropped, closed
+
+        before = throttle_counters.copy()
+        allowed, dropped, closed = asyncio.run(main())
+        self.assertEqual(allowed, [{'message': 0}, {'message': 1}])
+        self.assertEqual(len(dropped), 1)
+        self.assertEqual(dropped[0]['error'], 'Rate limit exceeded')
+        self.assertGreater(dropped[0]['retry_after'], 0)
+        self.assertEqual(closed, [{'type': 'websocket.close', 'code': RATE_LIMIT_CLOSE_CODE}])
+        self.assertEqual(throttle_counters['throttled'] - before['throttled'], 4)
+        self.assertEqual(throttle_counters['closed_flooding'] - before['closed_flooding'], 1)
+
+    def test_user_bucket_is_shared_by_connections(self):
+        async def main():
+            first, second = await self.connect(), await self.connect()
+            await self.send(first, 2)
+            await self.send(second, 2)
+            replies = await self.replies(first), await self.replies(second)
+            for communicator in (first, second):
+                await communicator.disconnect()
+            return replies
+
+        first, second = asyncio.run(main())
+        self.assertEqual(first, [{'message': 0}, {'message': 1}])
+        self.assertEqual(second[0], {'message': 0})
+        self.assertEqual(second[1]['error'], 'Rate limit exceeded')
+
+
+@override_settings(CACHES=BENCHMARK_CACHES)
+class AppendChunkTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.user = User.objects.create(username='alice')
+
+    def test_chunks_at_offsets(self):
+        session = start_upload(self.user, 'note.txt', 6)
+        session = append_chunk(session, 0, [b'ab', b'c'])
+        self.assertEqual(session.received, 3)
+        self.assertFalse(session.is_complete)
+        session = append_chunk(session, 3, [b'def'])
+        self.assertTrue(session.is_complete)
+        self.assertEqual(session.blob.sha256, hashlib.sha256(b'abcdef').hexdigest())
+        self.assertEqual(Blob.objects.get().size, 6)
+
+    def test_wrong_offset_conflicts(self):
+        session = start_upload(self.user, 'note.txt', 6)
+        append_chunk(session, 0, [b'abc'])
+        # A retry of the chunk that already arrived.
+        with self.assertRaises(UploadConflict) as conflict:
+            append_chunk(session, 0, [b'abc'])
+        self.assertEqual(conflict.exception.offset, 3)
+        with self.assertRaises(ValueError):
+            append_chunk(session, 3, [b'defg'])
+
+
+@override_settings(CACHES=BENCHMARK_CACHES)
+class ExportImportTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        save_messages(self.alice, self.bob, "one", "two, with a comma", "three\nlines")
+
+    def stored(self):
+        return list(PrivateMessage.objects.order_by('seq').values_list('sender__username', 'content', 'seq'))
+
+    def round_trip(self, format):
+        before = self.stored()
+        text = ''.join(export_chunks(format, export_pages(chunk_size=2)))
+        Conversation.objects.all().delete()
+        PrivateMessage.objects.all().delete()
+        self.assertEqual(list(import_records(read_records(io.StringIO(text, newline=''), format), 2)), [(2, 0), (1, 0)])
+        self.assertEqual(self.stored(), before)
+        # Loading the same export again adds nothing.
+        self.assertEqual(list(import_records(read_records(io.StringIO(text, newline=''), format))), [(0, 3)])
+        self.assertEqual(self.stored(), before)
+
+    def test_ndjson(self):
+        self.round_trip('ndjson')
+
+    def test_csv(self):
+        self.round_trip('csv')
+
+    def test_reimporting_attachments_adds_nothing(self):
+        dialog_key = PrivateMessage.make_dialog_key(self.alice.pk, self.bob.pk)
+        insert_messages([
+            PrivateMessage(sender=self.alice, recipient=self.bob, dialog_key=dialog_key, content=None,
+                           file='chat_files/photo.png'),
+            PrivateMessage(sender=self.alice, recipient=self.bob, dialog_key=dialog_key, content="caption",
+                           file='chat_files/other.png'),
+        ])
+        for format in ('csv', 'ndjson'):
+            with self.subTest(format=format):
+                text = ''.join(export_chunks(format, export_pages()))
+                # CSV gives the attachment-only message '' for content.
+                self.assertEqual(list(import_records(read_records(io.StringIO(text, newline=''), format))), [(0, 5)])
+
+    def test_same_text_with_another_file_is_imported(self):
+        record = dict(next(export_pages())[0], file='chat_files/photo.png')
+        self.assertEqual(list(import_records([record])), [(1, 0)])
+
+    def test_unknown_users_are_skipped(self):
+        records = [{'sender': 'alice', 'recipient': 'nobody', 'timestamp': '2024-03-01T09:30:00+00:00',
+                    'is_read': True, 'content': 'hi', 'file': None}]
+        self.assertEqual(list(import_records(records)), [(0, 1)])
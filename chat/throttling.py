@@ -0,0 +1,156 @@
+"""Rate limits on frames from clients and limits on frames queued for slow ones.
+
+Inbound, each connection has a token bucket and so does each user (or client
+address, for anonymous sockets), with rates set per consumer type:
+
+    CHAT_RATE_LIMITS = {
+        'chat': {'connection': (10, 20), 'user': (20, 40)},  # (frames per second, burst)
+        ...
+    }
+
+Frames over the limit are dropped before they are decoded. The client gets
+one error per run of dropped frames, and a connection that keeps sending
+through CHAT_RATE_LIMIT_CLOSE_AFTER of them is closed.
+
+Outbound, chat.server stops writing to a socket whose client does not read:
+frames are dropped, or the socket is closed, once CHAT_WS_SLOW_CONSUMER_BUFFER
+bytes are queued beyond Twisted's write buffer. Closing is the default
+because chat clients reconnect with resume_from and get what they missed.
+"""
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from .metrics import Counter as CounterMetric
+
+RATE_LIMITS = getattr(settings, 'CHAT_RATE_LIMITS', {
+    'chat': {'connection': (10, 20), 'user': (20, 40)},
+    # ICE candidates arrive in bursts when a call starts.
+    'screenshare': {'connection': (50, 200), 'user': (100, 400)},
+    'notifications': {'connection': (2, 5), 'user': (5, 10)},
+    'status': {'connection': (2, 5), 'user': (5, 10)},
+})
+RATE_LIMIT_CLOSE_AFTER = getattr(settings, 'CHAT_RATE_LIMIT_CLOSE_AFTER', 100)
+RATE_LIMIT_CLOSE_CODE = 4008
+SLOW_CONSUMER_BUFFER = getattr(settings, 'CHAT_WS_SLOW_CONSUMER_BUFFER', 1024 * 1024)
+SLOW_CONSUMER_ACTION = getattr(settings, 'CHAT_WS_SLOW_CONSUMER_ACTION', 'close')
+
+# Process-wide: throttled, closed_flooding, outbox_full, slow_dropped, slow_closed.
+throttle_counters = Counter()
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None):
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class UserBuckets:
+    """Buckets shared by every connection of one user in this process, (scope, user) -> bucket."""
+
+    prune_every = 1000
+
+    def __init__(self):
+        self.buckets = {}
+        self.created = 0
+
+    def get(self, scope, user, rate, burst):
+        key = (scope, user)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.created += 1
+            if self.created % self.prune_every == 0:
+                self.prune()
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def prune(self):
+        # A bucket that has refilled is the same as a new one.
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+
+user_buckets = UserBuckets()
+
+
+def client_key(scope):
+    user = scope.get('user')
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    client = scope.get('client')
+    return f"addr:{client[0]}" if client else None
+
+
+class ThrottleMixin:
+    """Token-bucket limits on incoming frames for AsyncWebsocketConsumer subclasses.
+
+    `throttle_scope` picks the entry of CHAT_RATE_LIMITS; consumers without
+    one are not limited.
+    """
+    throttle_scope = None
+    throttled_run = 0
+
+    async def websocket_receive(self, message):
+        if self.frame_allowed():
+            self.throttled_run = 0
+            await super().websocket_receive(message)
+            return
+        throttle_counters['throttled'] += 1
+        self.throttled_run += 1
+        if self.throttled_run == 1:
+            await self.send_event({'error': 'Rate limit exceeded', 'retry_after': round(self.retry_after(), 3)})
+        elif self.throttled_run == RATE_LIMIT_CLOSE_AFTER:
+            throttle_counters['closed_flooding'] += 1
+            await self.close(code=RATE_LIMIT_CLOSE_CODE)
+
+    def frame_allowed(self):
+        limits = RATE_LIMITS.get(self.throttle_scope)
+        if not limits:
+            return True
+        self.throttle_buckets = []
+        if limits.get('connection'):
+            if not hasattr(self, 'connection_bucket'):
+                self.connection_bucket = TokenBucket(*limits['connection'])
+            self.throttle_buckets.append(self.connection_bucket)
+        user = client_key(self.scope)
+        if limits.get('user') and user is not None:
+            # Looked up per frame, so a pruned bucket is never still in use.
+            self.throttle_buckets.append(user_buckets.get(self.throttle_scope, user, *limits['user']))
+        now = time.monotonic()
+        return all(bucket.take(now) for bucket in self.throttle_buckets)
+
+    def retry_after(self):
+        return max((bucket.retry_after() for bucket in self.throttle_buckets), default=0.0)
+
+
+def metrics():
+    """Throttling counters for this process."""
+    return {name: throttle_counters[name] for name in (
+        'throttled', 'closed_flooding', 'outbox_full', 'slow_dropped', 'slow_closed',
+    )}
+
+
+CounterMetric('chat_throttle_events_total', "Throttled and dropped frames, closed connections, by kind.",
+              ['event'], callback=metrics)
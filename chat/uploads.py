@@ -0,0 +1,188 @@
+import fcntl
+import hashlib
+import mimetypes
+import os
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import Blob, UploadSession
+
+UPLOAD_MAX_CHUNK_BYTES = getattr(settings, 'CHAT_UPLOAD_MAX_CHUNK_BYTES', 8 * 1024 * 1024)
+UPLOAD_QUOTA_BYTES = getattr(settings, 'CHAT_UPLOAD_QUOTA_BYTES', 2 * 1024 * 1024 * 1024)
+UPLOAD_READ_BYTES = 64 * 1024
+
+BLOB_DIR = 'chat_files/blobs'
+PARTIAL_DIR = 'chat_files/uploads'
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class UploadConflict(Exception):
+    def __init__(self, offset):
+        super().__init__(f"Upload continues at offset {offset}")
+        self.offset = offset
+
+
+def blob_name(digest):
+    return f"{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+def partial_path(session):
+    return os.path.join(settings.MEDIA_ROOT, PARTIAL_DIR, f"{session.pk}.part")
+
+
+def user_usage(user):
+    """Bytes counted against the user's quota: distinct blobs they uploaded plus unfinished uploads."""
+    stored = Blob.objects.filter(uploads__user=user).distinct().aggregate(total=Sum('size'))['total'] or 0
+    pending = UploadSession.objects.filter(user=user, completed_at__isnull=True) \
+        .aggregate(total=Sum('size'))['total'] or 0
+    return stored + pending
+
+
+def start_upload(user, filename, size):
+    if size < 0:
+        raise ValueError("Upload size must not be negative")
+    with transaction.atomic():
+        # One user's starts take turns, so two cannot both fit under the quota. The row lock does it
+        # where the database has one; on SQLite the IMMEDIATE transaction already holds the write lock.
+        User.objects.select_for_update().filter(pk=user.pk).first()
+        if user_usage(user) + size > UPLOAD_QUOTA_BYTES:
+            raise QuotaExceeded(f"Upload of {size} bytes would exceed the {UPLOAD_QUOTA_BYTES} byte quota")
+        return UploadSession.objects.create(user=user, filename=os.path.basename(filename)[:255], size=size)
+
+
+# Running digests of in-progress uploads, keyed by session id. They are
+# process-local; a chunk that lands on another worker rehashes the partial
+# file from disk instead.
+_hashers = {}
+
+
+def _hasher_for(session, path):
+    cached = _hashers.get(session.pk)
+    if cached is not None and cached[0] == session.received:
+        return cached[1]
+    hasher = hashlib.sha256()
+    if session.received:
+        with open(path, 'rb') as file:
+            remaining = session.received
+            while remaining:
+                data = file.read(min(1024 * 1024, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+    return hasher
+
+
+def read_stream(stream, length):
+    remaining = length
+    while remaining:
+        data = stream.read(min(UPLOAD_READ_BYTES, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def append_chunk(session, offset, pieces):
+    """Stream `pieces` (an iterable of bytes) to the upload's partial file at `offset`.
+
+    Bytes are hashed as they are written, so nothing is ever read back
+    except after a worker change. Returns the session, completed once
+    `size` bytes have arrived.
+
+    Requests for one upload take turns on a lock on the partial file, and the
+    offset is checked against the database once the lock is held, so a
+    retried chunk racing the original gets UploadConflict instead of both
+    writing.
+    """
+    path = partial_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        session.refresh_from_db(fields=['received', 'blob', 'completed_at'])
+        if session.is_complete:
+            if not os.fstat(file.fileno()).st_size:
+                # Opened after finish_upload moved the partial file away, so this one was just created.
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            return session
+        if offset != session.received:
+            raise UploadConflict(session.received)
+
+        hasher = _hasher_for(session, path)
+        file.seek(offset)
+        # Anything past the acknowledged offset belongs to an interrupted chunk.
+        file.truncate()
+        received = session.received
+        for data in pieces:
+            if received + len(data) > session.size:
+                raise ValueError("Upload is larger than announced")
+            file.write(data)
+            hasher.update(data)
+            received += len(data)
+        file.flush()
+
+        # Conditional as well, so a writer that got around the lock cannot be overwritten.
+        if not UploadSession.objects.filter(pk=session.pk, received=offset).update(received=received):
+            _hashers.pop(session.pk, None)
+            session.refresh_from_db(fields=['received'])
+            raise UploadConflict(session.received)
+        session.received = received
+        if received == session.size:
+            _hashers.pop(session.pk, None)
+            # Still under the lock, so a request waiting on it finds the session complete.
+            return finish_upload(session, path, hasher.hexdigest())
+        _hashers[session.pk] = (received, hasher)
+        return session
+
+
+def finish_upload(session, path, digest):
+    name = blob_name(digest)
+    target = os.path.join(settings.MEDIA_ROOT, name)
+    with transaction.atomic():
+        content_type = mimetypes.guess_type(session.filename)[0] or 'application/octet-stream'
+        blob, created = Blob.objects.get_or_create(
+            sha256=digest, defaults={'name': name, 'size': session.size, 'content_type': content_type},
+        )
+        if created or not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        else:
+            # Same content is already stored, keep the existing copy.
+            os.remove(path)
+        session.blob = blob
+        session.completed_at = timezone.now()
+        session.save(update_fields=['blob', 'completed_at'])
+    return session
+
+
+def store_file(user, uploaded_file):
+    """Store a regular multipart upload through the same deduplicating path."""
+    session = start_upload(user, uploaded_file.name, uploaded_file.size)
+    return append_chunk(session, 0, uploaded_file.chunks())
+
+
+def blob_url(blob):
+    return default_storage.url(blob.name)
+
+
+def owned_blob_name(user_id, file_url):
+    """Storage name of the blob `file_url` points at if `user_id` finished uploading it, else None.
+
+    Clients send `file_url` with their messages; this is all a message may attach.
+    """
+    name = Blob.name_from_file_value(file_url)
+    if not name or not name.startswith(BLOB_DIR + '/'):
+        return None
+    owned = UploadSession.objects.filter(user_id=user_id, blob__name=name, completed_at__isnull=False).exists()
+    return name if owned else None
@@ -10,7 +10,16 @@ urlpatterns = [
     path('chat/', views.chat_view, name='chat'),
     path('users/', users_view, name='users'),
     path('upload-file/', views.upload_file, name='upload_file'),
+    path('upload/start/', views.upload_start, name='upload_start'),
+    path('upload/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('attachments/<int:message_id>/', views.attachment_view, name='attachment'),
+    path('attachments/<int:message_id>/thumbnail/', views.attachment_view, {'thumbnail': True},
+         name='attachment_thumbnail'),
     path('chat/fetch-messages/<str:username>/', views.fetch_new_messages, name='fetch_new_messages'),
+    path('chat/unread-count/<str:username>/', views.fetch_unread_count, name='fetch_unread_count'),
+    path('search/', views.search_view, name='search'),
     path('login_redirect/', LoginRedirectView.as_view(), name='login_redirect'),
     path('screenshare/<str:room_name>/', views.screen_share, name='screen_share'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('export/', views.export_view, name='export'),
 ]
@@ -0,0 +1,103 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import Http404
+
+from .database import db_read
+
+USER_CACHE_SIZE = getattr(settings, 'CHAT_USER_CACHE_SIZE', 1024)
+USER_CACHE_TTL = getattr(settings, 'CHAT_USER_CACHE_TTL', 300)
+
+
+class UserCache:
+    """Process-local LRU cache of username -> User with a TTL per entry.
+
+    Shared by views and consumers, so every access is guarded by a lock.
+    Callers get a copy of the cached instance and are free to modify it.
+    """
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._usernames_by_id = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        user = self._lookup(username)
+        if user is None:
+            self.misses += 1
+            user = User.objects.get(username=username)
+            self.set(user)
+        else:
+            self.hits += 1
+        return copy.copy(user)
+
+    def _lookup(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(username)
+                return None
+            self._entries.move_to_end(username)
+            return user
+
+    def set(self, user):
+        with self._lock:
+            self._entries[user.username] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user.username)
+            self._usernames_by_id[user.pk] = user.username
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, user):
+        # The user may have been renamed, so drop both the id's old entry and the new name.
+        with self._lock:
+            old_username = self._usernames_by_id.get(user.pk)
+            if old_username is not None:
+                self._remove(old_username)
+            self._remove(user.username)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._usernames_by_id.clear()
+
+    def _remove(self, username):
+        entry = self._entries.pop(username, None)
+        if entry is not None and self._usernames_by_id.get(entry[0].pk) == username:
+            del self._usernames_by_id[entry[0].pk]
+
+
+user_cache = UserCache()
+
+
+def get_user(username):
+    return user_cache.get(username)
+
+
+def get_user_or_404(username):
+    try:
+        return user_cache.get(username)
+    except User.DoesNotExist:
+        raise Http404(f"No user named {username!r}")
+
+
+aget_user = db_read(get_user)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate(instance)
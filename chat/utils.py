@@ -1,22 +1,200 @@
+import atexit
 import json
+import logging
 import os
+import re
+import threading
+import time
 
-# Path to your JSON file where messages will be saved
-MESSAGE_FILE_PATH = "messages.json"
+from django.conf import settings
 
-def save_message_to_file(message_data):
-    # Check if the file exists, if not, create it
-    if not os.path.exists(MESSAGE_FILE_PATH):
-        with open(MESSAGE_FILE_PATH, 'w') as file:
-            json.dump([], file)  # Initialize with an empty list if file doesn't exist
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+# Directory holding the newline-delimited message log segments.
+MESSAGE_LOG_DIR = getattr(settings, 'CHAT_MESSAGE_LOG_DIR', os.path.join(settings.BASE_DIR, 'message_log'))
+MESSAGE_LOG_SEGMENT_BYTES = getattr(settings, 'CHAT_MESSAGE_LOG_SEGMENT_BYTES', 64 * 1024 * 1024)
+MESSAGE_LOG_FSYNC_EVERY = getattr(settings, 'CHAT_MESSAGE_LOG_FSYNC_EVERY', 100)
+MESSAGE_LOG_FSYNC_INTERVAL = getattr(settings, 'CHAT_MESSAGE_LOG_FSYNC_INTERVAL', 1.0)
+
+SEGMENT_PATTERN = re.compile(r'^messages-(\d{8})\.ndjson$')
+
+
+def segment_name(number):
+    return f"messages-{number:08d}.ndjson"
+
+
+def list_segments(directory):
+    if not os.path.isdir(directory):
+        return []
+    numbers = [int(match.group(1)) for match in map(SEGMENT_PATTERN.match, os.listdir(directory)) if match]
+    return sorted(numbers)
+
+
+class FileLock:
+    """Exclusive lock across processes, held on a separate lock file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        else:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+
+
+class MessageLog:
+    """Append-only, segmented NDJSON log that several processes can write to.
+
+    Each append is a single write to an O_APPEND file descriptor under an
+    exclusive file lock, so records never interleave. A segment is rotated
+    once it reaches `segment_bytes`; fsync is batched to every `fsync_every`
+    records or `fsync_interval` seconds, whichever comes first.
+    """
 
-    # Read existing messages from the file
-    with open(MESSAGE_FILE_PATH, 'r') as file:
-        messages = json.load(file)
+    def __init__(self, directory=MESSAGE_LOG_DIR, segment_bytes=MESSAGE_LOG_SEGMENT_BYTES,
+                 fsync_every=MESSAGE_LOG_FSYNC_EVERY, fsync_interval=MESSAGE_LOG_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._file_lock = None
+        self._fd = None
+        self._segment = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
 
-    # Append the new message to the list
-    messages.append(message_data)
+    def append(self, record):
+        self.append_many([record])
 
-    # Write the updated messages back to the file
-    with open(MESSAGE_FILE_PATH, 'w') as file:
-        json.dump(messages, file, indent=4)
+    def append_many(self, records):
+        if not records:
+            return
+        data = ''.join(json.dumps(record, separators=(',', ':'), default=str) + '\n' for record in records).encode()
+        with self._lock:
+            if self._file_lock is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._file_lock = FileLock(os.path.join(self.directory, '.lock'))
+            with self._file_lock:
+                self._open_current_segment()
+                size = os.fstat(self._fd).st_size
+                if size and size + len(data) > self.segment_bytes:
+                    self._open_segment(self._segment + 1)
+                elif size and self._last_byte(size) != b'\n':
+                    # Terminate a torn record left by a crashed writer instead of appending to it.
+                    data = b'\n' + data
+                os.write(self._fd, data)
+            self._unsynced += len(records)
+            if (self._unsynced >= self.fsync_every
+                    or time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+
+    def flush(self):
+        with self._lock:
+            if self._fd is not None and self._unsynced:
+                self._sync()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _last_byte(self, size):
+        os.lseek(self._fd, size - 1, os.SEEK_SET)
+        return os.read(self._fd, 1)
+
+    def _sync(self):
+        os.fsync(self._fd)
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _open_current_segment(self):
+        # Another process may have rotated since our last append.
+        if self._segment is None:
+            segments = list_segments(self.directory)
+            self._open_segment(segments[-1] if segments else 1)
+        while os.path.exists(os.path.join(self.directory, segment_name(self._segment + 1))):
+            self._open_segment(self._segment + 1)
+
+    def _open_segment(self, number):
+        if self._fd is not None:
+            if self._unsynced:
+                self._sync()
+            os.close(self._fd)
+        path = os.path.join(self.directory, segment_name(number))
+        self._fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._segment = number
+
+
+def iter_message_log(directory=MESSAGE_LOG_DIR, start_segment=None, follow=False, poll_interval=0.5):
+    """Stream records from the log one line at a time, oldest first.
+
+    With `follow=True` it keeps waiting for new records (and new segments)
+    like ``tail -f`` instead of stopping at the end of the log.
+    """
+    segments = [n for n in list_segments(directory) if start_segment is None or n >= start_segment]
+    number = segments[0] if segments else (start_segment or 1)
+    while True:
+        path = os.path.join(directory, segment_name(number))
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                partial = b''
+                rotated = False
+                while True:
+                    line = file.readline()
+                    if line.endswith(b'\n'):
+                        try:
+                            yield json.loads(partial + line)
+                        except ValueError:
+                            logger.warning("Skipping corrupt record in %s", path)
+                        partial = b''
+                        continue
+                    # At the end of the segment, possibly in the middle of a write.
+                    partial += line
+                    if rotated:
+                        break  # a torn record left by a crashed writer is skipped
+                    if os.path.exists(os.path.join(directory, segment_name(number + 1))):
+                        rotated = True  # read whatever was written before the rotation
+                        continue
+                    if not follow:
+                        return
+                    time.sleep(poll_interval)
+        elif not follow:
+            return
+        else:
+            time.sleep(poll_interval)
+            continue
+        number += 1
+
+
+message_log = MessageLog()
+
+
+@atexit.register
+def _sync_on_exit():
+    message_log.close()
+
+
+def save_message_to_file(message_data):
+    message_log.append(message_data)
@@ -1,13 +1,35 @@
+import json
+
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.files.storage import FileSystemStorage
-from django.db.models import Q
 from django.shortcuts import redirect, get_object_or_404
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
-from .models import PrivateMessage, UserStatus
+from django.views.decorators.http import require_safe
+from django.db.models import Q
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from .attachments import THUMBNAIL_SIZES, Attachment, annotate_images, serve_attachment
+from .archive import find_archived_message
+from .database import db_read
+from .export import CONTENT_TYPES, export_chunks, export_pages
+from .fragments import render_sidebar
+from .models import Conversation, PrivateMessage, UploadSession
+from .history import HISTORY_PAGE_SIZE, get_history_page, serialize_message
+from .metrics import METRICS_TOKEN, render as render_metrics
+from .notifications import reset_unread_count, unread_count
+from .search import SEARCH_PAGE_SIZE, search_messages
+from .sync import (
+    SYNC_MAX_WAIT, SYNC_PAGE_SIZE, SyncState, chat_group_name, dialog_state, get_delta, state_after_message,
+    wait_for_change,
+)
+from .uploads import (
+    UPLOAD_MAX_CHUNK_BYTES, QuotaExceeded, UploadConflict, append_chunk, blob_url, read_stream,
+    start_upload, store_file,
+)
+from .user_cache import get_user_or_404
+from .workers import sticky_port
 from django.shortcuts import render
 
 
@@ -69,34 +91,132 @@ def user_list_view(request):
         users = User.objects.filter(is_superuser=False)
     else:
         users = User.objects.filter(is_superuser=True)
-    return render(request, 'chat/users.html', {'users': users})
+    inbox = [{
+        'user': conversation.other_user(request.user),
+        'preview': conversation.last_message_preview,
+        'last_message_at': conversation.last_message_at,
+        'unread': conversation.unread_for(request.user),
+    } for conversation in Conversation.for_user(request.user)]
+    users = users.select_related('userstatus').exclude(pk__in=[entry['user'].pk for entry in inbox])
+    return render(request, 'chat/users.html', {'inbox': inbox, 'users': users})
 
 @login_required
 def chat_view(request, username):
     user = request.user
-    recipient = get_object_or_404(User, username=username)
-    messages = PrivateMessage.objects.filter(
-        Q(sender=user, recipient=recipient) | Q(sender=recipient, recipient=user)
-    ).order_by('timestamp')
-    users = User.objects.all()
+    recipient = get_user_or_404(username)
+    Conversation.mark_read(user, recipient)
+    reset_unread_count(user, recipient)
+    # Only the latest page; older ones are fetched from fetch_new_messages as the user scrolls up.
+    messages, next_cursor = get_history_page(user, recipient)
+    messages.reverse()
+    annotate_images(messages)
     return render(request, 'chat/chat.html', {
         'messages': messages,
+        'next_cursor': next_cursor,
+        'last_seq': max((message.seq or 0 for message in messages), default=0),
+        'screenshare_room': '_'.join(sorted([user.username, recipient.username])),
+        # Under runworkers, both participants' sockets go to the worker that owns the room.
+        'ws_port': sticky_port(chat_group_name(user.username, recipient.username)),
         'user': user,
         'recipient': recipient,
-        'users': users,
-        'online_users': UserStatus.objects.filter(is_online=True)
+        'sidebar': render_sidebar(user),
     })
 
 @csrf_exempt
+@login_required
 def upload_file(request):
-    if request.method == 'POST' and request.FILES['file']:
-        file = request.FILES['file']
-        fs = FileSystemStorage()
-        filename = fs.save(file.name, file)
-        file_url = fs.url(filename)
-        return JsonResponse({'file_url': file_url})
+    if request.method == 'POST' and request.FILES.get('file'):
+        try:
+            session = store_file(request.user, request.FILES['file'])
+        except QuotaExceeded as error:
+            return JsonResponse({'error': str(error)}, status=413)
+        return JsonResponse({'file_url': blob_url(session.blob)})
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
+
+@require_safe
+@login_required
+def attachment_view(request, message_id, thumbnail=False):
+    # Only the two participants of the owning message may fetch the file.
+    message = PrivateMessage.objects.only('file', 'sender') \
+        .filter(Q(sender=request.user) | Q(recipient=request.user), pk=message_id).first()
+    if message is None:
+        message = find_archived_message(request.user, message_id)
+    if message is None:
+        raise Http404("No message with that attachment")
+    attachment = Attachment.for_message(message)
+    if attachment is None:
+        raise Http404("Attachment not found")
+    thumbnail_size = None
+    if thumbnail:
+        if not attachment.is_image:
+            # Otherwise serve_attachment would fall back to the whole original.
+            raise Http404("Attachment is not an image")
+        try:
+            thumbnail_size = int(request.GET.get('size', THUMBNAIL_SIZES[0]))
+        except ValueError:
+            thumbnail_size = None
+        if thumbnail_size not in THUMBNAIL_SIZES:
+            return JsonResponse({'error': 'Invalid thumbnail size', 'sizes': list(THUMBNAIL_SIZES)}, status=400)
+    return serve_attachment(request, attachment, thumbnail_size)
+
+
+def upload_state(session):
+    state = {
+        'upload_id': str(session.pk),
+        'offset': session.received,
+        'size': session.size,
+        'complete': session.is_complete,
+        'chunk_size': UPLOAD_MAX_CHUNK_BYTES,
+    }
+    if session.is_complete:
+        state['file_url'] = blob_url(session.blob)
+        state['filename'] = session.filename
+    return state
+
+
+@csrf_exempt
+@login_required
+def upload_start(request):
+    """Open a resumable upload. Body: {"filename": ..., "size": ...}."""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=405)
+    try:
+        data = json.loads(request.body)
+        filename, size = str(data['filename']), int(data['size'])
+        session = start_upload(request.user, filename, size)
+    except QuotaExceeded as error:
+        return JsonResponse({'error': str(error)}, status=413)
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    return JsonResponse(upload_state(session), status=201)
+
+
+@csrf_exempt
+@login_required
+def upload_chunk(request, upload_id):
+    """GET reports how far an upload got; PUT/POST ?offset=N streams the next chunk as the raw body."""
+    session = get_object_or_404(UploadSession, pk=upload_id, user=request.user)
+    if request.method == 'GET':
+        return JsonResponse(upload_state(session))
+    if request.method not in ('PUT', 'POST'):
+        return JsonResponse({'error': 'Invalid request'}, status=405)
+    try:
+        offset = int(request.GET['offset'])
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    if length > UPLOAD_MAX_CHUNK_BYTES:
+        return JsonResponse({'error': 'Chunk too large', 'chunk_size': UPLOAD_MAX_CHUNK_BYTES}, status=413)
+    try:
+        # The request body is read straight into the partial file, never buffered whole.
+        session = append_chunk(session, offset, read_stream(request, length))
+    except UploadConflict as conflict:
+        return JsonResponse({'error': 'Offset mismatch', 'offset': conflict.offset}, status=409)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    return JsonResponse(upload_state(session))
+
 def screenshare_view(request):
     return render(request, 'chat/chat.html')
 
@@ -105,25 +225,90 @@ def users_view(request):
 
 
 @login_required
-def fetch_new_messages(request, username):
-    user = request.user
-    messages = PrivateMessage.objects.filter(
-        Q(sender__username=username, recipient=user.username) |
-        Q(sender=user.username, recipient__username=username)
-    ).order_by('-timestamp')
+async def fetch_new_messages(request, username):
+    """History pages by default; a delta sync when `sync` (or `since`) is given.
+
+    Delta sync: `sync` is the token from the previous response (also accepted
+    as If-None-Match), `since` a plain message id for a first sync. Unchanged
+    dialogs answer 304, after up to `wait` seconds of long-polling.
+    """
+    user = await request.auser()
+    recipient = await db_read(get_user_or_404)(username)
+    token = request.GET.get('sync') or request.headers.get('If-None-Match', '').removeprefix('W/').strip('"')
+    if not token and 'since' not in request.GET:
+        try:
+            messages, next_cursor = await db_read(get_history_page)(
+                user, recipient,
+                before=request.GET.get('before'),
+                limit=request.GET.get('limit', HISTORY_PAGE_SIZE),
+            )
+        except ValueError:
+            return JsonResponse({'error': 'Invalid pagination parameters'}, status=400)
+
+        await db_read(annotate_images)(messages)
+        message_data = [serialize_message(message) for message in messages]
+
+        return JsonResponse({'messages': message_data, 'next_cursor': next_cursor})
+
+    try:
+        if token:
+            since = SyncState.decode(token)
+        else:
+            since = await db_read(state_after_message)(user, recipient, int(request.GET['since']))
+        wait = min(float(request.GET.get('wait', 0)), SYNC_MAX_WAIT)
+        limit = int(request.GET.get('limit', SYNC_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid sync parameters'}, status=400)
+
+    current = await db_read(dialog_state)(user, recipient)
+    if current == since and wait > 0:
+        current = await wait_for_change(user, recipient, since, wait)
+    if current == since:
+        response = HttpResponseNotModified()
+        response['ETag'] = f'"{since.encode()}"'
+        return response
+
+    messages, state, has_more = await db_read(get_delta)(user, recipient, since, limit)
+    await db_read(annotate_images)(messages)
+    low, high = sorted((user, recipient), key=lambda u: u.pk)
+    response = JsonResponse({
+        'messages': [serialize_message(message) for message in messages],
+        'read_up_to': {low.username: state.read_low, high.username: state.read_high},
+        'sync': state.encode(),
+        'has_more': has_more,
+    })
+    response['ETag'] = f'"{state.encode()}"'
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
-    message_data = [{
-        'sender': message.sender.username,
-        'content': message.content,
-        'timestamp': message.timestamp.strftime('%H:%M')
-    } for message in messages]
 
-    return JsonResponse({'messages': message_data})
+@login_required
+def search_view(request):
+    """Ranked search over the requesting user's dialogs, optionally one dialog (?with=username)."""
+    other = get_user_or_404(request.GET['with']) if request.GET.get('with') else None
+    try:
+        results, next_cursor = search_messages(
+            request.user, request.GET.get('q', ''),
+            other=other,
+            cursor=request.GET.get('cursor'),
+            limit=request.GET.get('limit', SEARCH_PAGE_SIZE),
+        )
+    except ValueError:
+        return JsonResponse({'error': 'Invalid search parameters'}, status=400)
+    annotate_images([message for message, _ in results])
+
+    return JsonResponse({
+        'results': [
+            dict(serialize_message(message), recipient=message.recipient.username, highlight=highlight)
+            for message, highlight in results
+        ],
+        'next_cursor': next_cursor,
+    })
 
 
 @login_required
-def screen_share(request):
-    return render(request, 'chat.html')
+def screen_share(request, room_name):
+    return render(request, 'chat/chat.html', {'screenshare_room': room_name})
 
 from django.http import JsonResponse
 from django.contrib.auth.models import User
@@ -132,10 +317,38 @@ from .models import PrivateMessage
 @login_required
 def fetch_unread_count(request, username):
     user = request.user
-    recipient = User.objects.get(username=username)
-    unread_count = PrivateMessage.objects.filter(
-        recipient=recipient,
-        is_read=True,
-        deleted=True
-    ).count()
-    return JsonResponse({'unread_count': unread_count})
+    other = get_user_or_404(username)
+    # From the cached counter chat.notifications keeps; the Conversation row only seeds it.
+    return JsonResponse({'unread_count': unread_count(user, other)})
+
+
+@require_safe
+async def metrics_view(request):
+    # Async so the scrape reads the instruments on the event loop that updates them.
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return HttpResponse(status=401)
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@require_safe
+@login_required
+async def export_view(request):
+    """Stream messages for superusers: everything, one user's (?user=) or one dialog's (?user=&with=)."""
+    if not (await request.auser()).is_superuser:
+        return HttpResponse(status=403)
+    format = request.GET.get('format', 'ndjson')
+    if format not in CONTENT_TYPES:
+        return JsonResponse({'error': 'Invalid format', 'formats': sorted(CONTENT_TYPES)}, status=400)
+    user = await db_read(get_user_or_404)(request.GET['user']) if request.GET.get('user') else None
+    other = await db_read(get_user_or_404)(request.GET['with']) if user and request.GET.get('with') else None
+    chunks = export_chunks(format, export_pages(user, other))
+
+    async def stream():
+        # An async iterator, or Django would read a sync one to the end before sending anything. Each
+        # chunk is its own queries, so any reader thread can produce the next.
+        while (chunk := await db_read(next)(chunks, None)) is not None:
+            yield chunk
+
+    response = StreamingHttpResponse(stream(), content_type=CONTENT_TYPES[format])
+    response['Content-Disposition'] = f'attachment; filename="messages.{format}"'
+    return response
@@ -0,0 +1,209 @@
+import json
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .metrics import BYTES_OUT, CONNECTIONS, ENCODE_SECONDS, FRAMES_IN, FRAMES_OUT, Counter
+
+try:
+    import msgpack
+except ImportError:  # the MessagePack subprotocol is simply not offered
+    msgpack = None
+
+WIRE_FRAME_CACHE_SIZE = getattr(settings, 'CHAT_WIRE_FRAME_CACHE_SIZE', 2048)
+# Codecs whose frames are encoded once at group_send time and carried through the
+# channel layer. Connections on any other codec fall back to the frame cache, which
+# still encodes each event once per process. The browser client speaks plain JSON.
+FANOUT_CODECS = getattr(settings, 'CHAT_FANOUT_CODECS', ['chat.json'])
+
+# Positional layouts for the compact codecs. `type` becomes a small integer
+# and fields the client already knows (the recipient) are left out.
+COMPACT_SCHEMAS = {
+    'error': (0, ('error', 'client_id', 'peer_id')),
+    'chat_message': (1, ('id', 'seq', 'sender', 'message', 'file_url', 'attachment_url', 'thumbnail_url',
+                         'is_image')),
+    'message_ack': (2, ('id', 'seq', 'client_id')),
+    'read_receipt': (3, ('reader', 'up_to')),
+    'resync': (4, ('seq',)),
+    'notification': (5, ('dialogs',)),
+    'status_batch': (6, ('changes',)),
+    'user_status': (7, ('username', 'status')),
+    'welcome': (8, ('peer_id', 'peers')),
+    'peer_joined': (9, ('peer_id',)),
+    'peer_left': (10, ('peer_id',)),
+}
+# Anything without a schema (screen-share signals carrying SDP) is sent as [255, {...}].
+FREEFORM_CODE = 255
+
+
+def public_fields(event):
+    # Keys starting with an underscore are routing metadata, never sent to clients.
+    if any(key.startswith('_') for key in event):
+        return {key: value for key, value in event.items() if not key.startswith('_')}
+    return event
+
+
+def pack(event):
+    event = public_fields(event)
+    kind = 'error' if 'error' in event else event.get('type')
+    schema = COMPACT_SCHEMAS.get(kind)
+    if schema is None:
+        return [FREEFORM_CODE, event]
+    code, fields = schema
+    values = [event.get(field) for field in fields]
+    while values and values[-1] is None:
+        values.pop()
+    return [code, *values]
+
+
+class JsonCodec:
+    """The original wire format: one JSON object per text frame."""
+    name = 'chat.json'
+    binary = False
+
+    def encode(self, event):
+        return json.dumps(public_fields(event))
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class CompactJsonCodec(JsonCodec):
+    name = 'chat.compact.v1'
+
+    def encode(self, event):
+        return json.dumps(pack(event), separators=(',', ':'))
+
+
+class MsgpackCodec:
+    name = 'chat.msgpack.v1'
+    binary = True
+
+    def encode(self, event):
+        return msgpack.packb(pack(event))
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data)
+        except Exception as e:
+            raise ValueError(f"Invalid MessagePack frame: {e}") from e
+
+
+JSON_CODEC = JsonCodec()
+CODECS = {codec.name: codec for codec in (JSON_CODEC, CompactJsonCodec())}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+
+def encode(codec, event):
+    start = time.perf_counter()
+    frame = codec.encode(event)
+    ENCODE_SECONDS.observe(time.perf_counter() - start, codec.name)
+    return frame
+
+
+def negotiate(offered):
+    """Pick the first subprotocol the client offered that we speak: (codec, name or None)."""
+    for name in offered:
+        if name in CODECS:
+            return CODECS[name], name
+    return JSON_CODEC, None
+
+
+def stamp(event):
+    """Tag an event before group_send so every recipient in a process shares one encoding."""
+    event['_eid'] = uuid.uuid4().hex
+    return event
+
+
+def fanout(event, payload=None):
+    """Prepare a group event: stamp it and attach the frames its handlers will send.
+
+    `payload` is what clients receive, when the handler does not just forward
+    the event itself. Handlers pass the frames on with send_event(..., frames=...),
+    so the work per broadcast is one encode per codec rather than one per socket.
+    """
+    payload = public_fields(event if payload is None else payload)
+    event['_frames'] = {name: encode(CODECS[name], payload) for name in FANOUT_CODECS if name in CODECS}
+    return stamp(event)
+
+
+class FrameCache:
+    """Small LRU of encoded frames keyed by (codec, event id)."""
+
+    def __init__(self, maxsize=WIRE_FRAME_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, codec, event):
+        event_id = event.get('_eid')
+        if event_id is None:
+            return encode(codec, event)
+        key = (codec.name, event_id)
+        frame = self.frames.get(key)
+        if frame is not None:
+            self.hits += 1
+            self.frames.move_to_end(key)
+            return frame
+        self.misses += 1
+        frame = self.frames[key] = encode(codec, event)
+        if len(self.frames) > self.maxsize:
+            self.frames.popitem(last=False)
+        return frame
+
+
+frame_cache = FrameCache()
+Counter('chat_frame_cache_hits_total', "Frames reused from the frame cache.", callback=lambda: frame_cache.hits)
+Counter('chat_frame_cache_misses_total', "Frames the frame cache had to encode.", callback=lambda: frame_cache.misses)
+
+
+class WireProtocolMixin:
+    """Per-connection codec for AsyncWebsocketConsumer subclasses.
+
+    The codec is chosen from the subprotocols the client offers; clients that
+    offer none keep getting plain JSON text frames.
+    """
+    codec = JSON_CODEC
+    counted = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None:
+            self.codec, subprotocol = negotiate(self.scope.get('subprotocols') or [])
+        await super().accept(subprotocol, headers)
+        CONNECTIONS.inc(type(self).__name__)
+        self.counted = True
+
+    async def websocket_disconnect(self, message):
+        if self.counted:
+            CONNECTIONS.dec(type(self).__name__)
+            self.counted = False
+        await super().websocket_disconnect(message)
+
+    async def send_event(self, event, frames=None):
+        # Frames pre-encoded by fanout() are forwarded unchanged.
+        if frames is None:
+            frames = event.get('_frames')
+        frame = frames.get(self.codec.name) if frames else None
+        if frame is None:
+            frame = frame_cache.encode(self.codec, event)
+        FRAMES_OUT.inc(type(self).__name__)
+        BYTES_OUT.inc(type(self).__name__, amount=len(frame))
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        # Text frames are always JSON, whichever codec is in use. Raises ValueError
+        # for anything that cannot be read.
+        FRAMES_IN.inc(type(self).__name__)
+        if text_data is not None:
+            return json.loads(text_data)
+        if not self.codec.binary:
+            raise ValueError("Binary frame on a text subprotocol")
+        return self.codec.decode(bytes_data)
+
@@ -0,0 +1,154 @@
+"""Several ASGI worker processes on one host, see ``manage.py runworkers``.
+
+Every worker accepts on the shared port through its own SO_REUSEPORT socket,
+so the kernel spreads new connections across them. Each worker also listens
+on a sticky port of its own (shared port + 1 + index). Pages point a
+dialog's WebSockets at the worker its room hashes to, so both participants
+end up in the same process and their traffic never leaves it.
+
+With a retention interval the pool also runs ``manage.py apply_retention``
+that often, one run at a time.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Set by the launcher in each worker's environment.
+WORKER_COUNT = int(os.environ.get('CHAT_WORKERS', 0))
+WORKER_INDEX = int(os.environ.get('CHAT_WORKER_INDEX', 0))
+STICKY_BASE_PORT = int(os.environ.get('CHAT_WORKER_BASE_PORT', 0))
+
+RESTART_BACKOFF = 1.0
+
+
+def worker_for_room(room, workers):
+    """Rendezvous hash: stable per room, and only 1/n of rooms move when a worker is added."""
+    return max(range(workers), key=lambda index: hashlib.blake2b(
+        f"{index}:{room}".encode(), digest_size=8
+    ).digest())
+
+
+def sticky_port(room):
+    """Port of the worker that owns `room`, or None outside worker mode."""
+    if WORKER_COUNT < 2 or not STICKY_BASE_PORT:
+        return None
+    return STICKY_BASE_PORT + worker_for_room(room, WORKER_COUNT)
+
+
+def listening_socket(host, port, reuse_port=False, backlog=1024):
+    # IPv4 only: daphne's fd: endpoint adopts sockets as AF_INET.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class WorkerPool:
+    """Starts and supervises the workers; a worker that dies is started again on the same sockets."""
+
+    def __init__(self, application, workers, host='127.0.0.1', port=8000, sticky=True, ipc_dir=None,
+                 server_args=(), env=None, retention_interval=None):
+        self.application = application
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.sticky = sticky and workers > 1
+        self.ipc_dir = ipc_dir
+        self.owns_ipc_dir = ipc_dir is None
+        self.server_args = list(server_args)
+        self.env = env or {}
+        self.retention_interval = retention_interval
+        self.sockets = []
+        self.processes = []
+        self.retention = None
+        self.next_retention = None
+        self.stopping = False
+
+    def start(self):
+        if self.ipc_dir is None:
+            self.ipc_dir = tempfile.mkdtemp(prefix='chat-ipc-')
+        for index in range(self.workers):
+            listeners = [listening_socket(self.host, self.port, reuse_port=True)]
+            if self.sticky:
+                listeners.append(listening_socket(self.host, self.port + 1 + index))
+            self.sockets.append(listeners)
+        self.processes = [self.spawn(index) for index in range(self.workers)]
+        if self.retention_interval:
+            self.next_retention = time.monotonic() + self.retention_interval
+
+    def environment(self, index):
+        env = dict(os.environ, **self.env)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.settings')
+        env.update({
+            'CHAT_WORKERS': str(self.workers),
+            'CHAT_WORKER_INDEX': str(index),
+            'CHAT_WORKER_BASE_PORT': str(self.port + 1) if self.sticky else '0',
+            'CHAT_IPC_DIR': self.ipc_dir,
+        })
+        return env
+
+    def spawn(self, index):
+        listeners = self.sockets[index]
+        command = [sys.executable, '-m', 'chat.server']
+        for sock in listeners:
+            command += ['-e', f"fd:fileno={sock.fileno()}"]
+        command += self.server_args + [self.application]
+        logger.info("Starting worker %s: %s", index, ' '.join(command))
+        return subprocess.Popen(command, env=self.environment(index), pass_fds=[s.fileno() for s in listeners])
+
+    def run_retention(self):
+        # Skipped while the previous run is still going; it tries again next interval.
+        self.next_retention = time.monotonic() + self.retention_interval
+        if self.retention is not None and self.retention.poll() is None:
+            logger.warning("Previous retention run still going, skipping this one")
+            return
+        env = dict(os.environ, **self.env)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.settings')
+        logger.info("Starting retention run")
+        self.retention = subprocess.Popen([sys.executable, '-m', 'django', 'apply_retention'], env=env)
+
+    def supervise(self):
+        """Block until stop(), restarting workers that exit."""
+        while not self.stopping:
+            for index, process in enumerate(self.processes):
+                if process.poll() is not None and not self.stopping:
+                    logger.warning("Worker %s exited with %s, restarting", index, process.returncode)
+                    time.sleep(RESTART_BACKOFF)
+                    self.processes[index] = self.spawn(index)
+            if self.next_retention is not None and time.monotonic() >= self.next_retention:
+                self.run_retention()
+            time.sleep(0.5)
+
+    def stop(self, timeout=10):
+        self.stopping = True
+        if self.retention is not None and self.retention.poll() is None:
+            self.retention.send_signal(signal.SIGTERM)
+        for process in self.processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        for listeners in self.sockets:
+            for sock in listeners:
+                sock.close()
+        self.sockets = []
+        if self.owns_ipc_dir and self.ipc_dir:
+            shutil.rmtree(self.ipc_dir, ignore_errors=True)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -97,6 +98,24 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Kept open by the database writer and reader threads (chat.database).
+        'CONN_MAX_AGE': None,
+        'OPTIONS': {
+            # Seconds to wait for the write lock before "database is locked".
+            'timeout': 20,
+            # Take the write lock when a transaction starts; a deferred one that
+            # has to upgrade its lock later fails at once instead of waiting.
+            'transaction_mode': 'IMMEDIATE',
+            # WAL, which lets reads run alongside the writer, is set once by
+            # migration chat 0020. synchronous=NORMAL only syncs at checkpoints:
+            # a power cut can lose the last commits but never corrupts the database.
+            'init_command': (
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA mmap_size=268435456;'  # 256 MiB
+                'PRAGMA cache_size=-65536;'  # 64 MiB per connection
+                'PRAGMA temp_store=MEMORY;'
+            ),
+        },
     }
 }
 
@@ -105,16 +124,31 @@ SITE_URL = "http://localhost:8000"
 STATIC_URL = '/static/'
 
 ASGI_APPLICATION = 'chat_project.asgi.application'
+# Sockets in the same process are delivered to directly; Redis only carries
+# traffic between processes. Drop "transport" on a single-process install.
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "chat.layers.LocalFirstChannelLayer",
         "CONFIG": {
-            "hosts": [
-                "redis://:SAquUXnJZaVVSFzK5oaCHy9x9nWN2OZo@redis-14746.c8.us-east-1-3.ec2.redns.redis-cloud.com:14746"
-            ],
+            "capacity": 100,
+            "expiry": 60,
+            "transport": {
+                "BACKEND": "channels_redis.core.RedisChannelLayer",
+                "CONFIG": {
+                    "hosts": [
+                        "redis://:SAquUXnJZaVVSFzK5oaCHy9x9nWN2OZo@redis-14746.c8.us-east-1-3.ec2.redns.redis-cloud.com:14746"
+                    ],
+                },
+            },
         },
     },
 }
+# Workers started by `manage.py runworkers` share a host and talk over Unix sockets instead.
+if os.environ.get("CHAT_IPC_DIR"):
+    CHANNEL_LAYERS["default"]["CONFIG"]["transport"] = {
+        "BACKEND": "chat.ipc.UnixSocketChannelLayer",
+        "CONFIG": {"path": os.environ["CHAT_IPC_DIR"]},
+    }
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -176,7 +210,7 @@ LOGGING = {
         },
         'chat': {  # Ensure this matches your app name
             'handlers': ['console'],
-            'level': 'DEBUG',
+            'level': os.environ.get('CHAT_LOG_LEVEL', 'DEBUG'),
             'propagate': False,
         },
     },